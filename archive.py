@@ -0,0 +1,262 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import dbcontrol
+import fieldmap
+import gzip
+import json
+import os
+import re
+import stats
+import threading
+
+# Keeps every issue the sync downloads, as it came from the search API, in
+# compressed files next to jira.db, so a new field mapping (or anything else
+# the tickets/history tables don't keep) can be filled in from disk with
+# `jiraclone.py archive-replay` instead of downloading everything again.
+#
+# The archive is a directory of segments. Each one is a gzip file of JSON
+# lines, one issue per line, written as a separate gzip member per chunk of
+# issues, plus a tab separated index with a line per issue:
+#
+#   id, updated_ts, member offset, member length, line within the member
+#
+# A member is flushed before its index lines are written, so anything in an
+# index can be read back whole even after a crash, and a replay only has to
+# decompress the members holding the copy of an issue it actually wants.
+# Segments are closed once they pass segment_bytes.
+#
+# Settings, under "Archive" in jira_connection.json:
+#   "Enabled"            - false unless set
+#   "Path"               - the archive directory (jira_archive)
+#   "SegmentMegabytes"   - compressed size a segment is closed at (16)
+#
+# Searches ask for every field while the archive is on, so the archive has
+# whatever a later field mapping might want.
+
+DEFAULT_PATH = "jira_archive"
+DEFAULT_SEGMENT_MEGABYTES = 16
+
+# Replay work is submitted this many segments per process ahead of the
+# writer, so decoded rows can't pile up faster than SQLite takes them
+REPLAY_SEGMENTS_AHEAD = 2
+
+_SEGMENT_NAME = re.compile(r"^segment-(\d{6})\.jsonl\.gz$")
+
+
+class Archive:
+
+    def __init__(self, path=DEFAULT_PATH, segment_bytes=DEFAULT_SEGMENT_MEGABYTES * 1024 * 1024):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.segment_file = None
+        self.index_file = None
+        os.makedirs(path, exist_ok=True)
+
+    # Builds an archive from the "Archive" block of jira_connection.json, or
+    # returns None when it is missing or not enabled
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings or not settings.get("Enabled", False):
+            return None
+        return cls(
+            settings.get("Path", DEFAULT_PATH),
+            segment_bytes=int(float(settings.get("SegmentMegabytes", DEFAULT_SEGMENT_MEGABYTES)) * 1024 * 1024))
+
+    # Adds a chunk of search API issues as one gzip member. Safe to call from
+    # several threads; the encoding and compression happen outside the lock
+    def append(self, issues):
+        if not issues:
+            return
+        lines = [json.dumps(issue, separators=(",", ":")) for issue in issues]
+        member = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"), compresslevel=6)
+        entries = [(str(issue.get("id")), issue_updated_ts(issue)) for issue in issues]
+        with self.lock:
+            if self.segment_file is None or self.segment_file.tell() >= self.segment_bytes:
+                self.open_segment()
+            offset = self.segment_file.tell()
+            self.segment_file.write(member)
+            self.segment_file.flush()
+            self.index_file.write("".join(
+                f"{issue_id}\t{'' if updated_ts is None else updated_ts}\t{offset}\t{len(member)}\t{position}\n"
+                for position, (issue_id, updated_ts) in enumerate(entries)))
+            self.index_file.flush()
+        stats.count("archive.issues", len(issues))
+        stats.count("archive.bytes", len(member))
+
+    # Carries on with the newest segment if it has room, otherwise starts
+    # the next one
+    def open_segment(self):
+        self.close()
+        existing = segments(self.path)
+        if existing:
+            number, segment_path, index_path = existing[-1]
+            valid_bytes = repair_segment(segment_path, index_path)
+            if valid_bytes < self.segment_bytes:
+                self.segment_file = open(segment_path, "ab")
+                self.index_file = open(index_path, "a", encoding="utf-8")
+                return
+        number = existing[-1][0] + 1 if existing else 1
+        self.segment_file = open(segment_path_for(self.path, number), "xb")
+        self.index_file = open(index_path_for(self.path, number), "x", encoding="utf-8")
+
+    def close(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.index_file.close()
+        self.segment_file = None
+        self.index_file = None
+
+
+def issue_updated_ts(issue):
+    fields = issue.get("fields")
+    return dbcontrol.to_epoch(fields.get("updated")) if isinstance(fields, dict) else None
+
+
+def segment_path_for(path, number):
+    return os.path.join(path, f"segment-{number:06d}.jsonl.gz")
+
+
+def index_path_for(path, number):
+    return os.path.join(path, f"segment-{number:06d}.idx")
+
+
+# [(number, segment path, index path)] in order, for segments with an index
+def segments(path):
+    found = []
+    if not os.path.isdir(path):
+        return found
+    for name in os.listdir(path):
+        match = _SEGMENT_NAME.match(name)
+        if match and os.path.exists(index_path_for(path, int(match.group(1)))):
+            number = int(match.group(1))
+            found.append((number, segment_path_for(path, number), index_path_for(path, number)))
+    return sorted(found)
+
+
+# Yields (id, updated_ts, offset, length, position) for each complete index
+# line. updated_ts is None when the issue didn't have one
+def read_index(index_path):
+    with open(index_path, encoding="utf-8") as index_file:
+        for line in index_file:
+            if not line.endswith("\n"):
+                # Cut short by a crash; its member may not be whole
+                return
+            issue_id, updated_ts, offset, length, position = line[:-1].split("\t")
+            yield issue_id, int(updated_ts) if updated_ts else None, int(offset), int(length), int(position)
+
+
+# Drops whatever a crash left after the last indexed member (a half written
+# member or index line) so appending can carry on. Returns the segment size
+def repair_segment(segment_path, index_path):
+    valid_bytes = 0
+    index_bytes = 0
+    with open(index_path, "rb") as index_file:
+        for line in index_file:
+            if not line.endswith(b"\n"):
+                break
+            index_bytes += len(line)
+            fields = line.split(b"\t")
+            valid_bytes = max(valid_bytes, int(fields[2]) + int(fields[3]))
+    if os.path.getsize(index_path) != index_bytes:
+        os.truncate(index_path, index_bytes)
+    if os.path.getsize(segment_path) != valid_bytes:
+        os.truncate(segment_path, valid_bytes)
+    return valid_bytes
+
+
+# {id: (updated_ts, segment number, offset, length, position)} for the
+# newest archived copy of every issue. Copies with the same updated time go
+# to the one archived last
+def latest_copies(path):
+    latest = {}
+    for number, segment_path, index_path in segments(path):
+        for issue_id, updated_ts, offset, length, position in read_index(index_path):
+            candidate = (-1 if updated_ts is None else updated_ts, number, offset, length, position)
+            current = latest.get(issue_id)
+            if current is None or candidate > current:
+                latest[issue_id] = candidate
+    return latest
+
+
+# Loads the newest archived copy of every issue into the DB, one segment per
+# job across `processes` worker processes. Without rebuild the tickets and
+# history are upserted over what is there, skipping issues the DB already
+# has a newer copy of and ones reconcile has marked deleted. With rebuild
+# they are emptied first and only the archive counts (tickets that were
+# marked deleted stay marked). Returns {"segments", "issues", "skipped"}
+def replay(db, path=DEFAULT_PATH, processes=1, rebuild=False):
+    db.recover_bulk_load()
+    with stats.timer("archive.read_indexes"):
+        latest = latest_copies(path)
+    result = {"segments": 0, "issues": 0, "skipped": 0}
+
+    tombstoned = []
+    for ticket_id, updated_ts, deleted_at in db.iter_ticket_versions():
+        if deleted_at is not None:
+            tombstoned.append(ticket_id)
+        copy = latest.get(ticket_id)
+        if copy is None or rebuild:
+            continue
+        if deleted_at is not None or (updated_ts is not None and copy[0] < updated_ts):
+            del latest[ticket_id]
+            result["skipped"] += 1
+    if rebuild:
+        db.clear_tickets()
+
+    # segment number -> {offset: (length, [position, ...])}
+    wanted = {}
+    for updated_ts, number, offset, length, position in latest.values():
+        members = wanted.setdefault(number, {})
+        members.setdefault(offset, (length, []))[1].append(position)
+    jobs = [(segment_path_for(path, number), wanted[number], db.field_map.entries)
+            for number in sorted(wanted)]
+
+    db.begin_bulk_load()
+    try:
+        for ticket_rows, history_rows in _run_jobs(jobs, processes):
+            with stats.timer("archive.write"):
+                db.write_tickets(ticket_rows, history_rows)
+            result["segments"] += 1
+            result["issues"] += len(ticket_rows)
+            print(f"Replayed {result['segments']}/{len(jobs)} segments ({result['issues']} issues)")
+    finally:
+        db.end_bulk_load()
+    if rebuild and tombstoned:
+        db.tombstone_tickets(tombstoned)
+    return result
+
+
+# Job results in job order, keeping only a few jobs in flight per process
+def _run_jobs(jobs, processes):
+    if processes <= 1:
+        for job in jobs:
+            yield _replay_segment(*job)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        remaining = iter(jobs)
+        for job in remaining:
+            pending.append(executor.submit(_replay_segment, *job))
+            if len(pending) >= processes * REPLAY_SEGMENTS_AHEAD:
+                break
+        while pending:
+            yield pending.popleft().result()
+            for job in remaining:
+                pending.append(executor.submit(_replay_segment, *job))
+                break
+
+
+# Runs in a worker process: decodes the wanted issues from one segment and
+# transforms them with the given field mapping entries
+def _replay_segment(segment_path, members, mapping_entries):
+    field_map = fieldmap.compile_mapping(mapping_entries, dbcontrol.to_epoch)
+    issues = []
+    with stats.timer("archive.decode"), open(segment_path, "rb") as segment_file:
+        for offset in sorted(members):
+            length, positions = members[offset]
+            segment_file.seek(offset)
+            lines = gzip.decompress(segment_file.read(length)).decode("utf-8").split("\n")
+            issues.extend(json.loads(lines[position]) for position in positions)
+    with stats.timer("archive.transform"):
+        return dbcontrol.transform_tickets(field_map, issues)
@@ -0,0 +1,126 @@
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks import generator
+
+# Jira Cloud caps search pages with expand=changelog at 100 issues
+DEFAULT_MAX_RESULTS = 100
+
+
+# Local stand-in for the parts of the Jira REST API the sync uses: GET
+# serverInfo and POST search (startAt/maxResults paging, JQL ignored). Issues
+# come from benchmarks.generator. latency (seconds) is added to every
+# response, and every throttle_every-th search gets a 429 with Retry-After.
+#
+#   with FakeJira(100000, latency=0.05) as server:
+#       settings = {"url": server.url, ...}
+class FakeJira(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, issue_count, latency=0.0, throttle_every=0, retry_after=1,
+                 max_results=DEFAULT_MAX_RESULTS, project="BENCH", port=0, **issue_options):
+        super().__init__(("127.0.0.1", port), FakeJiraHandler)
+        self.issue_count = issue_count
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.max_results = max_results
+        self.project = project
+        self.issue_options = issue_options
+        self.lock = threading.Lock()
+        self.search_requests = 0
+        self.throttled_requests = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/rest/api/3/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # The client dropping a kept-alive connection isn't worth a traceback
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    # True if this search should be answered with a 429
+    def next_search_throttled(self):
+        with self.lock:
+            self.search_requests += 1
+            throttled = self.throttle_every > 0 and self.search_requests % self.throttle_every == 0
+            if throttled:
+                self.throttled_requests += 1
+            return throttled
+
+    def search_page(self, start_at, max_results):
+        max_results = max(min(max_results, self.max_results), 0)
+        end = min(start_at + max_results, self.issue_count)
+        return {
+            "startAt": start_at,
+            "maxResults": max_results,
+            "total": self.issue_count,
+            "issues": [generator.make_issue(index, project=self.project, **self.issue_options)
+                       for index in range(start_at, end)]
+        }
+
+
+class FakeJiraHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # requests sends a body with GETs too; it has to be read off the
+        # kept-alive connection before the next request
+        self.read_body()
+        time.sleep(self.server.latency)
+        if self.path.endswith("/serverInfo"):
+            self.send_json(200, {"serverTime": datetime.now(timezone.utc).isoformat(timespec="milliseconds")})
+        else:
+            self.send_json(404, {"errorMessages": [f"No fake for GET {self.path}"]})
+
+    def do_POST(self):
+        body = self.read_body()
+        time.sleep(self.server.latency)
+        if not self.path.endswith("/search"):
+            self.send_json(404, {"errorMessages": [f"No fake for POST {self.path}"]})
+        elif self.server.next_search_throttled():
+            self.send_json(429, {"errorMessages": ["Rate limit exceeded"]},
+                           {"Retry-After": str(self.server.retry_after)})
+        else:
+            self.send_json(200, self.server.search_page(int(body.get("startAt", 0)),
+                                                        int(body.get("maxResults", 50))))
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null") or {}
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
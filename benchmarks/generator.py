@@ -0,0 +1,114 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+# Synthetic issues in the shape the search API returns with expand=changelog,
+# i.e. exactly what DBControl.store_tickets / transform_tickets consume. Every
+# issue is built from its index alone, so the fake server can serve any page
+# of a million-issue project without holding it in memory, and two runs with
+# the same seed see the same data.
+
+WORKFLOW = ('Backlog', 'Selected for Development', 'In Progress', 'In Review', 'Done')
+ISSUE_TYPES = ('Story', 'Story', 'Bug', 'Task', 'Maintenance')
+TEAMS = ('Engineers-GreenTeam',
+         'Engineers-RedTeam',
+         'Engineers-BlueTeam',
+         'Engineers-YellowTeam',
+         'Engineers-OrangeTeam',
+         'Engineers-PurpleTeam')
+SEVERITIES = ('Sev 1', 'Sev 2', 'Sev 3', 'Sev 4')
+PEOPLE = 40
+
+# Issues are created at random across these two years, which covers the
+# windows the reports default to
+CREATED_FROM = datetime(2023, 1, 1, tzinfo=timezone.utc)
+CREATED_SPAN_SECONDS = 730 * 24 * 60 * 60
+
+DEFAULT_CHANGELOG_DEPTH = 6
+
+# History ids are index * this + entry number, so they never collide
+MAX_CHANGELOG_DEPTH = 1000
+
+
+def jira_time(instant):
+    return instant.strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+
+
+def person(rng):
+    number = rng.randrange(PEOPLE)
+    return {"displayName": f"Person {number}", "emailAddress": f"person{number}@example.com"}
+
+
+# One issue. changelog_depth is the most history entries it can have (the
+# actual number varies per issue); extra_custom_fields adds that many filler
+# customfield_2xxxx strings to bulk the payload up like a real instance
+def make_issue(index, project="BENCH", changelog_depth=DEFAULT_CHANGELOG_DEPTH,
+               extra_custom_fields=0, seed=0):
+    changelog_depth = min(changelog_depth, MAX_CHANGELOG_DEPTH)
+    rng = random.Random(seed * 1_000_003 + index)
+    created = CREATED_FROM + timedelta(seconds=rng.randrange(CREATED_SPAN_SECONDS))
+    issue_type = rng.choice(ISSUE_TYPES)
+
+    histories = []
+    status_index = 0
+    resolved = None
+    instant = created
+    for entry in range(rng.randint(0, changelog_depth)):
+        instant += timedelta(minutes=rng.randint(30, 7 * 24 * 60))
+        if status_index < len(WORKFLOW) - 1 and rng.random() < 0.7:
+            # Occasionally bounce back from review
+            if WORKFLOW[status_index] == 'In Review' and rng.random() < 0.25:
+                next_index = status_index - 1
+            else:
+                next_index = status_index + 1
+            item = {"field": "status",
+                    "fromString": WORKFLOW[status_index],
+                    "toString": WORKFLOW[next_index]}
+            status_index = next_index
+            if WORKFLOW[status_index] == 'Done':
+                resolved = instant
+        else:
+            item = {"field": "Story Points",
+                    "fromString": str(rng.choice((1, 2, 3, 5, 8))),
+                    "toString": str(rng.choice((1, 2, 3, 5, 8)))}
+        histories.append({
+            "id": str(index * MAX_CHANGELOG_DEPTH + entry),
+            "author": person(rng),
+            "created": jira_time(instant),
+            "items": [item]
+        })
+
+    fields = {
+        "issuetype": {"name": issue_type},
+        "summary": f"{issue_type} {index}: synthetic issue for benchmarking",
+        "created": jira_time(created),
+        "resolutiondate": jira_time(resolved) if resolved is not None else None,
+        "updated": jira_time(instant),
+        "creator": person(rng),
+        "assignee": person(rng) if rng.random() < 0.9 else None,
+        "status": {"name": WORKFLOW[status_index]},
+        "resolution": ({"name": 'Done' if rng.random() < 0.9 else 'Cannot Reproduce'}
+                       if resolved is not None else None),
+        "customfield_10026": rng.choice((1, 2, 3, 5, 8, None)),
+        "fixVersions": [{"name": f"{created.year}.{created.month}"}] if rng.random() < 0.5 else [],
+        "customfield_10050": {"value": rng.choice(SEVERITIES)} if issue_type == 'Bug' else None,
+        "customfield_10037": {"name": rng.choice(TEAMS)}
+    }
+    for field_number in range(extra_custom_fields):
+        fields[f"customfield_{20000 + field_number}"] = f"value {rng.randrange(1000000)}"
+
+    return {
+        "id": str(index + 1),
+        "key": f"{project}-{index + 1}",
+        "fields": fields,
+        "changelog": {
+            "startAt": 0,
+            "maxResults": len(histories),
+            "total": len(histories),
+            "histories": histories
+        }
+    }
+
+
+def generate_issues(count, start=0, **options):
+    for index in range(start, start + count):
+        yield make_issue(index, **options)
@@ -0,0 +1,205 @@
+# Benchmarks for the sync and the reports against synthetic data.
+#
+#   python -m benchmarks.run                       # every scenario at 10k, 100k and 1M
+#   python -m benchmarks.run --sizes 10000 --scenarios store,cycle-time
+#   python -m benchmarks.run --latency 0.05 --throttle-every 20 --label "after limiter change"
+#
+# Run from the repository root. Each scenario appends one JSON line to the
+# results file (benchmarks/results.jsonl by default) with the commit, the
+# timings and the stats collector's timers, so runs can be compared over time.
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import dbcontrol
+import jiraapi
+import metrics
+import stats
+from benchmarks import fakejira, generator
+
+SCENARIOS = ("sync", "store", "cycle-time", "monthly-report")
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_RESULTS_FILE = os.path.join("benchmarks", "results.jsonl")
+
+# Issues handed to store_tickets per call, the same as one sync page
+STORE_BATCH_SIZE = 1000
+
+# Report windows, the same ones jiraclone.py uses
+CYCLE_TIME_START = "2024-03-15T00:00:00.000-0000"
+CYCLE_TIME_END = "2024-06-15T00:00:00.000-0000"
+REPORT_MONTH = "202405"
+
+
+def bench_store(db, size, issue_options):
+    seconds = 0.0
+    history_rows = 0
+    for start in range(0, size, STORE_BATCH_SIZE):
+        issues = list(generator.generate_issues(min(STORE_BATCH_SIZE, size - start), start=start, **issue_options))
+        history_rows += sum(len(issue["changelog"]["histories"]) for issue in issues)
+        started = time.perf_counter()
+        db.store_tickets(issues)
+        seconds += time.perf_counter() - started
+    return {
+        "seconds": seconds,
+        "tickets_per_second": size / seconds,
+        "rows_per_second": (size + history_rows) / seconds,
+        "history_rows": history_rows
+    }
+
+
+def bench_sync(workdir, size, args, issue_options):
+    db = dbcontrol.DBControl(f"sync_{size}.db", workdir)
+    with fakejira.FakeJira(size, latency=args.latency, throttle_every=args.throttle_every,
+                           max_results=args.page_size, **issue_options) as server:
+        settings = {
+            "url": server.url,
+            "UserName": "benchmark",
+            "ApiKey": "benchmark",
+            "MaxConcurrentRequests": args.concurrency,
+            "RequestsPerSecond": args.rate,
+            "MaxRequestsPerSecond": args.rate
+        }
+        jira = jiraapi.JiraApi(server.project, settings=settings, db=db)
+        started = time.perf_counter()
+        jira.sync_db()
+        seconds = time.perf_counter() - started
+        stored = db.dbConn.execute("SELECT COUNT(*) FROM tickets;").fetchone()[0]
+        result = {
+            "seconds": seconds,
+            "tickets_per_second": stored / seconds,
+            "stored": stored,
+            "search_requests": server.search_requests,
+            "throttled_requests": server.throttled_requests
+        }
+    jira.session.close()
+    db.dbConn.close()
+    return result
+
+
+# Best and median of a few runs, since a single report query is short
+def repeat(function, repeats):
+    timings = []
+    for run in range(repeats):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return {"seconds": min(timings), "median_seconds": statistics.median(timings), "repeats": repeats}
+
+
+# What jiraclone.get_development_cycle_time does, minus the printing
+def cycle_time_report(db):
+    ticket_histories = db.get_dev_ticket_status_updates(CYCLE_TIME_START, CYCLE_TIME_END)
+    cycle_info = metrics.cycle_times(ticket_histories, datetime.now(timezone.utc).timestamp())
+    metrics.summarize(cycle_info['resolved_cycle_times'])
+    metrics.summarize(cycle_info['unresolved_ages'])
+    for seconds in cycle_info['time_in_status'].values():
+        metrics.summarize(seconds)
+
+
+# The two queries behind jiraclone.get_monthly_ri_metrics
+def monthly_report(db):
+    db.get_r_and_i_tickets_completed(REPORT_MONTH)
+    db.get_r_and_i_tickets_open(REPORT_MONTH)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record(results_file, run_info, scenario, size, result):
+    snapshot = stats.collector.snapshot()
+    line = {**run_info, "scenario": scenario, "tickets": size, **result,
+            "stats": {"timers": snapshot["timers"], "counters": snapshot["counters"]}}
+    with open(results_file, "a", encoding="utf-8") as output:
+        output.write(json.dumps(line, default=str) + "\n")
+    print(f"{scenario:>15} {size:>9}: {result['seconds']:.3f}s "
+          + " ".join(f"{name}={value:.1f}" for name, value in result.items()
+                     if name.endswith("per_second")))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark sync and reports on synthetic Jira data")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated ticket counts")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_FILE, help="results file (JSON lines, appended)")
+    parser.add_argument("--label", default=None, help="free text stored with every result")
+    parser.add_argument("--changelog-depth", type=int, default=generator.DEFAULT_CHANGELOG_DEPTH)
+    parser.add_argument("--custom-fields", type=int, default=0, help="extra filler custom fields per issue")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each fake Jira response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth search with a 429")
+    parser.add_argument("--page-size", type=int, default=fakejira.DEFAULT_MAX_RESULTS,
+                        help="largest page the fake Jira will return")
+    parser.add_argument("--concurrency", type=int, default=jiraapi.DEFAULT_MAX_CONCURRENT_REQUESTS)
+    parser.add_argument("--rate", type=float, default=1000.0, help="client requests per second")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each report, best is kept")
+    parser.add_argument("--workdir", default=None, help="where to put the benchmark DBs (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="don't delete the benchmark DBs")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario '{scenario}'. Choose from: {', '.join(SCENARIOS)}")
+    issue_options = {"changelog_depth": args.changelog_depth,
+                     "extra_custom_fields": args.custom_fields,
+                     "seed": args.seed}
+    run_info = {
+        "run_started": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "label": args.label,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "options": {**issue_options, "latency": args.latency, "throttle_every": args.throttle_every,
+                    "page_size": args.page_size, "concurrency": args.concurrency, "rate": args.rate}
+    }
+    workdir = args.workdir or tempfile.mkdtemp(prefix="jiraclone-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    try:
+        for size in sizes:
+            if "sync" in scenarios:
+                stats.collector.reset()
+                record(args.output, run_info, "sync", size, bench_sync(workdir, size, args, issue_options))
+
+            if not {"store", "cycle-time", "monthly-report"} & set(scenarios):
+                continue
+            # The reports run against the DB the store scenario builds
+            db = dbcontrol.DBControl(f"store_{size}.db", workdir)
+            stats.collector.reset()
+            store_result = bench_store(db, size, issue_options)
+            if "store" in scenarios:
+                record(args.output, run_info, "store", size, store_result)
+            if "cycle-time" in scenarios:
+                stats.collector.reset()
+                record(args.output, run_info, "cycle-time", size, repeat(lambda: cycle_time_report(db), args.repeats))
+            if "monthly-report" in scenarios:
+                stats.collector.reset()
+                record(args.output, run_info, "monthly-report", size, repeat(lambda: monthly_report(db), args.repeats))
+            db.dbConn.close()
+    finally:
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
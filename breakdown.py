@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
+import dbcontrol
+import metrics
+
+# Cycle time and completion numbers for the dev report tickets, split by any
+# combination of dbcontrol.GROUPABLE_COLUMNS, from one pass over the rows.
+# Every slice is accumulated as a metrics partial at the same time, so
+# breaking a report down by 20 teams costs about what running it once does.
+#
+# With processes > 1 the tickets are dealt out by id across that many worker
+# processes, each with its own connection, and their partials are merged.
+# Worth it on big DBs, where the Python pass is most of the time.
+
+
+# [{"key": [dimension values], "total": bool, **metrics.summarize_cycle_partial}]
+# sorted by key, with a row for everything first
+def grouped_cycle_times(db, start_date, end_date, dimensions, now_ts,
+                        team_names=dbcontrol.DEV_TEAM_NAMES, processes=1):
+    dimensions = tuple(dimensions)
+    if processes > 1:
+        jobs = [(db.dbName, db.dbPath, start_date, end_date, team_names, dimensions, now_ts,
+                 (partition, processes)) for partition in range(processes)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            partials = metrics.merge_grouped_partials(executor.map(_partition_partials, *zip(*jobs)))
+    else:
+        rows = db.get_dev_ticket_status_updates(start_date, end_date, team_names, dimensions)
+        partials = metrics.grouped_cycle_times(rows, now_ts, dimensions)
+
+    total = metrics.new_cycle_partial()
+    for partial in partials.values():
+        metrics.merge_cycle_partials(total, partial)
+    result = [{"key": [None] * len(dimensions), "total": True, **metrics.summarize_cycle_partial(total)}]
+    for key in sorted(partials, key=lambda key: tuple("" if value is None else str(value) for value in key)):
+        result.append({"key": list(key), "total": False, **metrics.summarize_cycle_partial(partials[key])})
+    return result
+
+
+# Runs in a worker process: one share of the tickets, as {key: partial}
+def _partition_partials(db_name, db_path, start_date, end_date, team_names, dimensions, now_ts, partition):
+    db = dbcontrol.DBControl(db_name, db_path)
+    try:
+        rows = db.get_dev_ticket_status_updates(start_date, end_date, team_names, dimensions, partition)
+        partials = metrics.grouped_cycle_times(rows, now_ts, dimensions)
+    finally:
+        db.dbConn.close()
+    # The ticket keys aren't needed for the summaries and would only be
+    # pickled back to the parent
+    for partial in partials.values():
+        partial['resolved_keys'] = []
+        partial['unresolved_keys'] = []
+    return partials
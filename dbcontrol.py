@@ -1,19 +1,328 @@
+import fieldmap
+import json
+import metrics
 import sqlite3
+import stats
 import os
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 
+# Incremental syncs re-request everything updated in this many minutes before
+# the watermark, to cover issues Jira's search index picks up late
+DEFAULT_WATERMARK_OVERLAP_MINUTES = 5
+
+
+# Columns of the history rows transform_tickets produces, in order
+HISTORY_COLUMNS = ("id", "ticket_id", "author", "field", "from_val", "to_val", "updated", "updated_ts")
+
+# The teams and issue types the dev reports cover
+DEV_TEAM_NAMES = ('Engineers-GreenTeam',
+                  'Engineers-RedTeam',
+                  'Engineers-BlueTeam',
+                  'Engineers-YellowTeam',
+                  'Engineers-OrangeTeam')
+DEV_ISSUE_TYPES = ('Bug', 'Story', 'Task', 'Maintenance')
+
+# The team the R&I reports cover
+RI_TEAM_NAME = 'Engineers-PurpleTeam'
+
+# Ticket columns reports can be broken down by
+GROUPABLE_COLUMNS = ('group_name', 'assignee', 'type', 'severity', 'fix_version')
+
+# Tables that can be dumped whole with stream_table
+EXPORTABLE_TABLES = ("tickets", "history", "status_intervals")
+
+
+def watermark_key(project_name):
+    return f"watermark:{project_name}"
+
+
+# Where a project's first full download records how far it got
+def checkpoint_key(project_name):
+    return f"sync_checkpoint:{project_name}"
+
+
+# Jira timestamps come back in whatever offset the API user has configured
+# (e.g. -0600 or +0000), so the strings don't sort or compare correctly.
+# Every timestamp is also stored as integer seconds since the epoch (UTC).
+# fromisoformat reads Jira's format ("2024-01-02T10:00:00.000-0600") and is
+# far quicker than strptime, which matters with several of these per issue
+def to_epoch(timestamp):
+    if timestamp is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+# Maps raw issues from the search API to ticket rows (tuples in
+# field_map.columns order) and history rows (HISTORY_COLUMNS order). Needs
+# nothing but the field map, so it also runs in other processes (see
+# archive.replay)
+def transform_tickets(field_map, tickets):
+    sync_date = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+    extract = field_map.extract
+    ticket_rows = [extract(ticket, sync_date) for ticket in tickets]
+    history_rows = []
+    for ticket in tickets:
+        ticket_id = ticket["id"]
+        changelog = ticket.get("changelog")
+        if not changelog:
+            continue
+        for history_entry in changelog["histories"]:
+            author = history_entry.get("author")
+            if author.__class__ is dict:
+                author = author["emailAddress"] if "emailAddress" in author else author.get("displayName")
+            else:
+                author = None
+            history_id = history_entry["id"]
+            updated = history_entry["created"]
+            updated_ts = to_epoch(updated)
+            for changed_value in history_entry["items"]:
+                history_rows.append((
+                    history_id,
+                    ticket_id,
+                    author,
+                    changed_value["field"],
+                    changed_value["fromString"],
+                    changed_value["toString"],
+                    updated,
+                    updated_ts))
+    return ticket_rows, history_rows
+
+
+# First instant of a YYYYMM month and of the month after it, in UTC
+def month_bounds(yearmonth):
+    year = int(yearmonth[0:4])
+    month = int(yearmonth[4:6])
+    month_start = datetime(year, month, 1, tzinfo=timezone.utc)
+    if month == 12:
+        month_end = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        month_end = datetime(year, month + 1, 1, tzinfo=timezone.utc)
+    return month_start, month_end
+
+
+# v1: column types, epoch timestamp columns and the indexes the reports need.
+# SQLite can't change column types in place so the tables are rebuilt.
+def migrate_typed_columns(cursor):
+    cursor.execute("CREATE TABLE tickets_v1("
+                "id TEXT PRIMARY KEY, "
+                "jira_key TEXT, "
+                "type TEXT, "
+                "summary TEXT, "
+                "created TEXT, "
+                "resolved TEXT, "
+                "updated TEXT, "
+                "creator TEXT, "
+                "assignee TEXT, "
+                "status TEXT, "
+                "resolution TEXT, "
+                "story_points REAL, "
+                "fix_version TEXT, "
+                "severity TEXT, "
+                "group_name TEXT, "
+                "sync_date TEXT, "
+                "created_ts INTEGER, "
+                "resolved_ts INTEGER, "
+                "updated_ts INTEGER);")
+    cursor.execute("INSERT INTO tickets_v1 SELECT "
+                "id, jira_key, type, summary, created, resolved, updated, creator, "
+                "assignee, status, resolution, story_points, fix_version, severity, "
+                "group_name, sync_date, "
+                "to_epoch(created), to_epoch(resolved), to_epoch(updated) "
+                "FROM tickets;")
+    cursor.execute("DROP TABLE tickets;")
+    cursor.execute("ALTER TABLE tickets_v1 RENAME TO tickets;")
+
+    cursor.execute("CREATE TABLE history_v1("
+                "id TEXT PRIMARY KEY, "
+                "ticket_id TEXT, "
+                "author TEXT, "
+                "field TEXT, "
+                "from_val TEXT, "
+                "to_val TEXT, "
+                "updated TEXT, "
+                "updated_ts INTEGER);")
+    cursor.execute("INSERT INTO history_v1 SELECT "
+                "id, ticket_id, author, field, from_val, to_val, updated, to_epoch(updated) "
+                "FROM history;")
+    cursor.execute("DROP TABLE history;")
+    cursor.execute("ALTER TABLE history_v1 RENAME TO history;")
+
+    cursor.execute("CREATE TABLE metadata_v1 (key TEXT PRIMARY KEY, val);")
+    cursor.execute("INSERT INTO metadata_v1 SELECT key, max(val) FROM metadata GROUP BY key;")
+    cursor.execute("DROP TABLE metadata;")
+    cursor.execute("ALTER TABLE metadata_v1 RENAME TO metadata;")
+
+    cursor.execute("CREATE INDEX history_ticket_field_updated "
+                "ON history(ticket_id, field, updated_ts);")
+    cursor.execute("CREATE INDEX tickets_group_type_status_resolved "
+                "ON tickets(group_name, type, status, resolved_ts);")
+
+
+# Rebuilds the derived status_intervals rows: one row per stretch of time a
+# ticket sat in a status, from creation to its first status change and then
+# from each change to the next. exited_at is NULL for the current status.
+# With only_touched, just the tickets listed in the touched_tickets temp
+# table are rebuilt, which is what keeps this cheap on every sync batch.
+def rebuild_status_intervals(cursor, only_touched=False):
+    ticket_filter = "IN (SELECT id FROM touched_tickets)" if only_touched else "IS NOT NULL"
+    cursor.execute(f"DELETE FROM status_intervals WHERE ticket_id {ticket_filter};")
+    cursor.execute("INSERT INTO status_intervals (ticket_id, status, entered_at, exited_at) "
+                "WITH transitions AS ("
+                    "SELECT h.ticket_id, h.from_val, h.to_val, h.updated_ts, "
+                    "ROW_NUMBER() OVER ticket_changes AS seq, "
+                    "LEAD(h.updated_ts) OVER ticket_changes AS next_ts "
+                    "FROM history h "
+                    f"WHERE h.field = 'status' AND h.ticket_id {ticket_filter} "
+                    "WINDOW ticket_changes AS (PARTITION BY h.ticket_id ORDER BY h.updated_ts, h.id)"
+                ") "
+                "SELECT t.id, COALESCE(f.from_val, t.status), t.created_ts, f.updated_ts "
+                "FROM tickets t "
+                "LEFT JOIN transitions f ON f.ticket_id = t.id AND f.seq = 1 "
+                f"WHERE t.id {ticket_filter} "
+                "UNION ALL "
+                "SELECT ticket_id, to_val, updated_ts, next_ts FROM transitions;")
+
+
+# v2: status_intervals, so time-in-status, lead time and WIP are SQL aggregates
+def migrate_status_intervals(cursor):
+    cursor.execute("CREATE TABLE status_intervals("
+                "ticket_id TEXT, "
+                "status TEXT, "
+                "entered_at INTEGER, "
+                "exited_at INTEGER);")
+    cursor.execute("CREATE INDEX status_intervals_ticket ON status_intervals(ticket_id);")
+    cursor.execute("CREATE INDEX status_intervals_status_entered "
+                "ON status_intervals(status, entered_at, exited_at);")
+    rebuild_status_intervals(cursor)
+
+
+# v3: deleted_at, set (epoch seconds) on tickets reconciliation found deleted
+# in Jira or moved out of the synced projects. The reports leave them out
+def migrate_deleted_at(cursor):
+    cursor.execute(f"ALTER TABLE tickets ADD COLUMN {fieldmap.DELETED_AT_COLUMN} INTEGER;")
+
+
+# v4: report_cache, finished report results (JSON) keyed on the report, its
+# parameters and the data generation they were computed from
+def migrate_report_cache(cursor):
+    cursor.execute("CREATE TABLE report_cache("
+                "report TEXT, "
+                "params TEXT, "
+                "generation INTEGER, "
+                "computed_at INTEGER, "
+                "result TEXT, "
+                "PRIMARY KEY (report, params));")
+
+
+# Keeps the ticket_search full text index in step with tickets and history:
+# one document per ticket (rowid = the Jira id) holding the summary and every
+# from/to value in its changelog. Rebuilt for the touched_tickets temp table
+# on each write, or from scratch after a bulk load
+def rebuild_ticket_search(cursor, only_touched=False):
+    if only_touched:
+        cursor.execute("DELETE FROM ticket_search "
+                    "WHERE rowid IN (SELECT CAST(id AS INTEGER) FROM touched_tickets);")
+        ticket_filter = "WHERE t.id IN (SELECT id FROM touched_tickets)"
+    else:
+        cursor.execute("DELETE FROM ticket_search;")
+        ticket_filter = ""
+    cursor.execute("INSERT INTO ticket_search (rowid, summary, changes) "
+                "SELECT CAST(t.id AS INTEGER), t.summary, "
+                "(SELECT group_concat(COALESCE(h.from_val, '') || ' ' || COALESCE(h.to_val, ''), ' ') "
+                "FROM history h WHERE h.ticket_id = t.id) "
+                f"FROM tickets t {ticket_filter};")
+    if not only_touched:
+        cursor.execute("INSERT INTO ticket_search (ticket_search) VALUES ('optimize');")
+
+
+# v5: ticket_search, an FTS5 index over summaries and changelog values
+def migrate_ticket_search(cursor):
+    cursor.execute("CREATE VIRTUAL TABLE ticket_search USING fts5("
+                "summary, "
+                "changes, "
+                "tokenize = 'unicode61 remove_diacritics 2');")
+    rebuild_ticket_search(cursor)
+
+
+# Everything the reports need that the upserts don't. Dropped for a bulk
+# load and built once at the end, which is far cheaper than keeping them up
+# to date row by row
+SECONDARY_INDEXES = {
+    "history_ticket_field_updated": "history(ticket_id, field, updated_ts)",
+    "tickets_group_type_status_resolved": "tickets(group_name, type, status, resolved_ts)",
+    "status_intervals_ticket": "status_intervals(ticket_id)",
+    "status_intervals_status_entered": "status_intervals(status, entered_at, exited_at)",
+}
+
+# Normal settings. WAL lets the reports read while a sync is writing
+DEFAULT_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = FULL;",
+    "PRAGMA cache_size = -2000;",
+    "PRAGMA mmap_size = 0;",
+    "PRAGMA temp_store = DEFAULT;",
+)
+
+# Bulk load settings: fsync only at WAL checkpoints (a power cut can lose
+# the last few commits, which the sync checkpoint picks up again, but never
+# corrupts the DB; OFF could), 256MB of page cache and 1GB of mmap
+BULK_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -262144;",
+    "PRAGMA mmap_size = 1073741824;",
+    "PRAGMA temp_store = MEMORY;",
+)
+
+# Sync pages committed together while bulk loading
+BULK_LOAD_PAGES_PER_COMMIT = 10
+
+BULK_LOAD_KEY = "bulk_load_in_progress"
+
+# A bulk load holds an exclusive sqlite lock on this file (next to the DB)
+# for as long as it runs. The OS drops the lock if the process dies, so a
+# marker without a lock holder is a load that was interrupted
+BULK_LOAD_LOCK_SUFFIX = "-bulkload"
+
+# Bumped in the same transaction as any write that changes tickets or
+# history. Cached report results are only good for the generation they
+# were computed from
+DATA_GENERATION_KEY = "data_generation"
+
+
+# Schema migrations, applied in order. The schema version is the number of
+# migrations applied and lives in PRAGMA user_version. Only ever append.
+MIGRATIONS = [
+    migrate_typed_columns,
+    migrate_status_intervals,
+    migrate_deleted_at,
+    migrate_report_cache,
+    migrate_ticket_search,
+]
+
 
 class DBControl:
 
-    def __init__(self, dbname, dbpath):
+    # field_mapping is the optional "FieldMapping" list from
+    # jira_connection.json, see fieldmap.py
+    def __init__(self, dbname, dbpath, field_mapping=None):
         self.dbName = dbname
         self.dbPath = dbpath
+        self.field_map = fieldmap.compile_mapping(field_mapping, to_epoch)
         self.dbConn = sqlite3.connect(
             os.path.join(self.dbPath, self.dbName), 
             autocommit=False
         )
         self.dbConn.row_factory = sqlite3.Row   
+        self.dbConn.create_function("to_epoch", 1, to_epoch, deterministic=True)
         with self.dbConn:
             cursor = self.dbConn.cursor()
             cursor.execute("CREATE TABLE IF NOT EXISTS tickets("
@@ -47,7 +356,146 @@ class DBControl:
             last_updated = cursor.fetchone()
             if last_updated[0] == 0:
                 cursor.execute("INSERT INTO metadata (key, val) VALUES ('last_updated', NULL);")
+            cursor.execute("SELECT count(*) FROM metadata WHERE key = 'watermark_overlap_minutes';")
+            if cursor.fetchone()[0] == 0:
+                cursor.execute("INSERT INTO metadata (key, val) VALUES ('watermark_overlap_minutes', ?);",
+                               (DEFAULT_WATERMARK_OVERLAP_MINUTES,))
+            self.dbConn.commit()
+        self.migrate()
+        self._add_mapped_columns()
+        self.ticket_sql = self._ticket_upsert_sql()
+        self.ticket_id_index = self.field_map.index("id")
+        self.bulk_loading = False
+        self.bulk_pages_pending = 0
+        self.bulk_load_lock = None
+        self._run_pragmas(DEFAULT_PRAGMAS)
+
+    # Columns added to the field mapping since the table was created
+    def _add_mapped_columns(self):
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            existing = {row["name"] for row in cursor.execute("PRAGMA table_info(tickets);")}
+            for column in self.field_map.columns:
+                if column not in existing:
+                    print(f"Adding column '{column}' to tickets")
+                    cursor.execute(f"ALTER TABLE tickets ADD COLUMN {column} "
+                                   f"{self.field_map.column_types[column]};")
+            self.dbConn.commit()
+
+    # Positional upsert over the mapped columns. sync_date keeps the date the
+    # ticket was first stored. A tombstoned ticket that comes back from Jira
+    # updated since it was deleted (e.g. moved back into the project) is live
+    # again. Older copies than the stored one are ignored, as webhooks are
+    # retried and arrive out of order. Rows that haven't changed aren't
+    # rewritten, so the connection's change count says whether a write
+    # actually brought in anything new
+    def _ticket_upsert_sql(self):
+        columns = [column for column in self.field_map.columns
+                   if column not in ("id", fieldmap.SYNC_DATE_COLUMN)]
+        updates = ", ".join([f"{column}=excluded.{column}" for column in columns]
+                            + [f"{fieldmap.DELETED_AT_COLUMN}=NULL"])
+        return (f"INSERT INTO tickets ({', '.join(self.field_map.columns)}) "
+                f"VALUES ({', '.join('?' for column in self.field_map.columns)}) "
+                f"ON CONFLICT(id) DO UPDATE SET {updates} "
+                "WHERE (tickets.updated_ts IS NULL OR excluded.updated_ts IS NULL "
+                "OR excluded.updated_ts >= tickets.updated_ts) "
+                f"AND CASE WHEN tickets.{fieldmap.DELETED_AT_COLUMN} IS NULL "
+                f"THEN ({', '.join(f'tickets.{column}' for column in columns)}) "
+                f"IS NOT ({', '.join(f'excluded.{column}' for column in columns)}) "
+                f"ELSE COALESCE(excluded.updated_ts > tickets.{fieldmap.DELETED_AT_COLUMN}, 0) END")
+
+    # Journal mode and synchronous can't change inside a transaction, and
+    # with autocommit=False there always is one open
+    def _run_pragmas(self, pragmas):
+        self.dbConn.commit()
+        self.dbConn.autocommit = True
+        try:
+            for pragma in pragmas:
+                self.dbConn.execute(pragma)
+        finally:
+            self.dbConn.autocommit = False
+
+    # Fast mode for the first full download: relaxed durability, a big page
+    # cache, secondary indexes dropped and status_intervals and the search
+    # index left alone, with
+    # several sync pages per transaction. end_bulk_load() puts it all back
+    def begin_bulk_load(self):
+        self.bulk_load_lock = self._take_bulk_load_lock()
+        if self.bulk_load_lock is None:
+            raise RuntimeError("Another process is already bulk loading this DB")
+        self.set_metadata(BULK_LOAD_KEY, datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z"))
+        self._run_pragmas(BULK_LOAD_PRAGMAS)
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            for index_name in SECONDARY_INDEXES:
+                cursor.execute(f"DROP INDEX IF EXISTS {index_name};")
             self.dbConn.commit()
+        self.bulk_loading = True
+        self.bulk_pages_pending = 0
+
+    def end_bulk_load(self):
+        self.dbConn.commit()
+        self.bulk_loading = False
+        self.bulk_pages_pending = 0
+        print("Building indexes, status intervals and the search index...")
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            with stats.timer("db.bulk_load_indexes"):
+                for index_name, columns in SECONDARY_INDEXES.items():
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {columns};")
+            with stats.timer("db.bulk_load_status_intervals"):
+                rebuild_status_intervals(cursor)
+            with stats.timer("db.bulk_load_ticket_search"):
+                rebuild_ticket_search(cursor)
+            cursor.execute("ANALYZE;")
+            cursor.execute("DELETE FROM metadata WHERE key = ?;", (BULK_LOAD_KEY,))
+            self.dbConn.commit()
+        self._run_pragmas(DEFAULT_PRAGMAS + ("PRAGMA wal_checkpoint(TRUNCATE);",))
+        if self.bulk_load_lock is not None:
+            self.bulk_load_lock.close()
+            self.bulk_load_lock = None
+
+    # Finishes a bulk load whose process died part way (indexes, status
+    # intervals and the search index are only built at the end). Only for
+    # code about to write anyway: the sync, reconcile, the webhook receiver
+    # and archive replay. Does nothing while the loading process is still
+    # alive. Returns whether a load was finished
+    def recover_bulk_load(self):
+        if self.bulk_loading or self.get_metadata(BULK_LOAD_KEY) is None:
+            return False
+        self.bulk_load_lock = self._take_bulk_load_lock()
+        if self.bulk_load_lock is None:
+            return False
+        if self.get_metadata(BULK_LOAD_KEY) is None:
+            # Finished while we were getting the lock
+            self.bulk_load_lock.close()
+            self.bulk_load_lock = None
+            return False
+        print("Finishing interrupted bulk load...")
+        self.end_bulk_load()
+        return True
+
+    # A connection holding the bulk load lock, or None if another process
+    # has it
+    def _take_bulk_load_lock(self):
+        lock = sqlite3.connect(os.path.join(self.dbPath, self.dbName) + BULK_LOAD_LOCK_SUFFIX,
+                               timeout=0, autocommit=True)
+        try:
+            lock.execute("BEGIN EXCLUSIVE;")
+        except sqlite3.OperationalError:
+            lock.close()
+            return None
+        return lock
+
+    def migrate(self):
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+            for migration_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                print(f"Upgrading local DB schema to version {migration_version}...")
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {migration_version};")
+                self.dbConn.commit()
 
     def set_last_updated_UTC(self):
         update_date_sql = ("UPDATE metadata SET val = "
@@ -58,6 +506,29 @@ class DBControl:
             cursor.execute(update_date_sql)
             self.dbConn.commit()
         
+    def get_metadata(self, key):
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            cursor.execute("SELECT val FROM metadata WHERE key = ?;", (key,))
+            row = cursor.fetchone()
+            return row[0] if row is not None else None
+
+    def set_metadata(self, key, val):
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            self._set_metadata(cursor, key, val)
+            self.dbConn.commit()
+
+    def delete_metadata(self, key):
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            cursor.execute("DELETE FROM metadata WHERE key = ?;", (key,))
+            self.dbConn.commit()
+
+    def _set_metadata(self, cursor, key, val):
+        cursor.execute("INSERT INTO metadata (key, val) VALUES (?, ?) "
+                       "ON CONFLICT(key) DO UPDATE SET val = excluded.val;", (key, val))
+
     def get_last_updated_UTC(self):
         with self.dbConn:
             cursor = self.dbConn.cursor()
@@ -68,231 +539,500 @@ class DBControl:
             else:
                 return None
 
+    # The latest `updated` (UTC) seen for a project by the incremental sync, or
+    # None if the project has never finished a full download
+    def get_sync_watermark(self, project_name):
+        watermark = self.get_metadata(watermark_key(project_name))
+        if watermark is None:
+            return None
+        return datetime.strptime(watermark, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+    def set_sync_watermark(self, project_name, watermark):
+        self.set_metadata(watermark_key(project_name),
+                          watermark.strftime("%Y-%m-%dT%H:%M:%S.%f%z"))
+
+    # Whether any project has a watermark, i.e. the DB has been synced since
+    # watermarks were introduced
+    def has_sync_watermarks(self):
+        cursor = self.dbConn.cursor()
+        cursor.execute("SELECT 1 FROM metadata WHERE key GLOB ? LIMIT 1;", (watermark_key("*"),))
+        return cursor.fetchone() is not None
+
+    def has_project_tickets(self, project_name):
+        cursor = self.dbConn.cursor()
+        cursor.execute("SELECT 1 FROM tickets WHERE jira_key LIKE ? LIMIT 1;", (f"{project_name}-%",))
+        return cursor.fetchone() is not None
+
+    def get_watermark_overlap(self):
+        overlap = self.get_metadata("watermark_overlap_minutes")
+        if overlap is None:
+            overlap = DEFAULT_WATERMARK_OVERLAP_MINUTES
+        return timedelta(minutes=float(overlap))
+
+    def get_data_generation(self):
+        generation = self.get_metadata(DATA_GENERATION_KEY)
+        return int(generation) if generation is not None else 0
+
+    def _bump_data_generation(self, cursor):
+        cursor.execute("INSERT INTO metadata (key, val) VALUES (?, 1) "
+                       "ON CONFLICT(key) DO UPDATE SET val = val + 1;", (DATA_GENERATION_KEY,))
+
+    # Memoized report results. Returns compute() (which must give back
+    # something json can store), computed once per report, params and data
+    # generation. Reports whose numbers also depend on the clock (e.g. ages
+    # of open tickets) pass max_age in seconds to bound how stale they get
+    def cached_report(self, report, params, compute, max_age=None):
+        params_key = json.dumps(params, sort_keys=True, default=str)
+        generation = self.get_data_generation()
+        now = int(datetime.now(timezone.utc).timestamp())
+        cursor = self.dbConn.cursor()
+        cursor.execute("SELECT generation, computed_at, result FROM report_cache "
+                       "WHERE report = ? AND params = ?;", (report, params_key))
+        cached = cursor.fetchone()
+        if (cached is not None and cached["generation"] == generation
+                and (max_age is None or now - cached["computed_at"] <= max_age)):
+            stats.count("report_cache.hits")
+            return json.loads(cached["result"])
+        stats.count("report_cache.misses")
+        result = compute()
+        try:
+            with self.dbConn:
+                cursor.execute("INSERT INTO report_cache (report, params, generation, computed_at, result) "
+                               "VALUES (?, ?, ?, ?, ?) "
+                               "ON CONFLICT (report, params) DO UPDATE SET generation = excluded.generation, "
+                               "computed_at = excluded.computed_at, result = excluded.result;",
+                               (report, params_key, generation, now, json.dumps(result)))
+                # Nothing from an older generation can ever be used again
+                cursor.execute("DELETE FROM report_cache WHERE generation != ?;", (generation,))
+                self.dbConn.commit()
+        except sqlite3.OperationalError as e:
+            # e.g. a sync in another process holding the write lock; the
+            # report is still good, it just isn't kept
+            print(f"WARNING: Couldn't cache the {report} report: {e}")
+        # Handed back the same way a cache hit would be
+        return json.loads(json.dumps(result))
+
     # Updates or inserts transactions based on thier jira id (not key) as appropriate
     def store_tickets(self, tickets):
-        ticket_sql = ("INSERT INTO tickets VALUES ("
-            ":id, "
-            ":jira_key, "
-            ":issue_type, "
-            ":summary, "
-            ":created, "
-            ":resolved, "
-            ":updated, "
-            ":creator, "
-            ":assignee, "
-            ":status, "
-            ":resolution, "
-            ":story_points, "
-            ":fix_version, "
-            ":severity, "
-            ":group_name, "
-            ":sync_date) "
-            "ON CONFLICT(id) DO UPDATE SET "
-            "jira_key=excluded.jira_key, "
-            "type=excluded.type, "
-            "summary=excluded.summary, "
-            "created=excluded.created, "
-            "resolved=excluded.resolved, "
-            "updated=excluded.updated, "
-            "creator=excluded.creator, "
-            "assignee=excluded.assignee, "
-            "status=excluded.status, "
-            "resolution=excluded.resolution, "
-            "story_points=excluded.story_points, "
-            "fix_version=excluded.fix_version, "
-            "severity=excluded.severity, "
-            "group_name=excluded.group_name, "
-            "sync_date=sync_date")
-        ticket_rows = []
-        history_sql = ("INSERT INTO history VALUES ("
-                ":id, "
-                ":ticket_id, "
-                ":author, "
-                ":field, "
-                ":from_val, "
-                ":to_val, "
-                ":updated) "
+        ticket_rows, history_rows = self.transform_tickets(tickets)
+        self.write_tickets(ticket_rows, history_rows)
+
+    # Writes rows produced by transform_tickets in a single transaction. Any
+    # metadata key/values passed in (e.g. a sync checkpoint) are committed in
+    # the same transaction so they can never get ahead of the data. During a
+    # bulk load the transaction spans BULK_LOAD_PAGES_PER_COMMIT calls
+    def write_tickets(self, ticket_rows, history_rows, metadata=None):
+        history_sql = ("INSERT INTO history ("
+                f"{', '.join(HISTORY_COLUMNS)}) VALUES ("
+                f"{', '.join('?' for column in HISTORY_COLUMNS)}) "
                 "ON CONFLICT (id) DO UPDATE SET "
                 "ticket_id=excluded.ticket_id, "
                 "author=excluded.author, "
                 "field=excluded.field, "
                 "from_val=excluded.from_val, "
                 "to_val=excluded.to_val, "
-                "updated=excluded.updated")
-        history_rows = []
-        for ticket in tickets:
-            ticket_id = ticket["id"]
-            jira_key = ticket["key"]
-            issue_type = ticket["fields"]["issuetype"]["name"]
-            summary = ticket["fields"]["summary"]
-            created = ticket["fields"]["created"]
-            resolved = ticket["fields"]["resolutiondate"]
-            try:
-                updated = ticket["fields"]["updated"]
-            except (IndexError, TypeError) as e:
-                updated = None
-            try:
-                creator = ticket["fields"]["creator"]["emailAddress"]
-            except (KeyError) as e:
-                creator = ticket["fields"]["creator"]["displayName"]
-            except (IndexError, TypeError) as e:
-                creator = None
-            try:
-                assignee = ticket["fields"]["assignee"]["emailAddress"]
-            except (KeyError) as e:
-                assignee = ticket["fields"]["creator"]["displayName"]
-            except (IndexError, TypeError) as e:
-                assignee = None
-            status = ticket["fields"]["status"]["name"]
-            try:
-                resolution = ticket["fields"]["resolution"]["name"]
-            except (IndexError, TypeError) as e:
-                resolution = None
-            #10026 = Story Points
-            story_points = ticket["fields"]["customfield_10026"]
-            try:
-                fix_version = ticket["fields"]["fixVersions"][0]["name"]
-            except (IndexError, TypeError) as e:
-                fix_version = None
-            #10050 = Severity
-            try:
-                severity = ticket["fields"]["customfield_10050"]["value"]
-            except (IndexError, TypeError) as e:
-                severity = None
-            #10037 = Group
-            try:
-                group_name = ticket["fields"]["customfield_10037"]["name"]
-            except (IndexError, TypeError) as e:
-                group_name = None
-            ticket_rows.append({
-                "id": ticket_id,
-                "jira_key": jira_key,
-                "issue_type": issue_type,
-                "summary": summary,
-                "created": created,
-                "resolved": resolved,
-                "updated": updated,
-                "creator": creator,
-                "assignee": assignee,
-                "status": status,
-                "resolution": resolution,
-                "story_points": story_points,
-                "fix_version": fix_version,
-                "severity": severity,
-                "group_name": group_name,
-                "sync_date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z")})
-
-            for history_entry in ticket["changelog"]["histories"]:
-                try:
-                    author = history_entry["author"]["emailAddress"]
-                except (KeyError) as e:
-                    author = history_entry["author"]["displayName"]
-                except (IndexError, TypeError) as e:
-                    author = None
-                updated = history_entry["created"]
-                for changed_value in history_entry["items"]:
-                    history_id = history_entry["id"]
-                    field = changed_value["field"]
-                    from_val = changed_value["fromString"]
-                    to_val = changed_value["toString"]
-                    history_rows.append({
-                        "id": history_id,
-                        "ticket_id": ticket_id,
-                        "author": author,
-                        "field": field,
-                        "from_val": from_val,
-                        "to_val": to_val,
-                        "updated": updated
-                    })
+                "updated=excluded.updated, "
+                "updated_ts=excluded.updated_ts "
+                "WHERE (history.ticket_id, history.author, history.field, history.from_val, "
+                "history.to_val, history.updated, history.updated_ts) IS NOT "
+                "(excluded.ticket_id, excluded.author, excluded.field, excluded.from_val, "
+                "excluded.to_val, excluded.updated, excluded.updated_ts)")
+        cursor = self.dbConn.cursor()
+        try:
+            changes_before = self.dbConn.total_changes
+            with stats.timer("db.insert"):
+                cursor.executemany(self.ticket_sql, ticket_rows)
+                cursor.executemany(history_sql, history_rows)
+            changed = self.dbConn.total_changes != changes_before
+            if changed:
+                self._bump_data_generation(cursor)
+            if changed and not self.bulk_loading:
+                # A bulk load rebuilds them all at the end instead
+                self._refresh_derived_tables(cursor, ticket_rows, history_rows)
+            for key, val in (metadata or {}).items():
+                self._set_metadata(cursor, key, val)
+        except BaseException:
+            self.dbConn.rollback()
+            raise
+        self.bulk_pages_pending += 1
+        if not self.bulk_loading or self.bulk_pages_pending >= BULK_LOAD_PAGES_PER_COMMIT:
+            with stats.timer("db.commit"):
+                self.dbConn.commit()
+            self.bulk_pages_pending = 0
+        stats.count("db.ticket_rows", len(ticket_rows))
+        stats.count("db.history_rows", len(history_rows))
+
+    # status_intervals and ticket_search for the tickets in this write
+    def _refresh_derived_tables(self, cursor, ticket_rows, history_rows):
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS touched_tickets (id TEXT PRIMARY KEY);")
+        cursor.executemany("INSERT OR IGNORE INTO touched_tickets (id) VALUES (?);",
+                           [(row[self.ticket_id_index],) for row in ticket_rows]
+                           + [(row[1],) for row in history_rows])
+        with stats.timer("db.status_intervals"):
+            rebuild_status_intervals(cursor, only_touched=True)
+        with stats.timer("db.ticket_search"):
+            rebuild_ticket_search(cursor, only_touched=True)
+        cursor.execute("DELETE FROM touched_tickets;")
+
+    # See transform_tickets. Safe to run on a worker thread as it doesn't
+    # touch the connection
+    def transform_tickets(self, tickets):
+        return transform_tickets(self.field_map, tickets)
+
+    # Open cursor over the ids of a project's tickets (every ticket without a
+    # project), as integers in ascending order. Tombstoned tickets are left
+    # out unless include_deleted
+    def iter_ticket_ids(self, project_name=None, include_deleted=False):
+        conditions = []
+        params = []
+        if project_name is not None:
+            conditions.append("jira_key LIKE ?")
+            params.append(f"{project_name}-%")
+        if not include_deleted:
+            conditions.append(f"{fieldmap.DELETED_AT_COLUMN} IS NULL")
+        cursor = self.dbConn.cursor()
+        return cursor.execute("SELECT CAST(id AS INTEGER) FROM tickets "
+                              f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+                              "ORDER BY CAST(id AS INTEGER);", params)
+
+    # Open cursor over (id, updated_ts, deleted_at) for every ticket, so a
+    # replay can tell which archived issues are older than what is stored
+    def iter_ticket_versions(self):
+        cursor = self.dbConn.cursor()
+        return cursor.execute(f"SELECT id, updated_ts, {fieldmap.DELETED_AT_COLUMN} FROM tickets;")
+
+    # Empties tickets, history and everything derived from them, ready to be
+    # reloaded from scratch (see archive.replay). Metadata such as the sync
+    # watermarks is kept
+    def clear_tickets(self):
         with self.dbConn:
             cursor = self.dbConn.cursor()
-            cursor.executemany(ticket_sql, ticket_rows)
-            cursor.executemany(history_sql, history_rows)
+            cursor.execute("DELETE FROM history;")
+            cursor.execute("DELETE FROM status_intervals;")
+            cursor.execute("DELETE FROM ticket_search;")
+            cursor.execute("DELETE FROM tickets;")
+            self._bump_data_generation(cursor)
             self.dbConn.commit()
 
-    def get_all_ticket_ids(self):
+    # Marks tickets as gone from Jira. They stay in the DB (with their
+    # history) but drop out of every report
+    def tombstone_tickets(self, ticket_ids):
+        deleted_at = int(datetime.now(timezone.utc).timestamp())
         with self.dbConn:
             cursor = self.dbConn.cursor()
-            cursor.execute(f"SELECT id FROM tickets;")
-            db_ticket_ids = [id[0] for id in cursor.fetchall()]
+            cursor.executemany(f"UPDATE tickets SET {fieldmap.DELETED_AT_COLUMN} = ? WHERE id = ?;",
+                               [(deleted_at, str(ticket_id)) for ticket_id in ticket_ids])
+            self._bump_data_generation(cursor)
             self.dbConn.commit()
-        return db_ticket_ids
 
-    # Get a list of tickets with status updates for any tickets that were open at any 
-    # point within a time window. Dates must be formatted as %Y-%m-%dT%H:%M:%S.%f+00:00
-    # History entries will be returned in descending order of ticket id, then ascending
-    # updated date. Empty history entries just get a single row with ticket and nulls
-    def get_dev_ticket_status_updates(self, 
-                                  start_date, 
-                                  end_date):
+    # Deletes tickets and everything hanging off them
+    def purge_tickets(self, ticket_ids):
+        rows = [(str(ticket_id),) for ticket_id in ticket_ids]
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            cursor.executemany("DELETE FROM history WHERE ticket_id = ?;", rows)
+            cursor.executemany("DELETE FROM status_intervals WHERE ticket_id = ?;", rows)
+            cursor.executemany("DELETE FROM ticket_search WHERE rowid = ?;",
+                               [(int(ticket_id),) for ticket_id in ticket_ids])
+            cursor.executemany("DELETE FROM tickets WHERE id = ?;", rows)
+            self._bump_data_generation(cursor)
+            self.dbConn.commit()
+
+    # The tickets the dev team reports cover: anything open at any point within
+    # a time window. Returns the WHERE clause (over tickets t) and its params
+    def _dev_ticket_filter(self, start_date, end_date, team_names=DEV_TEAM_NAMES):
         if start_date is None:
             start_date = '2020-01-01T00:00:00.000-0000'
         if end_date is None:
             end_date = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z")
 
-        team_names = ("'Engineers-GreenTeam', "
-                    "'Engineers-RedTeam', "
-                    "'Engineers-BlueTeam', "
-                    "'Engineers-YellowTeam', "
-                    "'Engineers-OrangeTeam'")
+        params = {"start_ts": to_epoch(start_date), "end_ts": to_epoch(end_date)}
+        params.update({f"team{i}": team_name for i, team_name in enumerate(team_names)})
+        params.update({f"type{i}": issue_type for i, issue_type in enumerate(DEV_ISSUE_TYPES)})
+        team_params = ", ".join(f":team{i}" for i in range(len(team_names)))
+        type_params = ", ".join(f":type{i}" for i in range(len(DEV_ISSUE_TYPES)))
+
+        where = (
+            "t.deleted_at IS NULL "
+            f"AND t.\"type\" IN ({type_params}) "
+            f"AND t.group_name in ({team_params}) "
+            "AND t.status != 'Backlog' " # nothing we haven't even started
+            "AND (t.resolved_ts >= :start_ts OR t.status != 'Done') " # and actually got worked on after the start date
+            "AND t.created_ts <= :end_ts "# created prior to end window
+            "AND ( "
+                    # we only care about stuff we decided to do (E.g., not duplicates)
+                    "(t.resolved_ts >= :end_ts AND t.resolution IN ('Done', 'Cannot Reproduce')) "
+                    "OR "
+                    "t.status != 'Done' "
+	            ") ")
+        return where, params
 
+    # Get a list of tickets with status updates for any tickets that were open at any 
+    # point within a time window. Dates must be formatted as %Y-%m-%dT%H:%M:%S.%f+00:00
+    # History entries will be returned in descending order of ticket id, then ascending
+    # updated date. Empty history entries just get a single row with ticket and nulls
+    #
+    # dimensions adds those GROUPABLE_COLUMNS to every row, for breakdowns.
+    # partition=(index, count) returns only the tickets whose id % count is
+    # index, so several processes can each take a share
+    def get_dev_ticket_status_updates(self, 
+                                  start_date, 
+                                  end_date,
+                                  team_names=DEV_TEAM_NAMES,
+                                  dimensions=(),
+                                  partition=None):
+        where, params = self._dev_ticket_filter(start_date, end_date, team_names)
+        for dimension in dimensions:
+            if dimension not in GROUPABLE_COLUMNS:
+                raise ValueError(f"Can't group by '{dimension}'. Choose from: {', '.join(GROUPABLE_COLUMNS)}")
+        dimension_columns = "".join(f", t.\"{dimension}\" " for dimension in dimensions)
+        if partition is not None:
+            where += "AND CAST(t.id AS INTEGER) % :partitions = :partition "
+            params["partition"], params["partitions"] = partition
         query = (
             "SELECT t.jira_key"
             ", h.field "
             ", h.from_val "
             ", h.to_val "
             ", h.updated "
+            ", h.updated_ts "
             ", t.created "
+            ", t.created_ts "
             ", t.status "
             ", t.resolved "
+            ", t.resolved_ts "
             ", t.resolution "
+            f"{dimension_columns}"
             "FROM tickets t "
-            "LEFT JOIN history h on t.id = h.ticket_id AND (h.field = 'status' OR h.field = 'Key' OR h.field = 'Workflow')"
-            "WHERE t.\"type\" IN ('Bug','Story','Task', 'Maintenance')"
-            f"AND t.group_name in ({team_names}) "
-            "AND t.status != 'Backlog' " # nothing we haven't even started
-            f"AND (t.resolved >= '{start_date}' OR t.status != 'Done') " # and actually got worked on after the start date
-            f"AND t.created <= '{end_date}' "# created prior to end window
-            "AND ( "
-                    # we only care about stuff we decided to do (E.g., not duplicates)
-                    f"(t.resolved >= '{end_date}' AND t.resolution IN ('Done', 'Cannot Reproduce')) "
-                    "OR "
-                    "t.status != 'Done' "
-	            ") "
-            "ORDER BY t.id DESC, h.updated ASC")
+            "LEFT JOIN history h on t.id = h.ticket_id AND h.field IN ('status', 'Key', 'Workflow') "
+            f"WHERE {where}"
+            "ORDER BY t.id DESC, h.updated_ts ASC, h.id ASC")
+        # Handed back as a cursor so the report can make a single pass over
+        # the rows without holding them all in memory
+        cursor = self.dbConn.cursor()
+        return cursor.execute(query, params)
+
+    # Total and average time the dev report tickets spent in each status, from
+    # status_intervals. Time in the current status counts up to now
+    def get_dev_time_in_status(self, start_date, end_date, team_names=DEV_TEAM_NAMES):
+        where, params = self._dev_ticket_filter(start_date, end_date, team_names)
+        params["now_ts"] = int(datetime.now(timezone.utc).timestamp())
+        query = (
+            "SELECT si.status"
+            ", COUNT(DISTINCT si.ticket_id) AS tickets "
+            ", SUM(COALESCE(si.exited_at, :now_ts) - si.entered_at) AS total_seconds "
+            ", SUM(COALESCE(si.exited_at, :now_ts) - si.entered_at) * 1.0 "
+            "  / COUNT(DISTINCT si.ticket_id) AS average_seconds "
+            "FROM tickets t "
+            "JOIN status_intervals si ON si.ticket_id = t.id "
+            f"WHERE {where}"
+            "GROUP BY si.status "
+            "ORDER BY total_seconds DESC")
         with self.dbConn:
             cursor = self.dbConn.cursor()
-            cursor.execute(query)
-            ticket_histories = cursor.fetchall()
-            return ticket_histories
-    
-    def get_r_and_i_tickets_open(self, yearmonth):
-        year = yearmonth[2:6]
-        month = yearmonth[0:2]
-        query = ("select * from tickets t " 
-                "where t.group_name = 'Engineers-PurpleTeam' "
-                f"AND t.resolved >= '{year}-{month}-01' "
-                f"AND t.resolved < '{year}-{str(int(month)+1).zfill(2)}-25' "
-                "AND t.\"type\" = 'Story' "
-                "AND t.assignee IS NOT NULL " 
-                "AND t.assignee != '' "
-                "AND t.resolution = 'Done' "
-        )
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    # Lead time (created to the last move into Done) for the dev report
+    # tickets that are done. Returns (ticket count, average seconds)
+    def get_dev_lead_time(self, start_date, end_date, team_names=DEV_TEAM_NAMES):
+        where, params = self._dev_ticket_filter(start_date, end_date, team_names)
+        query = (
+            "SELECT COUNT(*) AS tickets, AVG(done_at - created_ts) AS average_seconds "
+            "FROM ("
+                "SELECT t.id, t.created_ts, MAX(si.entered_at) AS done_at "
+                "FROM tickets t "
+                "JOIN status_intervals si ON si.ticket_id = t.id AND si.status = 'Done' "
+                f"WHERE {where} AND t.status = 'Done' "
+                "GROUP BY t.id, t.created_ts"
+            ")")
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+    # Status transitions for tickets matching the filters, one row per
+    # transition (or one row of nulls for tickets with none), ordered by
+    # ticket and then time. This is the input metrics.tickets_in_status_as_of
+    # expects. created_before (epoch) skips tickets that can't matter yet.
+    def get_status_transitions(self, group_name=None, issue_type=None, created_before=None):
+        conditions = ["t.deleted_at IS NULL"]
+        params = {}
+        if group_name is not None:
+            conditions.append("t.group_name = :group_name")
+            params["group_name"] = group_name
+        if issue_type is not None:
+            conditions.append("t.\"type\" = :issue_type")
+            params["issue_type"] = issue_type
+        if created_before is not None:
+            conditions.append("t.created_ts <= :created_before")
+            params["created_before"] = created_before
+        query = ("SELECT t.id, t.jira_key, t.status, t.created, t.created_ts, "
+                "t.resolved, t.resolved_ts, h.from_val, h.to_val, h.updated_ts "
+                "FROM tickets t "
+                "LEFT JOIN history h ON t.id = h.ticket_id AND h.field = 'status' "
+                f"WHERE {' AND '.join(conditions)} "
+                "ORDER BY t.id, h.updated_ts, h.id")
+        cursor = self.dbConn.cursor()
+        return cursor.execute(query, params)
+
+    # Everything metrics.trend_series needs in one ordered pass: the status
+    # (and Key / Workflow) changes of every dev ticket and every R&I story
+    # created before end_ts, flagged dev / ri by which series they feed
+    def get_trend_transitions(self, end_ts, team_names=DEV_TEAM_NAMES, ri_team_name=RI_TEAM_NAME):
+        params = {"end_ts": end_ts, "ri_team": ri_team_name}
+        params.update({f"team{i}": team_name for i, team_name in enumerate(team_names)})
+        params.update({f"type{i}": issue_type for i, issue_type in enumerate(DEV_ISSUE_TYPES)})
+        team_params = ", ".join(f":team{i}" for i in range(len(team_names)))
+        type_params = ", ".join(f":type{i}" for i in range(len(DEV_ISSUE_TYPES)))
+        query = (
+            "WITH trend_tickets AS ("
+                "SELECT id, jira_key, status, created_ts, resolution, "
+                f"(\"type\" IN ({type_params}) AND group_name IN ({team_params})) AS dev, "
+                "(\"type\" = 'Story' AND group_name = :ri_team) AS ri "
+                "FROM tickets "
+                "WHERE deleted_at IS NULL AND created_ts <= :end_ts"
+            ") "
+            "SELECT t.id, t.jira_key, t.status, t.created_ts, t.resolution, t.dev, t.ri, "
+            "h.field, h.from_val, h.to_val, h.updated_ts "
+            "FROM trend_tickets t "
+            "LEFT JOIN history h ON t.id = h.ticket_id AND h.field IN ('status', 'Key', 'Workflow') "
+            "WHERE t.dev OR t.ri "
+            "ORDER BY t.id, h.updated_ts, h.id")
+        cursor = self.dbConn.cursor()
+        return cursor.execute(query, params)
+
+    # Work in progress at each of `instants` (epoch seconds), as {instant:
+    # count}: dev tickets whose status_intervals row covering that moment
+    # isn't one of excluded_statuses. Tickets only count from when they were
+    # created, even if their history starts earlier. Every WIP interval adds
+    # one when it's entered and takes one off when it's left; the instants
+    # are sorted in after the changes at the same time, so the running total
+    # at each one is the count, from one ordered pass however many instants
+    # there are
+    def get_wip_at(self, instants, team_names=DEV_TEAM_NAMES,
+                   excluded_statuses=metrics.WIP_EXCLUDED_STATUSES):
+        instants = list(instants)
+        if not instants:
+            return {}
+        params = {}
+        params.update({f"at{i}": instant for i, instant in enumerate(instants)})
+        params.update({f"team{i}": team_name for i, team_name in enumerate(team_names)})
+        params.update({f"type{i}": issue_type for i, issue_type in enumerate(DEV_ISSUE_TYPES)})
+        params.update({f"status{i}": status for i, status in enumerate(excluded_statuses)})
+        instant_values = ", ".join(f"(:at{i})" for i in range(len(instants)))
+        team_params = ", ".join(f":team{i}" for i in range(len(team_names)))
+        type_params = ", ".join(f":type{i}" for i in range(len(DEV_ISSUE_TYPES)))
+        status_params = ", ".join(f":status{i}" for i in range(len(excluded_statuses)))
+        query = (
+            f"WITH instants(at) AS (VALUES {instant_values}), "
+            "wip_intervals AS ("
+                "SELECT MAX(si.entered_at, t.created_ts) AS entered_at, "
+                "MAX(si.exited_at, t.created_ts) AS exited_at "
+                "FROM tickets t "
+                "JOIN status_intervals si ON si.ticket_id = t.id "
+                f"WHERE t.deleted_at IS NULL AND t.\"type\" IN ({type_params}) "
+                f"AND t.group_name IN ({team_params}) AND t.created_ts IS NOT NULL "
+                f"AND si.status NOT IN ({status_params})"
+            "), "
+            "wip_changes AS ("
+                "SELECT entered_at AS ts, 1 AS change, NULL AS at FROM wip_intervals "
+                "UNION ALL "
+                "SELECT exited_at, -1, NULL FROM wip_intervals WHERE exited_at IS NOT NULL "
+                "UNION ALL "
+                "SELECT at, 0, at FROM instants"
+            ") "
+            "SELECT at, tickets FROM ("
+                "SELECT at, SUM(change) OVER (ORDER BY ts, at IS NOT NULL "
+                "ROWS UNBOUNDED PRECEDING) AS tickets "
+                "FROM wip_changes"
+            ") WHERE at IS NOT NULL")
+        with self.dbConn:
+            cursor = self.dbConn.cursor()
+            cursor.execute(query, params)
+            return {row["at"]: row["tickets"] for row in cursor}
+
+    # Tickets in (or, with exclude=True, not in) one of `statuses` at each of
+    # `instants` (epoch seconds), worked out offline from the local history.
+    # Returns {instant: [ticket rows]}
+    def get_tickets_in_status_as_of(self, instants, statuses, exclude=False,
+                                    group_name=None, issue_type=None):
+        transitions = self.get_status_transitions(
+            group_name=group_name,
+            issue_type=issue_type,
+            created_before=max(instants))
+        return metrics.tickets_in_status_as_of(transitions, instants, statuses, exclude)
+
+    # R&I stories that were still open at the start of the month
+    def get_r_and_i_tickets_open(self, yearmonth, team_name=RI_TEAM_NAME):
+        month_start, month_end = month_bounds(yearmonth)
+        month_start = int(month_start.timestamp())
+        open_tickets = self.get_tickets_in_status_as_of(
+            [month_start], ('Resolved', 'Done'), exclude=True,
+            group_name=team_name, issue_type='Story')
+        return open_tickets[month_start]
     
-    def get_r_and_i_tickets_completed(self, yearmonth):
-        year = yearmonth[0:4]
-        month = yearmonth[4:6]
+    def get_r_and_i_tickets_completed(self, yearmonth, team_name=RI_TEAM_NAME):
+        with self.dbConn:
+            return self.stream_r_and_i_tickets_completed(yearmonth, team_name).fetchall()
+
+    # Same as get_r_and_i_tickets_completed but hands back the open cursor
+    def stream_r_and_i_tickets_completed(self, yearmonth, team_name=RI_TEAM_NAME):
+        month_start, month_end = month_bounds(yearmonth)
         query = ("select * from tickets t " 
-                "where t.group_name = 'Engineers-PurpleTeam' "
-                f"AND t.resolved >= '{year}-{month}-01' "
-                f"AND t.resolved < '{year}-{str(int(month)+1).zfill(2)}-01' "
+                "where t.deleted_at IS NULL "
+                "AND t.group_name = ? "
                 "AND t.\"type\" = 'Story' "
+                "AND t.resolved_ts >= ? "
+                "AND t.resolved_ts < ? "
                 "AND t.assignee IS NOT NULL " 
                 "AND t.assignee != '' "
                 "AND t.resolution = 'Done' "
         )
-        with self.dbConn:
-            cursor = self.dbConn.cursor()
-            cursor.execute(query)
-            tickets = cursor.fetchall()
-            return tickets
+        cursor = self.dbConn.cursor()
+        return cursor.execute(query, (team_name, int(month_start.timestamp()), int(month_end.timestamp())))
+
+    # Tickets matching an FTS5 query (e.g. 'timeout', 'timeout AND prod*',
+    # '"connection reset"') over summaries and changelog values, best match
+    # first. Summary hits rank well above changelog ones. Optionally only
+    # tickets now in `status` and/or resolved within [resolved_from,
+    # resolved_to) (Jira timestamps). Each row has the ticket columns plus
+    # rank (bm25, lower is better) and snippet, the matching text with the
+    # hits in [brackets]
+    def search_tickets(self, query, status=None, resolved_from=None, resolved_to=None, limit=20):
+        conditions = ["t.deleted_at IS NULL"]
+        params = {"limit": limit}
+        if status is not None:
+            conditions.append("t.status = :status")
+            params["status"] = status
+        if resolved_from is not None:
+            conditions.append("t.resolved_ts >= :resolved_from")
+            params["resolved_from"] = to_epoch(resolved_from)
+        if resolved_to is not None:
+            conditions.append("t.resolved_ts < :resolved_to")
+            params["resolved_to"] = to_epoch(resolved_to)
+        sql = ("SELECT t.jira_key, t.summary, t.status, t.resolved, t.assignee, "
+               "bm25(ticket_search, 10.0, 1.0) AS rank, "
+               "snippet(ticket_search, -1, '[', ']', '...', 16) AS snippet "
+               "FROM ticket_search s "
+               "JOIN tickets t ON t.id = CAST(s.rowid AS TEXT) "
+               f"WHERE ticket_search MATCH :query AND {' AND '.join(conditions)} "
+               "ORDER BY rank "
+               "LIMIT :limit")
+        cursor = self.dbConn.cursor()
+        try:
+            return cursor.execute(sql, {**params, "query": query}).fetchall()
+        except sqlite3.OperationalError:
+            # Not valid FTS5 query syntax (e.g. "SMART-123" reads as a
+            # column filter); search for the words as typed instead
+            pass
+        terms = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+        return cursor.execute(sql, {**params, "query": terms}).fetchall()
+
+    # Open cursor over a whole table, for exports. Only the tables listed in
+    # EXPORTABLE_TABLES can be asked for since the name goes into the SQL
+    def stream_table(self, table_name):
+        if table_name not in EXPORTABLE_TABLES:
+            raise ValueError(f"Unknown table '{table_name}'")
+        cursor = self.dbConn.cursor()
+        return cursor.execute(f"SELECT * FROM {table_name} ORDER BY rowid;")
@@ -0,0 +1,66 @@
+import csv
+import gzip
+import json
+
+# Rows pulled from the cursor per fetchmany call. Only this many rows are
+# ever held in memory, whatever the size of the export.
+EXPORT_BATCH_SIZE = 5000
+
+FORMATS = ("csv", "jsonl")
+
+
+# Works out the format and compression from a file name such as
+# tickets.csv, history.jsonl or history.jsonl.gz
+def format_from_path(path):
+    name = path.lower()
+    compress = name.endswith(".gz")
+    if compress:
+        name = name[:-3]
+    for file_format in FORMATS:
+        if name.endswith("." + file_format):
+            return file_format, compress
+    raise ValueError(f"Can't tell export format from '{path}', use .csv or .jsonl (optionally .gz)")
+
+
+# Streams everything left in a DB cursor to a file. Returns the row count
+def export_cursor(cursor, path, file_format=None, compress=None):
+    columns = [column[0] for column in cursor.description]
+    return export_rows(columns, _fetch_batches(cursor), path, file_format, compress)
+
+
+# Streams an iterable of rows (tuples in `columns` order) to a file. Rows
+# are written as they come so generators keep memory flat too
+def export_rows(columns, rows, path, file_format=None, compress=None):
+    if file_format is None or compress is None:
+        path_format, path_compress = format_from_path(path)
+        file_format = file_format or path_format
+        compress = path_compress if compress is None else compress
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format '{file_format}'")
+
+    if compress:
+        output = gzip.open(path, "wt", encoding="utf-8", newline="")
+    else:
+        output = open(path, "w", encoding="utf-8", newline="")
+    row_count = 0
+    with output:
+        if file_format == "csv":
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(tuple(row))
+                row_count += 1
+        else:
+            for row in rows:
+                output.write(json.dumps(dict(zip(columns, tuple(row))), default=str))
+                output.write("\n")
+                row_count += 1
+    return row_count
+
+
+def _fetch_batches(cursor):
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        yield from rows
@@ -0,0 +1,171 @@
+import re
+
+# Declarative mapping from search API issues to tickets table columns.
+#
+# Each entry names a column and where its value lives in the issue JSON, as a
+# dotted path ("fields.customfield_10050.value"; numbers index into lists,
+# "fields.fixVersions.0.name"). "path" can also be a list of paths, tried in
+# order until one gives a value. "convert": "epoch" stores a Jira timestamp
+# as epoch seconds (see dbcontrol.to_epoch). "type" is the SQLite column type
+# used when the column has to be added to an existing DB.
+#
+# Extra entries go under "FieldMapping" in jira_connection.json. An entry
+# with the same column as a default one replaces it, anything else becomes a
+# new column, e.g.
+#
+#   "FieldMapping": [
+#       {"column": "team", "path": "fields.customfield_12345.value", "type": "TEXT"}
+#   ]
+DEFAULT_MAPPING = [
+    {"column": "id", "path": "id", "type": "TEXT"},
+    {"column": "jira_key", "path": "key", "type": "TEXT"},
+    {"column": "type", "path": "fields.issuetype.name", "type": "TEXT"},
+    {"column": "summary", "path": "fields.summary", "type": "TEXT"},
+    {"column": "created", "path": "fields.created", "type": "TEXT"},
+    {"column": "resolved", "path": "fields.resolutiondate", "type": "TEXT"},
+    {"column": "updated", "path": "fields.updated", "type": "TEXT"},
+    {"column": "creator", "path": ["fields.creator.emailAddress", "fields.creator.displayName"], "type": "TEXT"},
+    {"column": "assignee", "path": ["fields.assignee.emailAddress", "fields.assignee.displayName"], "type": "TEXT"},
+    {"column": "status", "path": "fields.status.name", "type": "TEXT"},
+    {"column": "resolution", "path": "fields.resolution.name", "type": "TEXT"},
+    {"column": "story_points", "path": "fields.customfield_10026", "type": "REAL"},
+    {"column": "fix_version", "path": "fields.fixVersions.0.name", "type": "TEXT"},
+    {"column": "severity", "path": "fields.customfield_10050.value", "type": "TEXT"},
+    {"column": "group_name", "path": "fields.customfield_10037.name", "type": "TEXT"},
+    {"column": "created_ts", "path": "fields.created", "convert": "epoch", "type": "INTEGER"},
+    {"column": "resolved_ts", "path": "fields.resolutiondate", "convert": "epoch", "type": "INTEGER"},
+    {"column": "updated_ts", "path": "fields.updated", "convert": "epoch", "type": "INTEGER"},
+]
+
+# Stamped once per batch rather than read from the issue
+SYNC_DATE_COLUMN = "sync_date"
+
+# Set by reconciliation (see reconcile.py), never mapped from the issue
+DELETED_AT_COLUMN = "deleted_at"
+
+CONVERTERS = ("epoch",)
+COLUMN_TYPES = ("TEXT", "INTEGER", "REAL", "NUMERIC", "BLOB", "")
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+# A mapping compiled into a single generated function, so pulling a row out
+# of an issue costs one call with no per-field loops, lookups of the mapping
+# or exceptions. extract(issue, sync_date) returns the row as a tuple in
+# `columns` order.
+class FieldMap:
+
+    def __init__(self, entries, to_epoch):
+        self.entries = entries
+        self.columns = tuple(entry["column"] for entry in entries) + (SYNC_DATE_COLUMN,)
+        self.column_types = {entry["column"]: entry.get("type", "") for entry in entries}
+        self.column_types[SYNC_DATE_COLUMN] = "TEXT"
+        self.sync_fields = sync_fields(entries)
+        self.source = generate_source(entries)
+        namespace = {"to_epoch": to_epoch}
+        exec(compile(self.source, "<fieldmap>", "exec"), namespace)
+        self.extract = namespace["extract"]
+
+    def index(self, column):
+        return self.columns.index(column)
+
+
+# Validates the configured entries, merges them over the defaults and
+# compiles the result. to_epoch is passed in to keep this module free of
+# the DB code
+def compile_mapping(configured=None, to_epoch=None):
+    entries = [dict(entry) for entry in DEFAULT_MAPPING]
+    positions = {entry["column"]: position for position, entry in enumerate(entries)}
+    for entry in configured or []:
+        entry = validate_entry(entry)
+        if entry["column"] in positions:
+            entries[positions[entry["column"]]] = entry
+        else:
+            positions[entry["column"]] = len(entries)
+            entries.append(entry)
+    return FieldMap(entries, to_epoch)
+
+
+def validate_entry(entry):
+    if not isinstance(entry, dict) or "column" not in entry or "path" not in entry:
+        raise ValueError(f"Field mapping entries need a column and a path: {entry!r}")
+    column = entry["column"]
+    # Column names and types end up in SQL, so only plain identifiers
+    if not _IDENTIFIER.match(column) or column in (SYNC_DATE_COLUMN, DELETED_AT_COLUMN):
+        raise ValueError(f"Invalid field mapping column name '{column}'")
+    column_type = str(entry.get("type", "")).upper()
+    if column_type not in COLUMN_TYPES:
+        raise ValueError(f"Field mapping column '{column}' has unknown type '{entry['type']}'")
+    paths = entry["path"] if isinstance(entry["path"], list) else [entry["path"]]
+    if not paths or not all(isinstance(path, str) and path for path in paths):
+        raise ValueError(f"Field mapping column '{column}' has an invalid path")
+    convert = entry.get("convert")
+    if convert is not None and convert not in CONVERTERS:
+        raise ValueError(f"Field mapping column '{column}' has unknown convert '{convert}'")
+    return {"column": column, "path": paths, "type": column_type, "convert": convert}
+
+
+# The top level issue fields the mapping reads, for the search request
+def sync_fields(entries):
+    fields = []
+    for entry in entries:
+        paths = entry["path"] if isinstance(entry["path"], list) else [entry["path"]]
+        for path in paths:
+            segments = path.split(".")
+            if segments[0] == "fields" and len(segments) > 1 and segments[1] not in fields:
+                fields.append(segments[1])
+    return fields
+
+
+# Generates:
+#
+#   def extract(issue, sync_date):
+#       fields = issue.get("fields")
+#       if fields.__class__ is not dict:
+#           fields = {}
+#       v0 = issue.get("id")
+#       v1 = fields.get("customfield_10050")
+#       v1 = v1.get("value") if v1.__class__ is dict else None
+#       ...
+#       return (v0, v1, ..., sync_date)
+def generate_source(entries):
+    lines = [
+        "def extract(issue, sync_date):",
+        "    fields = issue.get(\"fields\")",
+        "    if fields.__class__ is not dict:",
+        "        fields = {}",
+    ]
+    names = []
+    for position, entry in enumerate(entries):
+        name = f"v{position}"
+        names.append(name)
+        paths = entry["path"] if isinstance(entry["path"], list) else [entry["path"]]
+        for attempt, path in enumerate(paths):
+            indent = "    "
+            if attempt > 0:
+                lines.append(f"    if {name} is None:")
+                indent = "        "
+            lines.extend(indent + line for line in path_lines(name, path))
+        if entry.get("convert") == "epoch":
+            lines.append(f"    {name} = to_epoch({name})")
+    lines.append(f"    return ({', '.join(names + ['sync_date'])},)")
+    return "\n".join(lines) + "\n"
+
+
+def path_lines(name, path):
+    segments = path.split(".")
+    if segments[0] == "fields" and len(segments) > 1:
+        source = "fields"
+        segments = segments[1:]
+    else:
+        source = "issue"
+    lines = []
+    for segment in segments:
+        if segment.isdigit():
+            lines.append(f"{name} = {source}[{int(segment)}] "
+                         f"if {source}.__class__ is list and len({source}) > {int(segment)} else None")
+        elif source in ("fields", "issue"):
+            lines.append(f"{name} = {source}.get({segment!r})")
+        else:
+            lines.append(f"{name} = {source}.get({segment!r}) if {source}.__class__ is dict else None")
+        source = name
+    return lines
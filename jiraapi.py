@@ -1,124 +1,366 @@
+import archive
 import dbcontrol
 import json
+import jsonstream
 import os
-from datetime import datetime, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import ratelimit
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+import responsecache
+import stats
+import syncpipeline
+import threading
+import time
+
+# Number of search pages fetched in parallel unless "MaxConcurrentRequests"
+# is set in jira_connection.json. Keep this low; Jira rate limits per user.
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+
+# Requests that keep getting rate limited give up after this many tries
+MAX_REQUEST_ATTEMPTS = 8
+
+# The bulk changelog endpoint takes up to 1000 issues per request
+CHANGELOG_BULK_BATCH_SIZE = 1000
+
+# Issues asked for per page when only ids are wanted. Jira may cap it lower;
+# the paging goes by what it actually returns
+ID_PAGE_SIZE = 5000
+
+# Issues looked up per "id in (...)" query
+ID_LOOKUP_BATCH_SIZE = 100
 
 class JiraApi:
 
-    def __init__(self, projectName):
-        self.project_name = projectName
-        self.db = dbcontrol.DBControl("jira.db", ".")
+    # settings and db default to ./jira_connection.json and ./jira.db; pass
+    # them in to point the client somewhere else (e.g. the benchmarks).
+    # projectName can also be a list of projects to sync together
+    def __init__(self, projectName, settings=None, db=None):
+        self.project_names = [projectName] if isinstance(projectName, str) else list(projectName)
+        self.project_name = self.project_names[0]
+        # Looked up from serverInfo the first time a JQL date is built, so
+        # creating a JiraApi never touches the network
         self.server_time_offset = None
+        self.server_time_checked = False
+        self.server_time_lock = threading.Lock()
+        # Cleared the first time the bulk changelog endpoint isn't there
+        # (older or self-hosted Jira), after which we page per issue
+        self.bulk_changelog_supported = True
 
-        configFilePath = os.path.join(".","jira_connection.json")
-        with open(configFilePath) as jirasettingsfile:
-            jirasettings = json.load(jirasettingsfile)
-            self.jira_url = jirasettings["url"]
-            self.jira_user = jirasettings["UserName"]
-            self.jira_key = jirasettings["ApiKey"]
+        jirasettings = settings
+        if jirasettings is None:
+            configFilePath = os.path.join(".","jira_connection.json")
+            with open(configFilePath) as jirasettingsfile:
+                jirasettings = json.load(jirasettingsfile)
+        self.db = db if db is not None else dbcontrol.DBControl(
+            "jira.db", ".", field_mapping=jirasettings.get("FieldMapping"))
+        self.jira_url = jirasettings["url"]
+        self.jira_user = jirasettings["UserName"]
+        self.jira_key = jirasettings["ApiKey"]
+        # Worker budget per project; every project's workers share the one
+        # rate limiter below
+        self.max_concurrent_requests = int(jirasettings.get(
+            "MaxConcurrentRequests", DEFAULT_MAX_CONCURRENT_REQUESTS))
+        # Shared by every thread (and every sync path) making requests
+        self.rate_limiter = ratelimit.AdaptiveRateLimiter(
+            rate=float(jirasettings.get(
+                "RequestsPerSecond", ratelimit.DEFAULT_REQUESTS_PER_SECOND)),
+            max_rate=float(jirasettings.get(
+                "MaxRequestsPerSecond", ratelimit.DEFAULT_MAX_REQUESTS_PER_SECOND)))
+        # None unless "ResponseCache": {"Enabled": true, ...} is configured
+        self.response_cache = responsecache.ResponseCache.from_settings(
+            jirasettings.get("ResponseCache"), self.jira_url)
+        # None unless "Archive": {"Enabled": true, ...} is configured
+        self.archive = archive.Archive.from_settings(jirasettings.get("Archive"))
         self.request_auth = HTTPBasicAuth(self.jira_user, self.jira_key)
         self.request_headers = {
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
+        # One keep-alive session shared by every request (and every worker
+        # thread) so we only pay for the TLS handshake once per connection
+        self.session = requests.Session()
+        self.session.auth = self.request_auth
+        self.session.headers.update(self.request_headers)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(self.max_concurrent_requests, 1) * len(self.project_names))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_server_time_offset(self):
+        with self.server_time_lock:
+            if not self.server_time_checked:
+                self.server_time_checked = True
+                try:
+                    response = self.request(
+                        request_type = "GET", 
+                        url = self.jira_url + "serverInfo", 
+                        payload=None)
+                    server_time = json.loads(response.text)["serverTime"]
+                    self.server_time_offset = datetime.fromisoformat(server_time).utcoffset()
+                except:
+                    print("\nWARNING: Failure connecting to server to get timezone info")
+            return self.server_time_offset
+
+    # Syncs every project at once: each gets its own pipeline (full download
+    # or incremental from its own watermark) and worker budget, and they all
+    # feed one writer so everything lands in the same DB
+    def sync_db(self):
+        self.db.recover_bulk_load()
+        print("Requesting update set from Jira...")
+        pipelines = [self.project_pipeline(project_name) for project_name in self.project_names]
+        full_syncs = [pipeline for pipeline in pipelines
+                      if isinstance(pipeline, syncpipeline.OffsetSyncPipeline)]
+        if len(pipelines) == 1:
+            pipeline = pipelines[0]
+        else:
+            pipeline = syncpipeline.MultiSyncPipeline(self.db, pipelines)
+
+        if full_syncs:
+            # Nothing to keep up to date on an empty DB (or a new project),
+            # so load in bulk and build the indexes once at the end
+            self.db.begin_bulk_load()
         try:
-            response = self.request(
-                request_type = "GET", 
-                url = self.jira_url + "serverInfo", 
-                payload=None)
-            server_time = json.loads(response.text)["serverTime"]
-            self.server_time_offset = datetime.fromisoformat(server_time).utcoffset()
-        except:
-            print("\nWARNING: Failure connecting to server to get timezone info")
-
-    def get_r_and_i_tickets_open(self, yearmonth):
-        year = yearmonth[0:4]
-        month = yearmonth[4:6]
-        result = []
-        records_received = 0
-        morePages = True
-        batchSize = 1000
-        jql = (f"status was not in (Resolved, Done) on {year}-{month}-01 AND "
-               f"created <= {year}-{month}-01 AND "
-               "type = story and \"Group[Group Picker (single group)]\" = Engineers-PurpleTeam"
-        )
-        
-        while morePages: 
+            records_received = pipeline.run()
+        finally:
+            if full_syncs:
+                self.db.end_bulk_load()
+        if records_received == 0:
+            print("No records received")
+        for full_sync in full_syncs:
+            self.db.set_sync_watermark(full_sync.name, full_sync.started)
+
+        self.db.set_last_updated_UTC()
+        limiter_stats = self.rate_limiter.stats()
+        stats.collector.set("rate_limiter", limiter_stats)
+        if self.response_cache is not None:
+            stats.collector.set("response_cache", self.response_cache.stats())
+        if limiter_stats["throttled_responses"] > 0:
+            print(f"Rate limited {limiter_stats['throttled_responses']} times, "
+                  f"{limiter_stats['throttled_seconds']}s spent waiting on Jira")
+        return
+
+    def project_pipeline(self, project_name):
+        watermark = self.db.get_sync_watermark(project_name)
+        if (watermark is None and self.db.has_project_tickets(project_name)
+                and self.db.get_metadata(dbcontrol.checkpoint_key(project_name)) is None
+                and not self.db.has_sync_watermarks()):
+            # Databases synced before watermarks existed only have the time
+            # of the last successful sync. It only counts for projects that
+            # were actually synced then, and only until watermarks take over:
+            # a project added later needs everything, and one whose first
+            # download was cut short resumes from its checkpoint
+            watermark = self.db.get_last_updated_UTC()
+
+        if watermark is None:
+            # Pages are requested by offset from several workers at once (and
+            # resumed by offset after a crash), so the order has to be stable
+            return syncpipeline.OffsetSyncPipeline(
+                self, self.db,
+                jql=f"project = {project_name} ORDER BY key ASC",
+                checkpoint_key=dbcontrol.checkpoint_key(project_name),
+                page_size=1000,
+                max_workers=self.max_concurrent_requests,
+                name=project_name)
+        return syncpipeline.WatermarkSyncPipeline(
+            self, self.db,
+            project_name=project_name,
+            watermark=watermark,
+            overlap=self.db.get_watermark_overlap(),
+            page_size=1000)
+
+    # JQL doesn't accept offsets, dates have to be given in the server's zone
+    def to_server_time(self, utc_time):
+        return utc_time + (self.get_server_time_offset() or timedelta())
+
+    # One page of search results, decoded incrementally from the response
+    # body: iterate it for the issues, then read total etc. from .fields.
+    # Only the fields store_tickets reads are requested, or all of them when
+    # the issues are also being archived
+    def stream_search_page(self, jql, start_at, max_results):
+        query = {
+            'startAt': start_at,
+            'maxResults': max_results,
+            'expand': ['changelog'],
+            'fields': ['*all'] if self.archive is not None else self.db.field_map.sync_fields,
+            'jql': jql
+        }
+        started = time.perf_counter()
+        response = self.request("POST", url=self.jira_url + "search", payload=query, stream=True)
+        # Filled in as the page is read, see syncpipeline.SyncPipeline.queue_issues
+        timing = {"request": time.perf_counter() - started, "read": 0.0, "bytes": 0}
+        page = jsonstream.StreamedObject(iter_response(response, timing=timing), "issues")
+        page.timing = timing
+        return page
+
+    # Ids (as ints) of every issue the JQL matches. Only the id is asked for
+    # so a page is a few bytes per issue; after the first page gives the
+    # total, the rest are fetched in parallel. Issues created or deleted
+    # while paging can shift the offsets, so callers must double check
+    # anything that looks missing (see get_issue_projects)
+    def iter_issue_ids(self, jql):
+        def fetch(start_at, max_results):
             query = {
-                'startAt': records_received,
-                'maxResults': batchSize,
+                'startAt': start_at,
+                'maxResults': max_results,
+                'fields': ['id'],
                 'jql': jql
             }
-            response = self.request("POST", url=self.jira_url + "search", payload=query)
-            response_json = json.loads(response.text)
-            records_received += len(response_json["issues"])
-            result.extend(response_json["issues"])
-            if records_received >= int(response_json["total"]):
-                morePages = False    
-            else:
-                print(f"Paging request - ({(records_received/int(response_json["total"])):.0%})")
-        return result
+            response = self.request("POST", url=self.jira_url + "search", payload=query, cache=False)
+            return json.loads(response.text)
 
-    def sync_db(self):
-        existing_ids = self.db.get_all_ticket_ids()
-        last_updated = self.db.get_last_updated_UTC()
+        first_page = fetch(0, ID_PAGE_SIZE)
+        yield from (int(issue["id"]) for issue in first_page["issues"])
+        page_size = len(first_page["issues"])
+        total = int(first_page["total"])
+        if page_size == 0 or page_size >= total:
+            return
+        offsets = range(page_size, total, page_size)
+        with ThreadPoolExecutor(max_workers=max(self.max_concurrent_requests, 1)) as executor:
+            for page in executor.map(lambda start_at: fetch(start_at, page_size), offsets):
+                yield from (int(issue["id"]) for issue in page["issues"])
 
-        if last_updated is None or len(existing_ids) == 0:
-            jql = f"project = {self.project_name}"
-        else:
-            last_updated_server_time = (last_updated + self.server_time_offset).strftime("%Y-%m-%d %H:%M")
-            jql = (f'project = {self.project_name} AND '
-                   f'(id NOT IN ({','.join(existing_ids)}) '
-                   f' OR (updated > "{last_updated_server_time}" )'
-                   f'and project = "{self.project_name}")')
-
-        records_received = 0
-        morePages = True
-        batchSize = 1000
-        print("Requesting update set from Jira...")
-        while morePages: 
+    # The current project key of each of the given issue ids, as {id: key}.
+    # Ids Jira doesn't know (deleted, or no longer visible to us) are left out
+    def get_issue_projects(self, issue_ids):
+        projects = {}
+        issue_ids = list(issue_ids)
+        for batch_start in range(0, len(issue_ids), ID_LOOKUP_BATCH_SIZE):
+            batch = issue_ids[batch_start:batch_start + ID_LOOKUP_BATCH_SIZE]
             query = {
-                'startAt': records_received,
-                'maxResults': batchSize,
-                'expand': ['changelog'],
-                'jql': jql
+                'startAt': 0,
+                'maxResults': len(batch),
+                'fields': ['project'],
+                # Without this Jira rejects the query over ids that no
+                # longer exist, which are exactly the ones we're after
+                'validateQuery': 'warn',
+                'jql': f"id in ({', '.join(str(issue_id) for issue_id in batch)})"
             }
-            response = self.request("POST", url=self.jira_url + "search", payload=query)
-            response_json = json.loads(response.text)
-            self.db.store_tickets(response_json["issues"])
-            records_received += len(response_json["issues"])
-            if(records_received == 0):
-                print("No records received")
-            else:
-                print(f"Stored {records_received} of {response_json["total"]} "
-                    f"({(records_received/int(response_json["total"])):.0%})")
-            if records_received >= int(response_json["total"]):
-                morePages = False    
+            response = self.request("POST", url=self.jira_url + "search", payload=query, cache=False)
+            for issue in json.loads(response.text)["issues"]:
+                projects[int(issue["id"])] = issue["fields"]["project"]["key"]
+        return projects
 
-        self.db.set_last_updated_UTC()
-        return
+    # expand=changelog on search only embeds the first page of each issue's
+    # changelog. Finds the issues where that got cut short and swaps in the
+    # complete history, fetched for all of them together. Updates the issues
+    # in place and returns how many were backfilled
+    def backfill_truncated_changelogs(self, issues):
+        truncated = {}
+        for issue in issues:
+            changelog = issue.get("changelog")
+            if changelog is not None and int(changelog.get("total", 0)) > len(changelog["histories"]):
+                truncated[issue["id"]] = issue
+        if not truncated:
+            return 0
+        histories = self.get_full_changelogs(list(truncated))
+        for issue_id, issue in truncated.items():
+            if issue_id in histories:
+                issue["changelog"]["histories"] = histories[issue_id]
+        return len(truncated)
+
+    # Complete changelogs for a list of issue ids, as {issue id: [histories]}
+    def get_full_changelogs(self, issue_ids):
+        if self.bulk_changelog_supported:
+            try:
+                return self.get_changelogs_bulk(issue_ids)
+            except Exception as e:
+                if len(e.args) < 2 or getattr(e.args[1], "status_code", None) not in (404, 405):
+                    raise
+                print("Bulk changelog endpoint not available, fetching changelogs per issue")
+                self.bulk_changelog_supported = False
+        with ThreadPoolExecutor(max_workers=max(self.max_concurrent_requests, 1)) as executor:
+            return dict(zip(issue_ids, executor.map(self.get_issue_changelog, issue_ids)))
+
+    def get_changelogs_bulk(self, issue_ids):
+        histories = {issue_id: [] for issue_id in issue_ids}
+        for batch_start in range(0, len(issue_ids), CHANGELOG_BULK_BATCH_SIZE):
+            query = {
+                'issueIdsOrKeys': issue_ids[batch_start:batch_start + CHANGELOG_BULK_BATCH_SIZE],
+                'maxResults': 1000
+            }
+            while True:
+                response = self.request("POST", url=self.jira_url + "changelog/bulkfetch", payload=query)
+                response_json = json.loads(response.text)
+                for issue_changelog in response_json.get("issueChangeLogs", []):
+                    histories.setdefault(issue_changelog["issueId"], []).extend(
+                        issue_changelog.get("changeHistories", []))
+                if not response_json.get("nextPageToken"):
+                    break
+                query['nextPageToken'] = response_json["nextPageToken"]
+        return histories
 
-    def request(self, request_type, url, payload):
-        attempt = 1
-        backoff_sec = [0, .1, 1, 5]
-        response = None
-        while attempt <= 5:
-            response = requests.request(
-                request_type,
-                url,
-                data=json.dumps(payload),
-                headers=self.request_headers,
-                auth=self.request_auth
-            )
-            if(response.status_code == 429):
-                if(attempt > 5):
-                    raise Exception("Too many rate limit warnings. Ending requests.")
-                print(f"Waiting {backoff_sec[attempt]} seconds to retry (attempt {attempt} of 5)...")
-                time.sleep(backoff_sec[attempt])
-                attempt += 1
-            elif(response.status_code != 200 and response.status_code != 429):
+    def get_issue_changelog(self, issue_id):
+        histories = []
+        while True:
+            response = self.request(
+                "GET",
+                url=f"{self.jira_url}issue/{issue_id}/changelog?startAt={len(histories)}&maxResults=100",
+                payload=None)
+            response_json = json.loads(response.text)
+            histories.extend(response_json["values"])
+            if response_json.get("isLast", True) or not response_json["values"]:
+                return histories
+
+    # Every request goes through the shared rate limiter. 429s (and 503s that
+    # carry a Retry-After) are retried after the pause the limiter works out
+    #
+    # With the response cache turned on, non-streamed requests are answered
+    # from it when possible, unless cache=False (reconcile's id lookups, which
+    # must always see what Jira has now)
+    def request(self, request_type, url, payload, stream=False, cache=True):
+        use_cache = self.response_cache is not None and cache and not stream
+        if use_cache:
+            cached = self.response_cache.get(request_type, url, payload)
+            if cached is not None:
+                stats.count("http.cache_hits")
+                return cached
+        for attempt in range(MAX_REQUEST_ATTEMPTS):
+            with stats.timer("http.rate_limit_wait"):
+                self.rate_limiter.acquire()
+            # Time to the response headers for streamed requests, the whole
+            # body otherwise
+            with stats.timer("http.request"):
+                response = self.session.request(
+                    request_type,
+                    url,
+                    data=json.dumps(payload),
+                    stream=stream
+                )
+            stats.count("http.requests")
+            if(response.status_code == 429
+               or (response.status_code == 503 and "Retry-After" in response.headers)):
+                response.close()
+                delay = self.rate_limiter.on_throttled(response.headers, attempt)
+                stats.count("http.retries")
+                stats.record("http.throttled_wait", delay)
+                print(f"Rate limited, waiting {delay:.1f} seconds to retry "
+                      f"(attempt {attempt + 1} of {MAX_REQUEST_ATTEMPTS})...")
+            elif(response.status_code != 200):
+                response.close()
                 raise Exception("Error with request", response)
             else:
-                return response
\ No newline at end of file
+                self.rate_limiter.on_success(response.headers)
+                if not stream:
+                    stats.count("http.bytes", len(response.content))
+                if use_cache:
+                    self.response_cache.put(request_type, url, payload, response)
+                return response
+        raise Exception("Too many rate limit warnings. Ending requests.", response)
+
+# Hands the body of a streamed response over in chunks and releases the
+# connection back to the pool once it has been read (or abandoned). Time
+# spent waiting on the socket and bytes read are added to `timing`
+def iter_response(response, chunk_size=64 * 1024, timing=None):
+    timing = {"read": 0.0, "bytes": 0} if timing is None else timing
+    try:
+        for chunk in stats.timed_iter(response.iter_content(chunk_size=chunk_size), timing, "read"):
+            timing["bytes"] += len(chunk)
+            yield chunk
+    finally:
+        response.close()
+        stats.record("http.read", timing["read"])
+        stats.count("http.bytes", timing["bytes"])
@@ -1,16 +1,85 @@
+import archive
+import argparse
+import atexit
+import breakdown
 from datetime import datetime, timedelta, timezone
 import dbcontrol
-import jiraapi
-
-
-db = dbcontrol.DBControl("jira.db", ".")
-jira = jiraapi.JiraApi("SMART")
-
-def main():
+import export
+import json
+import metrics
+import os
+import reconcile
+import stats
+import sys
+import webhook
+
+# Synced unless jira_connection.json lists "Projects"
+PROJECT_NAME = "SMART"
+
+# Default report window for the interactive menu
+DEFAULT_START_DATE = "2024-03-15T00:00:00.000-0000"
+DEFAULT_END_DATE = "2024-06-15T00:00:00.000-0000"
+
+# Reports that count up to "now" (ages of open tickets, time in the current
+# status) are recomputed after this many seconds even if no new data came in
+CLOCK_DEPENDENT_REPORT_MAX_AGE = 60 * 60
+
+# Cleared by --no-cache
+use_report_cache = True
+
+# Opened on first use so commands that don't need them (e.g. an offline
+# report never needs Jira) don't pay for them
+_settings = None
+_db = None
+_jira = None
+
+# jira_connection.json, or nothing if it isn't there (reports run fine
+# without it)
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = {}
+        if os.path.exists("jira_connection.json"):
+            with open("jira_connection.json") as settings_file:
+                _settings = json.load(settings_file)
+    return _settings
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = dbcontrol.DBControl("jira.db", ".", field_mapping=get_settings().get("FieldMapping"))
+    return _db
+
+def get_jira():
+    global _jira
+    if _jira is None:
+        # Imported here because requests is slow to import and only the
+        # sync needs it
+        import jiraapi
+        projects = get_settings().get("Projects") or [PROJECT_NAME]
+        _jira = jiraapi.JiraApi(projects, settings=get_settings(), db=get_db())
+    return _jira
+
+# The teams the dev reports cover and the team the R&I report covers.
+# "DevTeams" / "RiTeam" in jira_connection.json override the defaults
+def dev_team_names():
+    return tuple(get_settings().get("DevTeams") or dbcontrol.DEV_TEAM_NAMES)
+
+def ri_team_name():
+    return get_settings().get("RiTeam") or dbcontrol.RI_TEAM_NAME
+
+# A report's results, from the report cache in jira.db when nothing has been
+# synced since they were last worked out
+def cached_report(report, params, compute, max_age=None):
+    if not use_report_cache:
+        return json.loads(json.dumps(compute()))
+    return get_db().cached_report(report, params, compute, max_age)
+
+def menu():
     while True:
         print("\n")
         try:
-            print(f"Last synchronization: {db.get_last_updated_UTC().astimezone().strftime("%c")}")
+            print(f"Last synchronization: {get_db().get_last_updated_UTC().astimezone().strftime("%c")}")
             print("Choose option:")
             print("1. Synchronize local DB")
         except(AttributeError) as e:
@@ -19,208 +88,341 @@ def main():
             print("1. Initialize local DB - Full download (may take hours)")
         print('2. Get dev teams cycle time (from "In Progress" to "Done")')
         print('3. Monthly R&I Metrics Report')
+        print('4. Get dev teams lead time and time in status')
+        print('5. Export report or table (CSV/JSONL)')
+        print('6. Weekly trend (cycle time, throughput, WIP, R&I backlog)')
         selection = input("Return to exit...\n")
 
         match selection:
             case "1":
                 update_database()
             case "2":
-                get_development_cycle_time("2024-03-15T00:00:00.000-0000","2024-06-15T00:00:00.000-0000")
+                get_development_cycle_time(DEFAULT_START_DATE, DEFAULT_END_DATE)
                 selection = 0
             case "3":
                 get_monthly_ri_metrics()
+            case "4":
+                get_development_lead_time(DEFAULT_START_DATE, DEFAULT_END_DATE)
+            case "5":
+                export_menu()
+            case "6":
+                get_trend(DEFAULT_START_DATE, DEFAULT_END_DATE, "week")
             case _:
                 exit(0)
 
-def get_monthly_ri_metrics():
-    report_month = input("Enter YYYYMM for report...\n")
-    if not report_month.isnumeric():
+def get_monthly_ri_metrics(report_month=None, team_name=None):
+    if report_month is None:
+        report_month = input("Enter YYYYMM for report...\n")
+    if not report_month.isnumeric() or len(report_month) != 6:
         print("Error parsing date: Enter datetime in format YYYYMM, digits only")
-        return
-    r_and_i_tickets_completed = db.get_r_and_i_tickets_completed(report_month)
-    print(f"R&I Tickets Completed: {len(r_and_i_tickets_completed)} \n")
-    r_and_i_open_tickets = jira.get_r_and_i_tickets_open(report_month)
-    # TODO: Can I replace the above with the equivalent DB call?
-    print(f"Count of open R&I Tickets at start of month: {len(r_and_i_open_tickets)} \n")
+        return False
+    team_name = team_name or ri_team_name()
+    with stats.timer("report.ri_metrics"):
+        ri_metrics = cached_report("ri-metrics", {"month": report_month, "team": team_name},
+                                   lambda: compute_monthly_ri_metrics(report_month, team_name))
+    print(f"R&I Tickets Completed: {ri_metrics['completed']} \n")
+    print(f"Count of open R&I Tickets at start of month: {ri_metrics['open']} \n")
+    if ri_metrics['counted'] == 0:
+        print("Average days R&I Tickets outstanding at start of month: n/a \n")
+        return True
+    average_r_and_i_days_outstanding = timedelta(seconds=ri_metrics['average_seconds_outstanding'])
+    print(f"Average days R&I Tickets outstanding at start of month: {average_r_and_i_days_outstanding} \n")
+    return True
+
+def compute_monthly_ri_metrics(report_month, team_name):
+    with stats.timer("report.ri_completed"):
+        r_and_i_tickets_completed = get_db().get_r_and_i_tickets_completed(report_month, team_name)
+    with stats.timer("report.ri_open"):
+        r_and_i_open_tickets = get_db().get_r_and_i_tickets_open(report_month, team_name)
     r_and_i_days_outstanding = timedelta()
     counted_tickets = 0
+    # Note: this is probably wrong b/c time zone issues but close enough...
+    start_of_month = datetime(int(report_month[0:4]), int(report_month[4:6]), 1, tzinfo=timezone.utc).timestamp()
+    min_ticket_duration = timedelta(minutes=15)
 
     for ticket in r_and_i_open_tickets:
-        try:
-            resolved_date = datetime.strptime(ticket["fields"]["resolutiondate"], "%Y-%m-%dT%H:%M:%S.%f%z")
-        except (TypeError) as e:
-            resolved_date = None
-        created_date = datetime.strptime(ticket["fields"]["created"],"%Y-%m-%dT%H:%M:%S.%f%z")
-        # Note: this is probably wrong b/c time zone issues but close enough...
-        start_of_month = datetime(int(report_month[0:4]), int(report_month[4:6]), 1, tzinfo=timezone.utc)
-        if resolved_date is not None:
-            open_time = min(resolved_date, start_of_month) - created_date
+        if ticket["resolved_ts"] is not None:
+            open_time = timedelta(seconds=min(ticket["resolved_ts"], start_of_month) - ticket["created_ts"])
         else:
-            open_time = start_of_month - created_date
-        min_ticket_duration = timedelta(minutes=15)
+            open_time = timedelta(seconds=start_of_month - ticket["created_ts"])
         if open_time > min_ticket_duration:
             counted_tickets += 1
             r_and_i_days_outstanding += open_time
 
-    average_r_and_i_days_outstanding = r_and_i_days_outstanding / counted_tickets
-    print(f"Average days R&I Tickets outstanding at start of month: {average_r_and_i_days_outstanding} \n")
+    return {
+        "completed": len(r_and_i_tickets_completed),
+        "open": len(r_and_i_open_tickets),
+        "counted": counted_tickets,
+        "average_seconds_outstanding": (r_and_i_days_outstanding.total_seconds() / counted_tickets
+                                        if counted_tickets else None)
+    }
 
 def update_database():
     start_time = datetime.now()
     print(f"[{start_time.strftime("%Y-%m-%d %H:%M:%S")}] Updating local database...")
-    jira.sync_db()
+    with stats.timer("sync"):
+        get_jira().sync_db()
     print(f"[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Update complete. Run time: {str(datetime.now() - start_time)}")
 
-# Assumes the items have come in grouped by key and ordered by update date
-def get_transition_info(ticket_histories):
-    ticket_loiter_times = {}
-    current_status_date = None
-
-    # This only works if the incoming histories are grouped by ticket 
-    # and the statuses only ascend. So to make sure we catch this, we'll 
-    # keep track of the current ticket and its date. If there's a 
-    # deviation we'll raise an error and bail
-    for ticket_history_entry in ticket_histories:
-        jira_key = ticket_history_entry['jira_key']
-        
-        if jira_key not in ticket_loiter_times:
-            ticket_loiter_times[jira_key] = {
-                'last_status': None, 
-                'last_update': datetime.fromisoformat(ticket_history_entry['created']),
-                'first_in_progress': None
-            }
-            current_status_date = None
-
-        # Check for out of order key
-        if [*ticket_loiter_times.keys()][-1] != jira_key:
-            raise ValueError(f"Ticket histories must be grouped by key: at {jira_key}")
-
-        # Check for out of chronological order entries within a key 
-        if current_status_date is not None and current_status_date > ticket_history_entry['updated']:
-            raise ValueError(f"Ticket histories must be grouped by key and in chronological order: at {jira_key}")
-        else:
-            current_status_date = ticket_history_entry['updated']
-
-        # Update the log for a given status OR make a new key with a zero timespan
-        if (ticket_history_entry['field'] is not None):
-            if ticket_history_entry['from_val'] not in ticket_loiter_times[jira_key]:
-                ticket_loiter_times[jira_key][ticket_history_entry['from_val']] = timedelta()
-
-            ticket_loiter_times[jira_key][ticket_history_entry['from_val']] += (
-                datetime.fromisoformat(ticket_history_entry['updated']) - ticket_loiter_times[jira_key]['last_update'] 
-            )
-            ticket_loiter_times[jira_key]['last_status'] = ticket_history_entry['to_val']
-            ticket_loiter_times[jira_key]['last_update'] = datetime.fromisoformat(ticket_history_entry['updated'])
-    return ticket_loiter_times
+# Tombstones (or with purge, deletes) local tickets that were deleted in Jira
+# or moved out of the synced projects
+def reconcile_database(purge=False):
+    start_time = datetime.now()
+    print(f"[{start_time.strftime("%Y-%m-%d %H:%M:%S")}] Reconciling local database with Jira...")
+    with stats.timer("reconcile"):
+        reconcile.reconcile(get_jira(), get_db(), purge=purge)
+    print(f"[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Reconcile complete. Run time: {str(datetime.now() - start_time)}")
+
+# Loads tickets and history from the sync archive (see archive.py) rather
+# than from Jira, e.g. after adding a field mapping
+def replay_archive(processes=1, rebuild=False):
+    archive_settings = get_settings().get("Archive") or {}
+    path = archive_settings.get("Path", archive.DEFAULT_PATH)
+    if not archive.segments(path):
+        print(f"No archive at {path}, enable \"Archive\" in jira_connection.json and sync first")
+        return False
+    start_time = datetime.now()
+    print(f"[{start_time.strftime("%Y-%m-%d %H:%M:%S")}] Replaying {path} into the local database...")
+    with stats.timer("archive_replay"):
+        result = archive.replay(get_db(), path, processes, rebuild)
+    print(f"{result['issues']} issues replayed from {result['segments']} segments, "
+          f"{result['skipped']} skipped as the DB already had them newer or marked deleted")
+    print(f"[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Replay complete. Run time: {str(datetime.now() - start_time)}")
+    return True
+
+# Keeps jira.db up to date from Jira webhooks until Ctrl-C, with a regular
+# sync as a safety net. Settings are under "Webhook" (see webhook.py)
+def listen_for_webhooks(host=None, port=None, record_path=None, gap_fill_minutes=None):
+    webhook_settings = get_settings().get("Webhook") or {}
+    host = host or webhook_settings.get("Host", webhook.DEFAULT_HOST)
+    port = port or int(webhook_settings.get("Port", webhook.DEFAULT_PORT))
+    if gap_fill_minutes is None:
+        gap_fill_minutes = float(webhook_settings.get("GapFillMinutes", webhook.DEFAULT_GAP_FILL_MINUTES))
+    # Without connection settings there is nothing to gap-fill from
+    jira = get_jira() if get_settings().get("url") else None
+    server = webhook.WebhookServer(host, port, webhook_settings.get("Secret"), record_path).start()
+    print(f"Listening for Jira webhooks on {server.url} (Ctrl-C to stop)")
+    try:
+        webhook.run(server, get_db(), jira, gap_fill_minutes * 60)
+    finally:
+        server.stop()
 
 # Cycle time starts when an issue is moved to “In Progress“ status and ends the
 # last time an issue is moved to “Done” status. This function takes a start and 
 # end date and prints a message giving the average cycle time for tickets within 
 # that window, as well as the count of incomplete tickets.
 def get_development_cycle_time(start_date, end_date):
-    ticket_histories = db.get_dev_ticket_status_updates(start_date, end_date)
-
-    # This only works if the incoming histories are grouped by ticket 
-    # and the statuses only ascend. So to make sure we catch this, we'll 
-    # keep track of the current ticket and its date. If there's a 
-    # deviation we'll raise an error and bail
-    ticket_cycle_info_dict = {}
-    current_status_date = None
-    prestart_statuses = ['Backlog','Selected for Development']
-    for ticket_history_entry in ticket_histories:
-        # skip it if the ticket isn't "started" yet
-        if ticket_history_entry['status'] in prestart_statuses:
-            continue
-
-        jira_key = ticket_history_entry['jira_key']
-        
-        if jira_key not in ticket_cycle_info_dict:
-            ticket_cycle_info_dict[jira_key] = {
-                'work_start': None, 
-                'work_end': None,
-                'meta_projectswitch': False
-            }
-            current_status_date = None
-
-        # Check for out of order key
-        if [*ticket_cycle_info_dict.keys()][-1] != jira_key:
-            raise ValueError(f"Ticket histories must be grouped by key: at {jira_key}")
-
-        # Check for out of chronological order entries within a key 
-        if current_status_date is not None and current_status_date > ticket_history_entry['updated']:
-            raise ValueError(f"Ticket histories must be grouped by key and in chronological order: at {jira_key}")
-        else:
-            current_status_date = ticket_history_entry['updated']
-
-        if ticket_history_entry['field'] is not None:
-            # When tickets switch projects, we don't know what status they go into (thanks Jira API)
-            # so we keep track of the date, and on the next update we find, we check the 'from_val'
-            # to see where the ticket was. That way we know if this is truly the date work stated
-            if ticket_history_entry['field'] in ['Key', 'Workflow']:
-                ticket_cycle_info_dict[jira_key]['work_start'] = ticket_history_entry['updated']
-                ticket_cycle_info_dict[jira_key]['meta_projectswitch'] = True
-            elif ticket_history_entry['field'] == 'status':
-                if (ticket_cycle_info_dict[jira_key]['meta_projectswitch']
-                    and ticket_history_entry['from_val'] in prestart_statuses
-                    and ticket_history_entry['to_val'] not in prestart_statuses):
-                    ticket_cycle_info_dict[jira_key]['work_start'] = ticket_history_entry['updated']
-                    ticket_cycle_info_dict[jira_key]['meta_projectswitch'] = False
-                elif(not ticket_cycle_info_dict[jira_key]['meta_projectswitch']
-                    and ticket_history_entry['to_val'] not in prestart_statuses
-                    and ticket_cycle_info_dict[jira_key]['work_start'] is None):
-                    ticket_cycle_info_dict[jira_key]['work_start'] = ticket_history_entry['updated']
-
-                if ticket_history_entry['to_val'] == 'Done':
-                    ticket_cycle_info_dict[jira_key]['work_end'] = ticket_history_entry['updated']
-                else:
-                    ticket_cycle_info_dict[jira_key]['work_end'] = None
-
-
-    resolved_tickets = []
-    total_resolved_cycle_time = timedelta()
-    unresolved_tickets = []
-    total_unresolved_cycle_time = timedelta()
-
-    for ticket_id, ticket_info in ticket_cycle_info_dict.items():
-        if ticket_info['work_end'] is not None:
-            resolved_tickets.append(ticket_id)
-            total_resolved_cycle_time += (datetime.fromisoformat(ticket_info['work_end']) - 
-                                          datetime.fromisoformat(ticket_info['work_start']))
+    # The rows are read from the cursor as cycle_times goes, so this times
+    # the query and the calculation together
+    with stats.timer("report.cycle_time"):
+        cycle_time = cached_report("cycle-time", {"start": start_date, "end": end_date, "teams": dev_team_names()},
+                                   lambda: compute_development_cycle_time(start_date, end_date),
+                                   max_age=CLOCK_DEPENDENT_REPORT_MAX_AGE)
+
+    resolved = cycle_time['resolved']
+    unresolved = cycle_time['unresolved']
+    print(f"Resolved tickets: {resolved['count']}")
+    print(f"Average cycle time: {pretty_seconds(resolved['mean'])}")
+    print(f"Cycle time p50 / p85 / p95: {pretty_seconds(resolved['p50'])} / "
+          f"{pretty_seconds(resolved['p85'])} / {pretty_seconds(resolved['p95'])}")
+    print(f"Unresolved tickets: {unresolved['count']}")
+    print(f"Current average unresolved ticket time: {pretty_seconds(unresolved['mean'])}")
+
+    print("Time in status (p50 / p85 / p95):")
+    for status, in_status in cycle_time['time_in_status']:
+        print(f"  {status}: {pretty_seconds(in_status['p50'])} / "
+              f"{pretty_seconds(in_status['p85'])} / {pretty_seconds(in_status['p95'])}")
+
+def compute_development_cycle_time(start_date, end_date):
+    ticket_histories = get_db().get_dev_ticket_status_updates(start_date, end_date, dev_team_names())
+    cycle_info = metrics.cycle_times(ticket_histories, datetime.now(timezone.utc).timestamp())
+    return {
+        "resolved": metrics.summarize(cycle_info['resolved_cycle_times']),
+        "unresolved": metrics.summarize(cycle_info['unresolved_ages']),
+        "time_in_status": [
+            [status, metrics.summarize(seconds)]
+            for status, seconds in sorted(cycle_info['time_in_status'].items(), key=lambda item: str(item[0]))]
+    }
+
+# Lead time runs from ticket creation to the last move into "Done". Worked out
+# in SQL from the status_intervals table, along with how long tickets in the
+# window spent in each status.
+# csv_path exports the time in status rows without asking; with
+# interactive=False nothing is prompted for
+def get_development_lead_time(start_date, end_date, csv_path=None, interactive=True):
+    with stats.timer("report.lead_time"):
+        lead_time = cached_report("lead-time", {"start": start_date, "end": end_date, "teams": dev_team_names()},
+                                  lambda: compute_development_lead_time(start_date, end_date),
+                                  max_age=CLOCK_DEPENDENT_REPORT_MAX_AGE)
+    print(f"Resolved tickets: {lead_time['tickets']}")
+    print(f"Development average lead time: {pretty_seconds(lead_time['average_seconds'])}")
+
+    print("Average time in status:")
+    for status, tickets, total_seconds, average_seconds in lead_time['time_in_status']:
+        print(f"  {status}: {pretty_seconds(average_seconds)} ({tickets} tickets)")
+
+    if csv_path is None and interactive and input("Export lead time CSV? (y/n)") == "y":
+        csv_path = "results.csv"
+    if csv_path is not None:
+        row_count = export.export_rows(
+            ["status", "tickets", "total_seconds", "average_seconds"],
+            lead_time['time_in_status'], csv_path)
+        print(f"Exported {row_count} rows to {csv_path}")
+
+def compute_development_lead_time(start_date, end_date):
+    lead_time = get_db().get_dev_lead_time(start_date, end_date, dev_team_names())
+    with stats.timer("report.time_in_status"):
+        time_in_status = get_db().get_dev_time_in_status(start_date, end_date, dev_team_names())
+    return {
+        "tickets": lead_time['tickets'],
+        "average_seconds": lead_time['average_seconds'],
+        "time_in_status": [[row['status'], row['tickets'], row['total_seconds'], row['average_seconds']]
+                           for row in time_in_status]
+    }
+
+# Cycle time and completion for the dev report tickets, split by one or more
+# of dbcontrol.GROUPABLE_COLUMNS (e.g. group_name, or group_name and
+# assignee). All the slices come out of one pass, see breakdown.py.
+# team_names overrides the dev teams; processes spreads the work over that
+# many processes
+def get_breakdown(start_date, end_date, dimensions, team_names=None, processes=1, csv_path=None):
+    team_names = tuple(team_names or dev_team_names())
+    with stats.timer("report.breakdown"):
+        groups = cached_report(
+            "breakdown", {"start": start_date, "end": end_date, "by": dimensions, "teams": team_names},
+            lambda: breakdown.grouped_cycle_times(get_db(), start_date, end_date, dimensions,
+                                                  datetime.now(timezone.utc).timestamp(),
+                                                  team_names, processes),
+            max_age=CLOCK_DEPENDENT_REPORT_MAX_AGE)
+    rows = [breakdown_row(group) for group in groups]
+    key_width = max([len(" / ".join(dimensions))] + [len(row[0]) for row in rows]) + 2
+    print(f"{' / '.join(dimensions):<{key_width}}{'Done':>6}{'Open':>6}{'Done %':>8}"
+          f"{'Cycle p50':>12}{'Cycle p85':>12}{'Open age avg':>14}")
+    for row in rows:
+        completion = f"{row[4]:.0%}" if row[4] is not None else "n/a"
+        print(f"{row[0]:<{key_width}}{row[1]:>6}{row[2]:>6}{completion:>8}"
+              f"{pretty_seconds(row[6]):>12}{pretty_seconds(row[7]):>12}{pretty_seconds(row[9]):>14}")
+    if csv_path is not None:
+        columns = ["group", "resolved", "unresolved", "unstarted", "completion_rate", "cycle_time_mean",
+                   "cycle_time_p50", "cycle_time_p85", "cycle_time_p95", "unresolved_age_mean"]
+        row_count = export.export_rows(columns, rows, csv_path)
+        print(f"Exported {row_count} rows to {csv_path}")
+
+def breakdown_row(group):
+    if group['total']:
+        name = "(all)"
+    else:
+        name = " / ".join("(none)" if value is None else str(value) for value in group['key'])
+    cycle_time = group['cycle_time']
+    return (name, group['resolved'], group['unresolved'], group['unstarted'], group['completion_rate'],
+            cycle_time['mean'], cycle_time['p50'], cycle_time['p85'], cycle_time['p95'],
+            group['unresolved_age']['mean'])
+
+# Full text search over ticket summaries and changelog values in the local
+# DB, best matches first. query is FTS5 syntax (timeout, "connection reset",
+# timeout AND prod*) or just words
+def search_tickets(query, status=None, resolved_from=None, resolved_to=None, limit=20, csv_path=None):
+    with stats.timer("report.search"):
+        matches = get_db().search_tickets(query, status, resolved_from, resolved_to, limit)
+    if not matches:
+        print("No matching tickets")
+    for match in matches:
+        print(f"{match['jira_key']:<14}{str(match['status']):<26}{match['summary']}")
+        print(f"{'':<14}{match['snippet']}")
+    if csv_path is not None:
+        row_count = export.export_rows(
+            ["jira_key", "summary", "status", "resolved", "assignee", "rank", "snippet"], matches, csv_path)
+        print(f"Exported {row_count} rows to {csv_path}")
+
+TREND_COLUMNS = ["window_start", "window_end", "throughput", "cycle_time_mean",
+                 "cycle_time_p50", "cycle_time_p85", "cycle_time_p95", "wip", "ri_backlog"]
+
+# Cycle time, throughput, WIP and the open R&I backlog for every week (or
+# month) between two dates, worked out together in one pass over the history.
+# See metrics.trend_series for what each number means
+def get_trend(start_date, end_date, step, csv_path=None):
+    with stats.timer("report.trend"):
+        windows = cached_report("trend", {"start": start_date, "end": end_date, "step": step,
+                                          "teams": dev_team_names(), "ri_team": ri_team_name()},
+                                lambda: compute_trend(start_date, end_date, step))
+    rows = [trend_row(window) for window in windows]
+    print(f"{'Window':<12}{'Done':>6}{'Cycle p50':>12}{'Cycle p85':>12}{'WIP':>6}{'R&I open':>10}")
+    for row in rows:
+        print(f"{row[0][:10]:<12}{row[2]:>6}{pretty_seconds(row[4]):>12}{pretty_seconds(row[5]):>12}"
+              f"{row[7]:>6}{row[8]:>10}")
+    if csv_path is not None:
+        row_count = export.export_rows(TREND_COLUMNS, rows, csv_path)
+        print(f"Exported {row_count} rows to {csv_path}")
+
+def compute_trend(start_date, end_date, step):
+    start = datetime.fromtimestamp(dbcontrol.to_epoch(start_date), timezone.utc)
+    end = datetime.fromtimestamp(dbcontrol.to_epoch(end_date), timezone.utc)
+    boundaries = metrics.window_boundaries(start, end, step)
+    wip_counts = get_db().get_wip_at(boundaries[:-1], dev_team_names())
+    transitions = get_db().get_trend_transitions(boundaries[-1], dev_team_names(), ri_team_name())
+    return metrics.trend_series(transitions, boundaries, wip_counts)
+
+def trend_row(window):
+    def date(epoch):
+        return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%d %H:%M")
+    cycle_time = window['cycle_time']
+    return (date(window['start']), date(window['end']), window['throughput'],
+            cycle_time['mean'], cycle_time['p50'], cycle_time['p85'], cycle_time['p95'],
+            window['wip'], window['ri_backlog'])
+
+# Every export streams straight from its cursor (or generator) to the file, so
+# memory stays flat however many rows come out. Each entry maps a name to a
+# function returning a DB cursor (read export.EXPORT_BATCH_SIZE rows at a
+# time) or (columns, rows)
+def get_export_sources(start_date, end_date, report_month):
+    def cycle_time_rows():
+        ticket_histories = get_db().get_dev_ticket_status_updates(start_date, end_date, dev_team_names())
+        cycle_info = metrics.cycle_times(ticket_histories, datetime.now(timezone.utc).timestamp())
+        for jira_key, seconds in zip(cycle_info['resolved_keys'], cycle_info['resolved_cycle_times']):
+            yield (jira_key, "resolved", seconds)
+        for jira_key, seconds in zip(cycle_info['unresolved_keys'], cycle_info['unresolved_ages']):
+            yield (jira_key, "unresolved", seconds)
+
+    return {
+        "tickets": lambda: get_db().stream_table("tickets"),
+        "history": lambda: get_db().stream_table("history"),
+        "status_intervals": lambda: get_db().stream_table("status_intervals"),
+        "dev-status-updates": lambda: get_db().get_dev_ticket_status_updates(start_date, end_date, dev_team_names()),
+        "cycle-time": lambda: (["jira_key", "state", "seconds"], cycle_time_rows()),
+        "ri-completed": lambda: get_db().stream_r_and_i_tickets_completed(report_month, ri_team_name()),
+    }
+
+def export_data(source_name, path, start_date, end_date, report_month=None):
+    sources = get_export_sources(start_date, end_date, report_month)
+    if source_name not in sources:
+        print(f"Unknown export '{source_name}'. Choose from: {', '.join(sources)}")
+        return False
+    with stats.timer(f"export.{source_name}"):
+        source = sources[source_name]()
+        if isinstance(source, tuple):
+            row_count = export.export_rows(*source, path)
         else:
-            unresolved_tickets.append(ticket_id)
-            total_unresolved_cycle_time += (datetime.now(timezone.utc) - 
-                                            datetime.fromisoformat(ticket_info['work_start']))
-
-    print(f"Resolved tickets: {len(resolved_tickets)}")
-    print(f"Average cycle time: {pretty_time_delta(total_resolved_cycle_time / len(resolved_tickets))}")
-    print(f"Unresolved tickets: {len(unresolved_tickets)}")
-    print(f"Current average unresolved ticket time: {pretty_time_delta(total_unresolved_cycle_time / len(unresolved_tickets))}")
-
-def get_development_lead_time():
-    raise NotImplementedError()
-    # Get tickets open between start and end dates 
-    start_date = "2024-03-15T00:00:00.000-0000" #input("Datetime in format: 2024-03-15T00:00:00.000-0000")
-    end_date = "2024-06-15T00:00:00.000-0000" #input("Datetime in format: 2024-06-15T00:00:00.000-0000")
-    ticket_status_histories = db.get_dev_ticket_status_updates(start_date, end_date)
-
-    ticket_loiter_times = get_transition_info(ticket_status_histories)
-    sum_of_time_per_status = {}
-
-    for ticket_id, loiter_times in ticket_loiter_times.items():
-        for status, time_in_status in loiter_times.items(): 
-            if status == "last_update" or status == "last_status":
-                continue
-            if status not in sum_of_time_per_status:
-                sum_of_time_per_status[status] = time_in_status
-            else:
-                sum_of_time_per_status[status] = sum_of_time_per_status[status] + time_in_status
-
-    print(f"Development average lead time: {lead_time}")
-
-    if input("Export lead time CSV? (y/n)") == "y":
-    	with open("results.csv", "w", encoding="utf-8") as f:
-            f.write("headers")
-            f.writelines(ticket_loiter_times)
+            row_count = export.export_cursor(source, path)
+    print(f"Exported {row_count} rows to {path}")
+    return True
+
+def export_menu():
+    sources = get_export_sources(None, None, None)
+    print(f"Exports: {', '.join(sources)}")
+    source_name = input("Export which data?\n")
+    report_month = None
+    if source_name == "ri-completed":
+        report_month = input("Enter YYYYMM for report...\n")
+    path = input("Export to file (.csv or .jsonl, add .gz to compress)...\n")
+    try:
+        export_data(source_name, path, DEFAULT_START_DATE, DEFAULT_END_DATE, report_month)
+    except ValueError as e:
+        print(f"Error exporting: {e}")
+
+def pretty_seconds(seconds):
+    if seconds is None:
+        return "n/a"
+    return pretty_time_delta(timedelta(seconds=seconds))
 
 def pretty_time_delta(time):
     seconds = time.total_seconds()
@@ -236,4 +438,178 @@ def pretty_time_delta(time):
     else:
         return '%ds' % (seconds)
 
-main()
\ No newline at end of file
+# With --profile, print where the time went and write the full stats
+# (including per-page sync timings) to jira_stats.json on the way out
+def write_profile():
+    print(stats.collector.summary())
+    stats.collector.dump(stats.DEFAULT_STATS_FILE)
+    print(f"Stats written to {stats.DEFAULT_STATS_FILE}")
+
+def group_columns(value):
+    columns = [column.strip() for column in value.split(",") if column.strip()]
+    for column in columns:
+        if column not in dbcontrol.GROUPABLE_COLUMNS:
+            raise argparse.ArgumentTypeError(
+                f"Can't group by '{column}'. Choose from: {', '.join(dbcontrol.GROUPABLE_COLUMNS)}")
+    if not columns:
+        raise argparse.ArgumentTypeError("Give at least one column to group by")
+    return columns
+
+# Accepts YYYY-MM-DD or a full Jira style timestamp for the report windows
+def report_date(value):
+    if len(value) == 10:
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%S.000-0000")
+        except ValueError:
+            pass
+    if dbcontrol.to_epoch(value) is None:
+        raise argparse.ArgumentTypeError(f"'{value}' isn't a date (use YYYY-MM-DD)")
+    return value
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Local Jira mirror and team reports. Runs the interactive menu without a command.")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"print timings on exit and write them to {stats.DEFAULT_STATS_FILE}")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="recompute reports instead of reusing results from before the last sync")
+    # So --profile and --no-cache also work after the command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--profile", action="store_true", default=argparse.SUPPRESS,
+                        help=f"print timings on exit and write them to {stats.DEFAULT_STATS_FILE}")
+    common.add_argument("--no-cache", action="store_true", default=argparse.SUPPRESS,
+                        help="recompute reports instead of reusing results from before the last sync")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("sync", parents=[common], help="download changes from Jira into jira.db")
+
+    reconcile_command = commands.add_parser(
+        "reconcile", parents=[common], help="find tickets deleted in (or moved out of) Jira and drop them from the reports")
+    reconcile_command.add_argument("--purge", action="store_true",
+                                   help="delete them and their history instead of marking them deleted")
+
+    archive_replay = commands.add_parser(
+        "archive-replay", parents=[common], help="load tickets and history from the sync archive instead of Jira")
+    archive_replay.add_argument("--processes", type=int, default=1,
+                                help="decode this many archive segments at once")
+    archive_replay.add_argument("--rebuild", action="store_true",
+                                help="empty the tickets and history first rather than updating them")
+
+    cycle_time = commands.add_parser("cycle-time", parents=[common], help="dev teams cycle time and time in status")
+    cycle_time.add_argument("--start", type=report_date, default=DEFAULT_START_DATE)
+    cycle_time.add_argument("--end", type=report_date, default=DEFAULT_END_DATE)
+
+    lead_time = commands.add_parser("lead-time", parents=[common], help="dev teams lead time and time in status")
+    lead_time.add_argument("--start", type=report_date, default=DEFAULT_START_DATE)
+    lead_time.add_argument("--end", type=report_date, default=DEFAULT_END_DATE)
+    lead_time.add_argument("--csv", help="also export the time in status rows to this file")
+
+    trend = commands.add_parser("trend", parents=[common],
+                                help="cycle time, throughput, WIP and R&I backlog per week or month")
+    trend.add_argument("--start", type=report_date, default=DEFAULT_START_DATE)
+    trend.add_argument("--end", type=report_date, default=DEFAULT_END_DATE)
+    trend.add_argument("--step", choices=metrics.TREND_STEPS, default="week")
+    trend.add_argument("--csv", help="also export the series to this file")
+
+    breakdown_command = commands.add_parser(
+        "breakdown", parents=[common], help="dev teams cycle time and completion split by team, assignee, ...")
+    breakdown_command.add_argument("--by", type=group_columns, default=["group_name"],
+                                   help=f"comma separated, from: {', '.join(dbcontrol.GROUPABLE_COLUMNS)}")
+    breakdown_command.add_argument("--start", type=report_date, default=DEFAULT_START_DATE)
+    breakdown_command.add_argument("--end", type=report_date, default=DEFAULT_END_DATE)
+    breakdown_command.add_argument("--teams", help="comma separated group names (default: the dev teams)")
+    breakdown_command.add_argument("--processes", type=int, default=1,
+                                   help="split the work over this many processes (for large DBs)")
+    breakdown_command.add_argument("--csv", help="also export the breakdown to this file")
+
+    search = commands.add_parser("search", parents=[common],
+                                 help="full text search of ticket summaries and changelogs")
+    search.add_argument("query", nargs="+", help='words, or FTS5 syntax such as timeout AND "prod db"')
+    search.add_argument("--status", help="only tickets currently in this status")
+    search.add_argument("--resolved-from", type=report_date)
+    search.add_argument("--resolved-to", type=report_date)
+    search.add_argument("--limit", type=int, default=20)
+    search.add_argument("--csv", help="also export the matches to this file")
+
+    webhook_command = commands.add_parser(
+        "webhook", parents=[common], help="apply Jira webhooks to jira.db as they arrive")
+    webhook_command.add_argument("--host", help=f"default {webhook.DEFAULT_HOST}")
+    webhook_command.add_argument("--port", type=int, help=f"default {webhook.DEFAULT_PORT}")
+    webhook_command.add_argument("--record", help="append every payload received to this JSON lines file")
+    webhook_command.add_argument("--gap-fill-minutes", type=float,
+                                 help=f"minutes between safety-net syncs, 0 for none "
+                                      f"(default {webhook.DEFAULT_GAP_FILL_MINUTES})")
+
+    replay_command = commands.add_parser(
+        "webhook-replay", parents=[common], help="post recorded webhook payloads to a running receiver")
+    replay_command.add_argument("path", help="JSON lines file written by webhook --record")
+    replay_command.add_argument("--url", default=f"http://{webhook.DEFAULT_HOST}:{webhook.DEFAULT_PORT}{webhook.WEBHOOK_PATH}")
+    replay_command.add_argument("--delay", type=float, default=0.0, help="seconds between payloads")
+
+    ri_report = commands.add_parser("ri-report", parents=[common], help="monthly R&I metrics")
+    ri_report.add_argument("--month", required=True, help="YYYYMM")
+    ri_report.add_argument("--team", help=f"group name (default: {dbcontrol.RI_TEAM_NAME})")
+
+    export_command = commands.add_parser("export", parents=[common], help="export a table or report to CSV/JSONL")
+    export_command.add_argument("source", choices=list(get_export_sources(None, None, None)))
+    export_command.add_argument("path", help=".csv or .jsonl, add .gz to compress")
+    export_command.add_argument("--start", type=report_date, default=DEFAULT_START_DATE)
+    export_command.add_argument("--end", type=report_date, default=DEFAULT_END_DATE)
+    export_command.add_argument("--month", help="YYYYMM, for ri-completed")
+
+    commands.add_parser("menu", parents=[common], help="the interactive menu (the default)")
+    return parser.parse_args(argv)
+
+# Returns the process exit code
+def main(argv=None):
+    global use_report_cache
+    args = parse_args(argv)
+    if args.profile:
+        atexit.register(write_profile)
+    if args.no_cache:
+        use_report_cache = False
+
+    match args.command:
+        case "sync":
+            update_database()
+        case "reconcile":
+            reconcile_database(args.purge)
+        case "archive-replay":
+            if not replay_archive(max(args.processes, 1), args.rebuild):
+                return 2
+        case "webhook":
+            listen_for_webhooks(args.host, args.port, args.record, args.gap_fill_minutes)
+        case "webhook-replay":
+            secret = (get_settings().get("Webhook") or {}).get("Secret")
+            accepted = webhook.replay(args.path, args.url, secret, args.delay)
+            print(f"Replayed {accepted} payloads to {args.url}")
+        case "cycle-time":
+            get_development_cycle_time(args.start, args.end)
+        case "lead-time":
+            get_development_lead_time(args.start, args.end, csv_path=args.csv, interactive=False)
+        case "trend":
+            get_trend(args.start, args.end, args.step, csv_path=args.csv)
+        case "breakdown":
+            team_names = args.teams.split(",") if args.teams else None
+            get_breakdown(args.start, args.end, args.by, team_names, max(args.processes, 1), args.csv)
+        case "search":
+            search_tickets(" ".join(args.query), args.status, args.resolved_from, args.resolved_to,
+                           args.limit, args.csv)
+        case "ri-report":
+            if not get_monthly_ri_metrics(args.month, args.team):
+                return 2
+        case "export":
+            if args.source == "ri-completed" and args.month is None:
+                print("ri-completed needs --month YYYYMM")
+                return 2
+            try:
+                export_data(args.source, args.path, args.start, args.end, args.month)
+            except ValueError as e:
+                print(f"Error exporting: {e}")
+                return 2
+        case _:
+            menu()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,127 @@
+import codecs
+import json
+
+_WHITESPACE = " \t\n\r"
+_VALUE_END = _WHITESPACE + ",]}:"
+
+
+# Incrementally decodes a JSON object from an iterable of byte chunks (e.g.
+# requests' iter_content) and yields the elements of one array member one at
+# a time, so a search page never has to be held as one big str or object
+# tree. Every other top-level member ends up in `fields`; members that come
+# after the array are only there once iteration has finished.
+#
+#   page = StreamedObject(response.iter_content(65536), "issues")
+#   for issue in page:
+#       ...
+#   total = page.fields["total"]
+class StreamedObject:
+
+    def __init__(self, chunks, array_key):
+        self.chunks = iter(chunks)
+        self.array_key = array_key
+        self.fields = {}
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self):
+        self.skip_whitespace()
+        self.expect("{")
+        self.skip_whitespace()
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            self.skip_whitespace()
+            key = self.decode_value()
+            self.skip_whitespace()
+            self.expect(":")
+            self.skip_whitespace()
+            if key == self.array_key and self.peek() == "[":
+                yield from self.iter_array()
+            else:
+                self.fields[key] = self.decode_value()
+            self.skip_whitespace()
+            if self.next_char() == "}":
+                return
+            self.pos -= 1
+            self.expect(",")
+
+    def iter_array(self):
+        self.expect("[")
+        self.skip_whitespace()
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            self.skip_whitespace()
+            yield self.decode_value()
+            self.skip_whitespace()
+            separator = self.next_char()
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or ']' in '{self.array_key}', got {separator!r}")
+
+    # raw_decode needs the whole value in the buffer. When it isn't, read at
+    # least as much again as is already waiting before retrying, so a very
+    # large value is re-scanned a logarithmic number of times, not per chunk.
+    # A value also has to be followed by a delimiter, or a number split
+    # across chunks ("1" + ".5e3") would decode early.
+    def decode_value(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in _VALUE_END):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read(max(len(self.buffer) - self.pos, 1))
+
+    def skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return
+            self.read(1)
+
+    def peek(self):
+        if self.pos >= len(self.buffer):
+            self.read(1)
+        if self.pos >= len(self.buffer):
+            raise ValueError("Unexpected end of JSON document")
+        return self.buffer[self.pos]
+
+    def next_char(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, char):
+        if self.next_char() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos - 1}")
+
+    # Reads until at least `wanted` more characters are buffered (or the
+    # input runs out), dropping the part of the buffer already consumed
+    def read(self, wanted):
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        target = len(self.buffer) + wanted
+        pieces = [self.buffer]
+        buffered = len(self.buffer)
+        while buffered < target and not self.eof:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                pieces.append(self.text_decoder.decode(b"", final=True))
+            else:
+                text = self.text_decoder.decode(chunk)
+                pieces.append(text)
+                buffered += len(text)
+        self.buffer = "".join(pieces)
@@ -0,0 +1,374 @@
+# Report calculations over rows read from the local DB. Nothing in here talks
+# to Jira or sqlite directly; the DBControl methods hand rows in already
+# sorted the way each function expects.
+from array import array
+from datetime import timedelta
+
+
+# Groups consecutive rows by ticket id. Rows must already be ordered by ticket
+# so this only ever has to compare against the previous id.
+def group_by_ticket(rows, id_column='id'):
+    current_id = None
+    group = []
+    for row in rows:
+        if row[id_column] != current_id:
+            if group:
+                yield group
+            current_id = row[id_column]
+            group = []
+        group.append(row)
+    if group:
+        yield group
+
+
+# Point-in-time status reconstruction from the changelog. Answers "which
+# tickets were (or were not, with exclude=True) in one of `statuses` at each
+# of `instants`" in a single pass over the rows.
+#
+# Rows are one per status transition (ticket columns repeated) ordered by
+# ticket then transition time, with from_val/to_val/updated_ts of None for
+# tickets that never changed status. Needs: id, status, created_ts, from_val,
+# to_val, updated_ts. Instants are epoch seconds. Tickets are only counted
+# once created. Returns {instant: [first row of each matching ticket]}.
+def tickets_in_status_as_of(rows, instants, statuses, exclude=False):
+    instants = sorted(instants)
+    statuses = set(statuses)
+    result = {instant: [] for instant in instants}
+    for ticket_rows in group_by_ticket(rows):
+        ticket = ticket_rows[0]
+        transitions = [row for row in ticket_rows if row['updated_ts'] is not None]
+        # Before its first transition a ticket sits in the status it left;
+        # with no transitions at all it has always had its current status
+        status = transitions[0]['from_val'] if transitions else ticket['status']
+        next_transition = 0
+        for instant in instants:
+            if ticket['created_ts'] is None or ticket['created_ts'] > instant:
+                continue
+            while (next_transition < len(transitions)
+                   and transitions[next_transition]['updated_ts'] <= instant):
+                status = transitions[next_transition]['to_val']
+                next_transition += 1
+            if (status in statuses) != exclude:
+                result[instant].append(ticket)
+    return result
+
+
+PRESTART_STATUSES = ('Backlog', 'Selected for Development')
+PERCENTILES = (50, 85, 95)
+
+
+# Cycle time starts when an issue is moved to "In Progress" status and ends the
+# last time an issue is moved to "Done" status. Takes the rows from
+# DBControl.get_dev_ticket_status_updates (grouped by ticket, chronological
+# within a ticket) and makes a single pass over them, so it can be handed the
+# cursor directly. Durations are seconds in array('d') columns:
+#   resolved_keys / resolved_cycle_times  - tickets whose last move was to Done
+#   unresolved_keys / unresolved_ages     - started tickets, age as of now_ts
+#   time_in_status                        - {status: seconds per ticket}
+#   unstarted                             - tickets with no start transition
+def cycle_times(rows, now_ts, prestart_statuses=PRESTART_STATUSES):
+    result = new_cycle_partial()
+    for ticket in _ticket_cycles(rows, prestart_statuses):
+        _finish_ticket(ticket, now_ts, result)
+    return result
+
+
+# cycle_times split up by the values of `dimensions` (columns of the rows,
+# e.g. ('group_name', 'assignee')), in the same single pass. Returns
+# {tuple of dimension values: partial}, each partial shaped like the
+# cycle_times result. Partials for the same key from different slices of the
+# tickets combine with merge_cycle_partials
+def grouped_cycle_times(rows, now_ts, dimensions, prestart_statuses=PRESTART_STATUSES):
+    partials = {}
+    for ticket in _ticket_cycles(rows, prestart_statuses):
+        first_row = ticket['first_row']
+        key = tuple(first_row[dimension] for dimension in dimensions)
+        partial = partials.get(key)
+        if partial is None:
+            partial = partials[key] = new_cycle_partial()
+        _finish_ticket(ticket, now_ts, partial)
+    return partials
+
+
+def new_cycle_partial():
+    return {
+        'resolved_keys': [],
+        'resolved_cycle_times': array('d'),
+        'unresolved_keys': [],
+        'unresolved_ages': array('d'),
+        'time_in_status': {},
+        'unstarted': 0
+    }
+
+
+# Folds partial `other` into `into` (both shaped like the cycle_times
+# result) and returns `into`
+def merge_cycle_partials(into, other):
+    for column in ('resolved_keys', 'resolved_cycle_times', 'unresolved_keys', 'unresolved_ages'):
+        into[column].extend(other[column])
+    for status, seconds in other['time_in_status'].items():
+        if status not in into['time_in_status']:
+            into['time_in_status'][status] = array('d')
+        into['time_in_status'][status].extend(seconds)
+    into['unstarted'] += other['unstarted']
+    return into
+
+
+# Merges {key: partial} dicts (e.g. one per worker) into one
+def merge_grouped_partials(grouped_partials):
+    merged = {}
+    for partials in grouped_partials:
+        for key, partial in partials.items():
+            if key in merged:
+                merge_cycle_partials(merged[key], partial)
+            else:
+                merged[key] = partial
+    return merged
+
+
+# The numbers the breakdown report shows for one partial
+def summarize_cycle_partial(partial):
+    resolved = len(partial['resolved_cycle_times'])
+    unresolved = len(partial['unresolved_ages'])
+    return {
+        'resolved': resolved,
+        'unresolved': unresolved,
+        'unstarted': partial['unstarted'],
+        'completion_rate': resolved / (resolved + unresolved) if resolved + unresolved else None,
+        'cycle_time': summarize(partial['resolved_cycle_times']),
+        'unresolved_age': summarize(partial['unresolved_ages'])
+    }
+
+
+# Yields each ticket's cycle state (see cycle_times) once all its rows have
+# been read. first_row is the ticket's first row, for grouping
+def _ticket_cycles(rows, prestart_statuses):
+    prestart_statuses = frozenset(prestart_statuses)
+    seen_keys = set()
+    ticket = None
+    for row in rows:
+        jira_key = row['jira_key']
+        if ticket is None or ticket['jira_key'] != jira_key:
+            if ticket is not None:
+                yield ticket
+            # Check for out of order key
+            if jira_key in seen_keys:
+                raise ValueError(f"Ticket histories must be grouped by key: at {jira_key}")
+            seen_keys.add(jira_key)
+            ticket = {
+                'jira_key': jira_key,
+                'first_row': row,
+                # tickets that aren't "started" yet only count towards time in status
+                'started': row['status'] not in prestart_statuses,
+                'work_span': [None, None, False],
+                'last_update': row['created_ts'],
+                'last_entry': None,
+                'time_in_status': {}
+            }
+
+        updated = row['updated_ts']
+        # Check for out of chronological order entries within a key
+        if ticket['last_entry'] is not None and updated is not None and ticket['last_entry'] > updated:
+            raise ValueError(f"Ticket histories must be grouped by key and in chronological order: at {jira_key}")
+        if updated is not None:
+            ticket['last_entry'] = updated
+
+        field = row['field']
+        if field is None:
+            continue
+        if field == 'status':
+            from_val = row['from_val']
+            if ticket['last_update'] is not None:
+                ticket['time_in_status'][from_val] = (ticket['time_in_status'].get(from_val, 0)
+                                                      + updated - ticket['last_update'])
+            ticket['last_update'] = updated
+        _advance_work_span(ticket['work_span'], field, row['from_val'], row['to_val'], updated,
+                           prestart_statuses)
+    if ticket is not None:
+        yield ticket
+
+
+# The cycle time rules, applied one changelog row at a time. span is
+# [work_start, work_end, project_switch] and is updated in place: work starts
+# at the first move out of the pre-start statuses and ends at the last move
+# to Done (work_end goes back to None if the ticket moves on again).
+# cycle_times and trend_series both go through here so they can't disagree
+def _advance_work_span(span, field, from_val, to_val, updated, prestart_statuses):
+    # When tickets switch projects, we don't know what status they go into (thanks Jira API)
+    # so we keep track of the date, and on the next update we find, we check the 'from_val'
+    # to see where the ticket was. That way we know if this is truly the date work stated
+    if field == 'Key' or field == 'Workflow':
+        span[0] = updated
+        span[2] = True
+    elif field == 'status':
+        if span[2] and from_val in prestart_statuses and to_val not in prestart_statuses:
+            span[0] = updated
+            span[2] = False
+        elif not span[2] and to_val not in prestart_statuses and span[0] is None:
+            span[0] = updated
+        span[1] = updated if to_val == 'Done' else None
+
+
+def _finish_ticket(ticket, now_ts, result):
+    time_in_status = result['time_in_status']
+    for status, seconds in ticket['time_in_status'].items():
+        if status not in time_in_status:
+            time_in_status[status] = array('d')
+        time_in_status[status].append(seconds)
+    if not ticket['started']:
+        return
+    work_start, work_end = ticket['work_span'][:2]
+    if work_start is None:
+        result['unstarted'] += 1
+    elif work_end is not None:
+        result['resolved_keys'].append(ticket['jira_key'])
+        result['resolved_cycle_times'].append(work_end - work_start)
+    else:
+        result['unresolved_keys'].append(ticket['jira_key'])
+        result['unresolved_ages'].append(now_ts - work_start)
+
+
+# Count, mean and percentiles (linear interpolation) of a column of numbers
+def summarize(values, percentiles=PERCENTILES):
+    ordered = sorted(values)
+    summary = {'count': len(ordered), 'mean': None}
+    if ordered:
+        summary['mean'] = sum(ordered) / len(ordered)
+    for p in percentiles:
+        summary[f'p{p}'] = percentile(ordered, p)
+    return summary
+
+
+# p (0-100) percentile of an already sorted sequence
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+TREND_STEPS = ('week', 'month')
+
+# Statuses that don't count as work in progress (see DBControl.get_wip_at)
+WIP_EXCLUDED_STATUSES = ('Backlog', 'Selected for Development', 'Done')
+
+# R&I tickets in these statuses are no longer part of the backlog
+RI_CLOSED_STATUSES = ('Resolved', 'Done')
+
+# Done tickets with other resolutions (duplicates, won't do) aren't work that
+# was delivered, the same as the dev report filter
+DELIVERED_RESOLUTIONS = ('Done', 'Cannot Reproduce')
+
+
+# Window boundaries (epoch seconds) from start to end (aware datetimes),
+# a week or a calendar month apart. Monthly windows start on the 1st of
+# start's month. The last window is cut short at end
+def window_boundaries(start, end, step):
+    if step not in TREND_STEPS:
+        raise ValueError(f"Unknown step '{step}', use one of: {', '.join(TREND_STEPS)}")
+    if step == 'month':
+        start = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    boundaries = []
+    current = start
+    while current < end:
+        boundaries.append(int(current.timestamp()))
+        if step == 'week':
+            current += timedelta(days=7)
+        elif current.month == 12:
+            current = current.replace(year=current.year + 1, month=1)
+        else:
+            current = current.replace(month=current.month + 1)
+    boundaries.append(int(end.timestamp()))
+    return boundaries
+
+
+# Cycle time, throughput, WIP and the open R&I backlog for every window
+# between consecutive boundaries, from a single pass over the rows.
+#
+# Rows come from DBControl.get_trend_transitions: one per status (or Key /
+# Workflow) change, ordered by ticket then time, with dev and ri flags
+# saying which series the ticket belongs to. Each ticket is turned into
+# timestamped events (entering or leaving the R&I backlog, finishing with a
+# cycle time); the events are sorted once and swept against the boundaries,
+# so the cost barely depends on the number of windows. WIP is counted in SQL
+# from status_intervals and handed in as wip_counts, {window start: count}
+# (see DBControl.get_wip_at). Returns one dict per window:
+#   start / end       - epoch seconds
+#   throughput        - dev tickets whose last move to Done fell in the window
+#   cycle_time        - summarize() of those tickets' cycle times
+#   wip               - dev tickets in a WIP status at the start of the window
+#   ri_backlog        - R&I tickets not yet Resolved/Done at the start
+def trend_series(rows, boundaries, wip_counts, prestart_statuses=PRESTART_STATUSES,
+                 ri_closed=RI_CLOSED_STATUSES):
+    prestart_statuses = frozenset(prestart_statuses)
+    ri_closed = frozenset(ri_closed)
+    ri_events = []
+    done_events = []
+    for ticket_rows in group_by_ticket(rows):
+        ticket = ticket_rows[0]
+        created_ts = ticket['created_ts']
+        if created_ts is None:
+            continue
+        transitions = [row for row in ticket_rows if row['field'] == 'status']
+        status = transitions[0]['from_val'] if transitions else ticket['status']
+        if ticket['dev']:
+            work_start, work_end = _work_span(ticket_rows, prestart_statuses)
+            if (work_start is not None and work_end is not None
+                    and ticket['status'] not in prestart_statuses
+                    and ticket['resolution'] in DELIVERED_RESOLUTIONS):
+                done_events.append((work_end, work_end - work_start))
+        if ticket['ri']:
+            _add_state_events(ri_events, created_ts, status, transitions,
+                              lambda status: status not in ri_closed)
+
+    windows = [{'start': start, 'end': end, 'throughput': 0, 'cycle_time': None,
+                'wip': wip_counts.get(start, 0), 'ri_backlog': 0}
+               for start, end in zip(boundaries, boundaries[1:])]
+    if not windows:
+        return windows
+    ri_events.sort()
+    running = 0
+    next_event = 0
+    for window in windows:
+        while next_event < len(ri_events) and ri_events[next_event][0] <= window['start']:
+            running += ri_events[next_event][1]
+            next_event += 1
+        window['ri_backlog'] = running
+
+    done_events.sort()
+    next_event = 0
+    while next_event < len(done_events) and done_events[next_event][0] < windows[0]['start']:
+        next_event += 1
+    for window in windows:
+        cycle_times = array('d')
+        while next_event < len(done_events) and done_events[next_event][0] < window['end']:
+            cycle_times.append(done_events[next_event][1])
+            next_event += 1
+        window['throughput'] = len(cycle_times)
+        window['cycle_time'] = summarize(cycle_times)
+    return windows
+
+
+# +1 when a ticket starts matching in_state, -1 when it stops. Changes logged
+# before the ticket was created count from its creation
+def _add_state_events(events, created_ts, status, transitions, in_state):
+    inside = in_state(status)
+    if inside:
+        events.append((created_ts, 1))
+    for transition in transitions:
+        now_inside = in_state(transition['to_val'])
+        if now_inside != inside:
+            events.append((max(transition['updated_ts'], created_ts), 1 if now_inside else -1))
+            inside = now_inside
+
+
+# When work on a ticket started and (if it's finished) when it last moved to
+# Done, by the same rules as cycle_times (see _advance_work_span)
+def _work_span(ticket_rows, prestart_statuses):
+    span = [None, None, False]
+    for row in ticket_rows:
+        _advance_work_span(span, row['field'], row['from_val'], row['to_val'], row['updated_ts'],
+                           prestart_statuses)
+    return span[0], span[1]
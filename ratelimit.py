@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+DEFAULT_MAX_REQUESTS_PER_SECOND = 50.0
+MIN_REQUESTS_PER_SECOND = 0.5
+
+# Without a Retry-After hint, a 429 waits BACKOFF_BASE_SEC * 2^attempt
+# (capped), plus up to BACKOFF_JITTER of that again so the workers that were
+# all throttled together don't all come back at the same instant
+BACKOFF_BASE_SEC = 0.5
+BACKOFF_MAX_SEC = 60.0
+BACKOFF_JITTER = 0.25
+
+
+# Client-side token bucket shared by every thread making Jira requests.
+#
+# acquire() blocks until a request may go out. The rate adapts (AIMD): a 429
+# halves it (once per throttling episode, not once per in-flight request
+# that got the same 429), and every rate-worth of successful requests in a
+# row adds 10% (at least 1/s) back, up to max_rate. So we settle just under
+# what the server lets us do instead of tripping its limiter over and over. Server hints win over
+# the local estimate: Retry-After, or X-RateLimit-Remaining hitting 0 with
+# an X-RateLimit-Reset time, pauses every thread until then.
+class AdaptiveRateLimiter:
+
+    def __init__(self, rate=DEFAULT_REQUESTS_PER_SECOND,
+                 max_rate=DEFAULT_MAX_REQUESTS_PER_SECOND,
+                 min_rate=MIN_REQUESTS_PER_SECOND):
+        self.lock = threading.Lock()
+        self.max_rate = max(max_rate, min_rate)
+        self.min_rate = min_rate
+        self.rate = min(max(rate, min_rate), self.max_rate)
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.successes_in_a_row = 0
+        # Counters, see stats(). throttled_seconds is wall-clock time every
+        # thread was paused for. rate_wait_thread_seconds adds up the time
+        # each thread spent waiting for a token, so with several workers it
+        # is larger than the elapsed time (http.rate_limit_wait in the
+        # profile has the per-request timings)
+        self.requests = 0
+        self.throttled_responses = 0
+        self.throttled_seconds = 0.0
+        self.rate_wait_thread_seconds = 0.0
+
+    # Waits for a token (and for any server-imposed pause to end)
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                    self.rate_wait_thread_seconds += wait
+            time.sleep(wait)
+
+    def refill(self, now):
+        # Allow a burst of up to one second's worth of requests
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def on_success(self, headers):
+        with self.lock:
+            self.successes_in_a_row += 1
+            if self.successes_in_a_row >= self.rate:
+                self.successes_in_a_row = 0
+                self.rate = min(self.max_rate, self.rate + max(1.0, self.rate * 0.1))
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset = parse_reset(headers.get("X-RateLimit-Reset"))
+            if remaining is not None and reset is not None and _to_float(remaining) == 0:
+                self.block_for(reset)
+
+    # Called for a 429 (or a 503 carrying Retry-After). Returns the pause
+    # applied, in seconds
+    def on_throttled(self, headers, attempt):
+        with self.lock:
+            self.throttled_responses += 1
+            self.successes_in_a_row = 0
+            if time.monotonic() >= self.blocked_until:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+            delay = parse_retry_after(headers.get("Retry-After"))
+            if delay is None:
+                delay = parse_reset(headers.get("X-RateLimit-Reset"))
+            if delay is None:
+                delay = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * (2 ** attempt))
+            delay += random.uniform(0, delay * BACKOFF_JITTER)
+            self.block_for(delay)
+            return delay
+
+    # Pauses every thread for `delay` seconds from now. Only the part that
+    # extends an existing pause is added to throttled_seconds
+    def block_for(self, delay):
+        now = time.monotonic()
+        until = now + delay
+        if until > self.blocked_until:
+            self.throttled_seconds += until - max(self.blocked_until, now)
+            self.blocked_until = until
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "throttled_responses": self.throttled_responses,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "rate_wait_thread_seconds": round(self.rate_wait_thread_seconds, 3),
+                "requests_per_second": round(self.rate, 3)
+            }
+
+
+# Retry-After is either a number of seconds or an HTTP date
+def parse_retry_after(value):
+    if value is None:
+        return None
+    seconds = _to_float(value)
+    if seconds is not None:
+        return max(seconds, 0.0)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+# Jira sends X-RateLimit-Reset as an ISO timestamp. Seconds until then
+def parse_reset(value):
+    if value is None:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=timezone.utc)
+    return max((reset_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
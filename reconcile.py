@@ -0,0 +1,99 @@
+import stats
+
+# Finds tickets in the local DB that no longer exist in Jira (deleted, or
+# moved to a project we don't sync) and tombstones or purges them. The sync
+# only ever hears about issues that still match its JQL, so without this
+# they would count in the reports forever.
+#
+# Jira is asked for ids only, which are collected into an IdBitmap: a bit per
+# possible id, so a project with a million issues (ids up into the tens of
+# millions) costs a few MB at most. The local ids are then streamed past it
+# in id order and anything not in the bitmap is a candidate. Candidates are
+# looked up again one last time before anything is touched, so an issue
+# created or re-ranked while paging can't be mistaken for a deleted one.
+
+
+# Set of non-negative integers stored as a growable bitmap
+class IdBitmap:
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, value):
+        byte, bit = divmod(value, 8)
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(max(byte + 1, 2 * len(self.bits)) - len(self.bits)))
+        if not self.bits[byte] & (1 << bit):
+            self.bits[byte] |= 1 << bit
+            self.count += 1
+
+    def __contains__(self, value):
+        byte, bit = divmod(value, 8)
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << bit))
+
+    def __len__(self):
+        return self.count
+
+
+# Reconciles one project. With purge, the missing tickets (and ones already
+# tombstoned) are deleted along with their history; otherwise they are
+# tombstoned. Returns {"local", "remote", "deleted", "moved"} counts
+def reconcile_project(jira, db, project_name, purge=False):
+    remote = IdBitmap()
+    with stats.timer("reconcile.remote_ids"):
+        for issue_id in jira.iter_issue_ids(f"project = {project_name}"):
+            remote.add(issue_id)
+    result = {"local": 0, "remote": len(remote), "deleted": 0, "moved": 0}
+
+    with stats.timer("reconcile.diff"):
+        local_ids = db.iter_ticket_ids(project_name, include_deleted=purge)
+        candidates = []
+        for (ticket_id,) in local_ids:
+            result["local"] += 1
+            if ticket_id not in remote:
+                candidates.append(ticket_id)
+    if not candidates:
+        return result
+    if len(remote) == 0:
+        # Far more likely a typo in the project name or lost permissions
+        # than every issue having been deleted
+        print(f"[{project_name}] Jira returned no issues, skipping reconciliation")
+        return result
+
+    with stats.timer("reconcile.confirm"):
+        current_projects = jira.get_issue_projects(candidates)
+    gone = []
+    for ticket_id in candidates:
+        current_project = current_projects.get(ticket_id)
+        if current_project is None:
+            result["deleted"] += 1
+            gone.append(ticket_id)
+        elif current_project not in jira.project_names:
+            result["moved"] += 1
+            gone.append(ticket_id)
+        # Otherwise it's still here (or moved to another synced project,
+        # whose sync picks it up under its new key)
+
+    if gone:
+        with stats.timer("reconcile.apply"):
+            if purge:
+                db.purge_tickets(gone)
+            else:
+                db.tombstone_tickets(gone)
+    stats.count("reconcile.removed", len(gone))
+    return result
+
+
+# Reconciles every project the JiraApi syncs
+def reconcile(jira, db, purge=False):
+    db.recover_bulk_load()
+    results = {}
+    for project_name in jira.project_names:
+        result = reconcile_project(jira, db, project_name, purge)
+        action = "purged" if purge else "tombstoned"
+        print(f"[{project_name}] {result['local']} local, {result['remote']} in Jira: "
+              f"{result['deleted'] + result['moved']} {action} "
+              f"({result['deleted']} deleted, {result['moved']} moved out)")
+        results[project_name] = result
+    return results
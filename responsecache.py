@@ -0,0 +1,150 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds to keep a response per endpoint (the part of the URL after the
+# API root, up to any id). 0 means never cache. Anything not listed uses
+# the "default" entry. Overridden by "TTLSeconds" in the cache settings
+DEFAULT_TTLS = {
+    "serverInfo": 24 * 60 * 60,
+    "search": 0,
+    "changelog": 0,
+    "issue": 0,
+    "default": 0
+}
+
+# Answers from these are written into jira.db or decide which tickets
+# reconcile marks deleted, so a stale copy would end up as wrong data.
+# They can't be given a TTL
+UNCACHEABLE_ENDPOINTS = ("search", "changelog", "issue")
+
+
+# Opt-in on-disk cache of Jira responses, keyed on method, URL and payload.
+# Stored in its own sqlite file so it can be deleted at any time without
+# touching jira.db. Entries expire by TTL, and the least recently used ones
+# are evicted once the stored bodies go over max_bytes. Safe to share
+# between the sync worker threads.
+class ResponseCache:
+
+    def __init__(self, path, api_root, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        self.api_root = api_root
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        for endpoint in UNCACHEABLE_ENDPOINTS:
+            if (self.ttls.get(endpoint) or 0) > 0:
+                raise ValueError(f"Response cache TTL for '{endpoint}' must be 0, its responses can't be cached")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, autocommit=True)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses("
+                          "key TEXT PRIMARY KEY, "
+                          "endpoint TEXT, "
+                          "status INTEGER, "
+                          "headers TEXT, "
+                          "body BLOB, "
+                          "size INTEGER, "
+                          "stored_at REAL, "
+                          "expires_at REAL, "
+                          "last_access REAL);")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access);")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses;").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    # Builds a cache from the "ResponseCache" block of jira_connection.json,
+    # or returns None when it is missing or not enabled
+    @classmethod
+    def from_settings(cls, settings, api_root):
+        if not settings or not settings.get("Enabled", False):
+            return None
+        return cls(
+            settings.get("Path", "jira_cache.db"),
+            api_root,
+            max_bytes=int(float(settings.get("MaxMegabytes", DEFAULT_MAX_BYTES / 1024 / 1024)) * 1024 * 1024),
+            ttls=settings.get("TTLSeconds"))
+
+    def endpoint(self, url):
+        path = url[len(self.api_root):] if url.startswith(self.api_root) else url
+        return path.split("?")[0].split("/")[0]
+
+    def key(self, method, url, payload):
+        canonical = json.dumps([method.upper(), url, payload], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    # The cached response, or None on a miss or an expired entry
+    def get(self, method, url, payload):
+        key = self.key(method, url, payload)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, headers, body, size, expires_at FROM responses WHERE key = ?;",
+                (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            status, headers, body, size, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self.conn.execute("DELETE FROM responses WHERE key = ?;", (key,))
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?;", (now, key))
+            self.hits += 1
+        return build_response(url, status, json.loads(headers), body)
+
+    # Stores a response if its endpoint's TTL allows it
+    def put(self, method, url, payload, response):
+        ttl = self.ttls.get(self.endpoint(url), self.ttls["default"])
+        if ttl is None or ttl <= 0:
+            return
+        body = response.content
+        if len(body) > self.max_bytes:
+            return
+        now = time.time()
+        expires_at = now + ttl
+        key = self.key(method, url, payload)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?;", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, endpoint, status, headers, body, size, stored_at, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                (key, self.endpoint(url), response.status_code, json.dumps(dict(response.headers)),
+                 body, len(body), now, expires_at, now))
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            self.evict()
+
+    # Drops least recently used entries until we're back under max_bytes
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            victims = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100;").fetchall()
+            if not victims:
+                self.total_bytes = 0
+                return
+            for key, size in victims:
+                self.conn.execute("DELETE FROM responses WHERE key = ?;", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    return
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
+
+
+def build_response(url, status, headers, body):
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers) or "utf-8"
+    response._content = body
+    return response
@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+DEFAULT_STATS_FILE = "jira_stats.json"
+
+
+# Counters and timers for working out where a sync or a report spends its
+# time. One collector is shared by the whole process (see `collector` below)
+# and every method is safe to call from the sync worker threads.
+#
+#   counters - running totals (bytes, issues, retries...)
+#   timers   - name -> count / total / max seconds
+#   values   - last value set for a name (e.g. the rate limiter's stats)
+#   pages    - one record per page per sync stage, in the order they finished
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now(timezone.utc)
+            self.started_clock = time.perf_counter()
+            self.counters = {}
+            self.timers = {}
+            self.values = {}
+            self.pages = []
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def page(self, stage, **fields):
+        with self.lock:
+            self.pages.append({"stage": stage, **fields})
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started": self.started.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+                "elapsed_seconds": round(time.perf_counter() - self.started_clock, 6),
+                "counters": dict(self.counters),
+                "timers": {name: {
+                    "count": count,
+                    "total_seconds": round(total, 6),
+                    "mean_seconds": round(total / count, 6),
+                    "max_seconds": round(longest, 6)
+                } for name, (count, total, longest) in sorted(self.timers.items())},
+                "values": dict(self.values),
+                "pages": list(self.pages)
+            }
+
+    def dump(self, path=DEFAULT_STATS_FILE):
+        with open(path, "w", encoding="utf-8") as stats_file:
+            json.dump(self.snapshot(), stats_file, indent=2, default=str)
+
+    # Human readable version of snapshot(), without the per-page records
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = [f"Profile ({snapshot['elapsed_seconds']:.1f}s elapsed)"]
+        if snapshot["timers"]:
+            lines.append(f"  {'timer':<28}{'count':>8}{'total s':>12}{'mean ms':>12}{'max ms':>12}")
+            for name, timer in snapshot["timers"].items():
+                lines.append(f"  {name:<28}{timer['count']:>8}{timer['total_seconds']:>12.3f}"
+                             f"{timer['mean_seconds'] * 1000:>12.1f}{timer['max_seconds'] * 1000:>12.1f}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"  {name}: {value}")
+        for name, value in sorted(snapshot["values"].items()):
+            lines.append(f"  {name}: {value}")
+        return "\n".join(lines)
+
+
+# Wraps an iterator and adds the time spent waiting on each next() to
+# timing[key], for work (like streaming decode) that happens lazily inside
+# someone else's loop
+def timed_iter(iterable, timing, key):
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timing[key] = timing.get(key, 0.0) + time.perf_counter() - started
+            return
+        timing[key] = timing.get(key, 0.0) + time.perf_counter() - started
+        yield item
+
+
+collector = Stats()
+count = collector.count
+record = collector.record
+timer = collector.timer
+page = collector.page
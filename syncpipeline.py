@@ -0,0 +1,433 @@
+import dbcontrol
+import json
+import queue
+import stats
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# How many decoded pages / transformed batches may wait between stages. Keeps
+# memory bounded when the network is faster than the SQLite writer.
+DEFAULT_QUEUE_SIZE = 4
+
+# Issues are streamed out of each response and handed to the transform stage
+# in chunks of this many, so no stage ever holds a whole decoded page
+DECODE_CHUNK_SIZE = 50
+
+_DONE = object()
+
+
+# Runs a search sync as overlapping stages connected by bounded queues:
+#
+#   producers (HTTP + streaming json decode) -> transform thread -> writer (caller)
+#
+# Producers queue ("issues", page_id, [issue, ...]) chunks as they decode
+# them, then ("end", page_id, page_key) once a page is complete. The
+# transform stage turns the chunks into rows and passes whole pages on to the
+# writer, keyed by page_key. Page ids and keys travel as (pipeline, id)
+# pairs so several pipelines can share the stages (see MultiSyncPipeline).
+#
+# The writer is the thread that calls run() because the sqlite connection
+# can't be shared between threads. Every page is committed together with
+# whatever checkpoint metadata the subclass hands back, so a sync that dies
+# part way through picks up from the last page that made it to disk.
+# Subclasses supply the producers (start_producers) and the checkpoint
+# (page_metadata).
+class SyncPipeline:
+
+    def __init__(self, jira, db, page_size=1000, queue_size=DEFAULT_QUEUE_SIZE, name=None):
+        self.jira = jira
+        self.db = db
+        self.name = name
+        self.page_size = page_size
+        self.decoded_pages = queue.Queue(maxsize=queue_size * (page_size // DECODE_CHUNK_SIZE + 1))
+        self.transformed_pages = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.total = 0
+        self.records_received = 0
+
+    def run(self):
+        self.prepare()
+        transformer = threading.Thread(target=self.transform_worker, daemon=True)
+        transformer.start()
+        try:
+            producers = self.start_producers()
+            producer_watch = threading.Thread(
+                target=self.close_when_done, args=(producers, self.decoded_pages), daemon=True)
+            producer_watch.start()
+            self.write_worker()
+        finally:
+            self.stop_event.set()
+            # Unblock anything waiting on a full queue so the threads exit
+            self.drain(self.decoded_pages)
+            self.drain(self.transformed_pages)
+        transformer.join()
+        self.finish()
+        return self.records_received
+
+    # Runs on the writer thread before anything starts; the place to read
+    # from the DB, since producers run on threads of their own
+    def prepare(self):
+        pass
+
+    def start_producers(self):
+        raise NotImplementedError()
+
+    def page_metadata(self, page_key, issue_count):
+        raise NotImplementedError()
+
+    def finish(self):
+        pass
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=self.produce, args=(target, *args), daemon=True)
+        thread.start()
+        return thread
+
+    # Wraps a producer so failures travel down the pipeline to the writer
+    def produce(self, target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            self.put(self.decoded_pages, e)
+
+    # Streams issues into the decode queue in chunks. Returns how many.
+    # `timing` is the page's JiraApi.stream_search_page timing; whatever time
+    # pulling issues took beyond reading the socket is the decode time
+    def queue_issues(self, page_id, issues, timing=None):
+        timing = {} if timing is None else timing
+        issue_count = 0
+        chunk = []
+        for issue in stats.timed_iter(issues, timing, "fetch"):
+            chunk.append(issue)
+            if len(chunk) >= DECODE_CHUNK_SIZE:
+                self.queue_chunk(page_id, chunk, timing)
+                issue_count += len(chunk)
+                chunk = []
+        if chunk:
+            self.queue_chunk(page_id, chunk, timing)
+            issue_count += len(chunk)
+        decode_seconds = max(timing["fetch"] - timing.get("read", 0.0), 0.0)
+        stats.record("sync.decode", decode_seconds)
+        stats.count("sync.issues_fetched", issue_count)
+        stats.page("fetch", pipeline=self.name, page=page_id, issues=issue_count, bytes=timing.get("bytes"),
+                   request_seconds=timing.get("request"), read_seconds=timing.get("read"),
+                   decode_seconds=decode_seconds, backfill_seconds=timing.get("backfill", 0.0),
+                   queue_wait_seconds=timing.get("queue_wait", 0.0))
+        return issue_count
+
+    # Truncated changelogs are completed here, a chunk at a time, so the
+    # extra requests run on the producer threads alongside the searches. The
+    # completed chunk is what goes in the archive, if there is one
+    def queue_chunk(self, page_id, chunk, timing):
+        started = time.perf_counter()
+        backfilled = self.jira.backfill_truncated_changelogs(chunk)
+        backfill_seconds = time.perf_counter() - started
+        if backfilled:
+            stats.count("sync.changelogs_backfilled", backfilled)
+            stats.record("sync.changelog_backfill", backfill_seconds)
+        if self.jira.archive is not None:
+            with stats.timer("sync.archive"):
+                self.jira.archive.append(chunk)
+        started = time.perf_counter()
+        self.put(self.decoded_pages, ("issues", (self, page_id), chunk))
+        queue_wait_seconds = time.perf_counter() - started
+        stats.record("sync.decoded_queue_wait", queue_wait_seconds)
+        timing["backfill"] = timing.get("backfill", 0.0) + backfill_seconds
+        timing["queue_wait"] = timing.get("queue_wait", 0.0) + queue_wait_seconds
+
+    def end_page(self, page_id, page_key):
+        self.put(self.decoded_pages, ("end", (self, page_id), (self, page_key)))
+
+    def transform_worker(self):
+        try:
+            # page_id -> [issue count, ticket rows, history rows, seconds]
+            pages = {}
+            while True:
+                item = self.get(self.decoded_pages)
+                if item is None:
+                    return
+                if item is _DONE or isinstance(item, BaseException):
+                    self.put(self.transformed_pages, item)
+                    return
+                kind, page_id, payload = item
+                page = pages.setdefault(page_id, [0, [], [], 0.0])
+                if kind == "issues":
+                    started = time.perf_counter()
+                    ticket_rows, history_rows = self.db.transform_tickets(payload)
+                    page[3] += time.perf_counter() - started
+                    page[0] += len(payload)
+                    page[1].extend(ticket_rows)
+                    page[2].extend(history_rows)
+                else:
+                    del pages[page_id]
+                    issue_count, ticket_rows, history_rows, transform_seconds = page
+                    stats.record("sync.transform", transform_seconds)
+                    stats.page("transform", pipeline=page_id[0].name, page=page_id[1], issues=issue_count,
+                               history_rows=len(history_rows), seconds=transform_seconds)
+                    self.put(self.transformed_pages, (payload, issue_count, ticket_rows, history_rows))
+        except BaseException as e:
+            self.put(self.transformed_pages, e)
+
+    def write_worker(self):
+        while True:
+            item = self.transformed_pages.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            (pipeline, page_key), issue_count, ticket_rows, history_rows = item
+            started = time.perf_counter()
+            self.db.write_tickets(ticket_rows, history_rows,
+                                  metadata=pipeline.page_metadata(page_key, issue_count))
+            write_seconds = time.perf_counter() - started
+            stats.record("sync.write", write_seconds)
+            stats.page("write", pipeline=pipeline.name, page=page_key, issues=issue_count,
+                       history_rows=len(history_rows), seconds=write_seconds)
+            pipeline.records_received += issue_count
+            self.report_progress(pipeline)
+
+    def report_progress(self, pipeline):
+        print(f"Stored {pipeline.records_received} of {pipeline.total} "
+              f"({(pipeline.records_received/max(pipeline.total, 1)):.0%})")
+
+    def close_when_done(self, threads, target_queue):
+        for thread in threads:
+            thread.join()
+        self.put(target_queue, _DONE)
+
+    def put(self, target_queue, item):
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    # Returns None instead of blocking forever once the pipeline is stopping
+    def get(self, target_queue):
+        while not self.stop_event.is_set():
+            try:
+                return target_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def drain(self, target_queue):
+        try:
+            while True:
+                target_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+# Full download: once the first page tells us the total, a bounded pool of
+# workers fetches the remaining startAt offsets in parallel. The checkpoint is
+# the end of the contiguous run of pages on disk, stored against the jql so a
+# different query never resumes from it.
+class OffsetSyncPipeline(SyncPipeline):
+
+    def __init__(self, jira, db, jql, checkpoint_key, max_workers=4, **kwargs):
+        super().__init__(jira, db, **kwargs)
+        self.jql = jql
+        self.checkpoint_key = checkpoint_key
+        self.max_workers = max(max_workers, 1)
+        self.offset_lock = threading.Lock()
+        self.next_offsets = None
+        self.finished_pages = {}
+        self.started = datetime.now(timezone.utc)
+        self.start_offset = 0
+        # Everything before this offset is on disk
+        self.committed_offset = 0
+
+    def prepare(self):
+        self.start_offset = self.load_checkpoint()
+        self.committed_offset = self.start_offset
+
+    def start_producers(self):
+        start_offset = self.start_offset
+        if start_offset > 0:
+            print(f"Resuming interrupted sync at record {start_offset}")
+
+        self.records_received = start_offset
+        # The first page is read here, while the transform stage is already
+        # draining the queue, because the total decides which offsets to fetch
+        first_page = self.jira.stream_search_page(self.jql, start_offset, self.page_size)
+        issue_count = self.queue_issues(start_offset, first_page, first_page.timing)
+        self.total = int(first_page.fields["total"])
+        if issue_count == 0:
+            return []
+        # The server may cap maxResults below what we asked for. Set before
+        # the page is ended, as the writer advances the checkpoint by it
+        self.page_size = max(int(first_page.fields.get("maxResults") or self.page_size), 1)
+        self.end_page(start_offset, start_offset)
+        self.next_offsets = iter(range(start_offset + self.page_size, self.total, self.page_size))
+        return [self.start_thread(self.fetch_worker) for i in range(self.max_workers)]
+
+    def load_checkpoint(self):
+        checkpoint = self.db.get_metadata(self.checkpoint_key)
+        if checkpoint is None:
+            return 0
+        checkpoint = json.loads(checkpoint)
+        if checkpoint.get("jql") != self.jql:
+            # Different query, the stored offsets mean nothing for this one
+            return 0
+        # Anything changed since the interrupted run started has to be picked
+        # up by the next incremental sync, so keep its start time
+        self.started = datetime.strptime(checkpoint["started"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        return int(checkpoint["offset"])
+
+    def claim_offset(self):
+        with self.offset_lock:
+            return next(self.next_offsets, None)
+
+    def fetch_worker(self):
+        while not self.stop_event.is_set():
+            offset = self.claim_offset()
+            if offset is None:
+                return
+            page = self.jira.stream_search_page(self.jql, offset, self.page_size)
+            self.queue_issues(offset, page, page.timing)
+            self.end_page(offset, offset)
+
+    def page_metadata(self, offset, issue_count):
+        self.finished_pages[offset] = issue_count
+        # Pages arrive out of order; only advance the checkpoint over the
+        # run of pages that are all on disk
+        while self.finished_pages.pop(self.committed_offset, None) is not None:
+            self.committed_offset += self.page_size
+        return {self.checkpoint_key: json.dumps({
+            "jql": self.jql,
+            "offset": min(self.committed_offset, self.total),
+            "total": self.total,
+            "started": self.started.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+            "updated": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+        })}
+
+    def finish(self):
+        self.db.delete_metadata(self.checkpoint_key)
+
+
+# Incremental sync from a high-watermark. Issues are requested in `updated`
+# order and paged with a keyset cursor on `updated` rather than startAt, so
+# tickets that change mid-sync move to the end of the result set instead of
+# shifting the pages under us. The watermark is the cursor: it is committed
+# with every page, which makes the incremental sync resumable as well.
+#
+# JQL dates only have minute precision, so each request restarts at the
+# minute of the last issue seen and skips the ids already stored from that
+# minute. Only if a whole page falls inside one minute do we fall back to
+# startAt within that minute.
+class WatermarkSyncPipeline(SyncPipeline):
+
+    def __init__(self, jira, db, project_name, watermark, overlap, **kwargs):
+        kwargs.setdefault("name", project_name)
+        super().__init__(jira, db, **kwargs)
+        self.project_name = project_name
+        self.watermark = watermark
+        self.overlap = overlap
+
+    def start_producers(self):
+        return [self.start_thread(self.cursor_worker)]
+
+    def jql(self, lower_bound):
+        return (f'project = "{self.project_name}" AND '
+                f'updated >= "{self.jira.to_server_time(lower_bound).strftime("%Y-%m-%d %H:%M")}" '
+                'ORDER BY updated ASC, key ASC')
+
+    def cursor_worker(self):
+        lower_bound = floor_minute(self.watermark - self.overlap)
+        seen_at_lower_bound = set()
+        start_at = 0
+        page_id = 0
+        while not self.stop_event.is_set():
+            page = self.jira.stream_search_page(self.jql(lower_bound), start_at, self.page_size)
+            # (id, updated) of everything on the page, for moving the cursor
+            page_issues = []
+            page_watermark = None
+
+            def fresh_issues():
+                nonlocal page_watermark
+                for issue in page:
+                    updated = issue_updated(issue)
+                    page_issues.append((issue["id"], updated))
+                    if issue["id"] not in seen_at_lower_bound:
+                        page_watermark = updated
+                        yield issue
+
+            if self.queue_issues(page_id, fresh_issues(), page.timing) > 0:
+                self.end_page(page_id, page_watermark)
+            page_id += 1
+            if self.total == 0:
+                self.total = int(page.fields["total"])
+            if len(page_issues) < max(int(page.fields.get("maxResults") or self.page_size), 1):
+                return
+            last_minute = floor_minute(page_issues[-1][1])
+            if last_minute > lower_bound:
+                lower_bound = last_minute
+                seen_at_lower_bound = {issue_id for issue_id, updated in page_issues
+                                       if floor_minute(updated) == last_minute}
+                start_at = 0
+            else:
+                # Whole page inside one minute, the cursor can't move
+                seen_at_lower_bound.update(issue_id for issue_id, updated in page_issues)
+                start_at += len(page_issues)
+
+    def page_metadata(self, page_watermark, issue_count):
+        if page_watermark > self.watermark:
+            self.watermark = page_watermark
+        return {dbcontrol.watermark_key(self.project_name):
+                self.watermark.strftime("%Y-%m-%dT%H:%M:%S.%f%z")}
+
+
+# Runs several pipelines (e.g. one per project) through a single transform
+# thread and a single writer, so every project lands in the same DB through
+# one connection while their producers fetch at the same time. Each child
+# keeps its own producers, worker budget and checkpoint; they just share the
+# queues. The children's start_producers run on threads of their own since
+# OffsetSyncPipeline reads its first page there.
+class MultiSyncPipeline(SyncPipeline):
+
+    def __init__(self, db, pipelines, queue_size=DEFAULT_QUEUE_SIZE):
+        page_size = max(pipeline.page_size for pipeline in pipelines)
+        super().__init__(None, db, page_size=page_size,
+                         queue_size=queue_size * len(pipelines), name="all")
+        self.pipelines = pipelines
+        for pipeline in pipelines:
+            pipeline.decoded_pages = self.decoded_pages
+            pipeline.transformed_pages = self.transformed_pages
+            pipeline.stop_event = self.stop_event
+
+    def prepare(self):
+        for pipeline in self.pipelines:
+            pipeline.prepare()
+
+    def start_producers(self):
+        return [self.start_thread(self.run_child, pipeline) for pipeline in self.pipelines]
+
+    def run_child(self, pipeline):
+        for thread in pipeline.start_producers():
+            thread.join()
+
+    def report_progress(self, pipeline):
+        self.records_received = sum(child.records_received for child in self.pipelines)
+        self.total = sum(child.total for child in self.pipelines)
+        print(f"[{pipeline.name}] Stored {pipeline.records_received} of {pipeline.total} "
+              f"- all projects {self.records_received} of {self.total} "
+              f"({(self.records_received/max(self.total, 1)):.0%})")
+
+    def run(self):
+        super().run()
+        return sum(child.records_received for child in self.pipelines)
+
+    def finish(self):
+        for pipeline in self.pipelines:
+            pipeline.finish()
+
+
+def issue_updated(issue):
+    return datetime.strptime(issue["fields"]["updated"], "%Y-%m-%dT%H:%M:%S.%f%z").astimezone(timezone.utc)
+
+
+def floor_minute(instant):
+    return instant - timedelta(seconds=instant.second, microseconds=instant.microsecond)
@@ -0,0 +1,314 @@
+import hashlib
+import hmac
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dbcontrol
+import stats
+
+# Receives Jira issue webhooks and applies them to the local DB as they come
+# in, so it stays seconds-fresh without polling the search API. Register
+# http://<host>:<port>/webhook in Jira (System > WebHooks) for the issue
+# created, updated and deleted events.
+#
+# HTTP threads only parse and queue the events. The thread running run()
+# (the one that owns the sqlite connection) takes them off in micro-batches
+# and writes each batch through DBControl.store_tickets, so webhooks land
+# exactly like synced issues. Deletes are tombstoned as reconcile does. Every
+# gap_fill_seconds it also runs the normal incremental sync to pick up
+# anything a missed or failed delivery left out.
+#
+# Settings, under "Webhook" in jira_connection.json (all optional):
+#   "Host", "Port"       - where to listen (127.0.0.1:8765)
+#   "Secret"             - the webhook's secret in Jira; deliveries without a
+#                          matching X-Hub-Signature are refused
+#   "GapFillMinutes"     - minutes between safety-net syncs (15, 0 for never)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_GAP_FILL_MINUTES = 15
+WEBHOOK_PATH = "/webhook"
+
+# A batch is written once it has this many events or its oldest event has
+# waited this long, whichever comes first
+BATCH_MAX_EVENTS = 200
+BATCH_MAX_SECONDS = 1.0
+
+ISSUE_EVENTS = ("jira:issue_created", "jira:issue_updated")
+DELETE_EVENTS = ("jira:issue_deleted",)
+
+
+class WebhookServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    # record_path appends every accepted payload to a JSON lines file, for
+    # replaying later (see replay)
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, secret=None, record_path=None):
+        super().__init__((host, port), WebhookHandler)
+        self.secret = secret.encode("utf-8") if secret else None
+        self.events = queue.Queue()
+        self.record_lock = threading.Lock()
+        self.record_file = open(record_path, "a", encoding="utf-8") if record_path else None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_port}{WEBHOOK_PATH}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.record_file is not None:
+            self.record_file.close()
+
+    def signature_ok(self, body, signature):
+        if self.secret is None:
+            return True
+        expected = "sha256=" + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        return signature is not None and hmac.compare_digest(expected, signature)
+
+    def accept(self, payload):
+        if self.record_file is not None:
+            with self.record_lock:
+                self.record_file.write(json.dumps(payload) + "\n")
+                self.record_file.flush()
+        self.events.put(payload)
+        stats.count("webhook.events")
+
+    # The client giving up on a connection isn't worth a traceback
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.path.split("?")[0] != WEBHOOK_PATH:
+            return self.send_status(404)
+        if not self.server.signature_ok(body, self.headers.get("X-Hub-Signature")):
+            return self.send_status(401)
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return self.send_status(400)
+        if not isinstance(payload, dict) or payload.get("webhookEvent") not in ISSUE_EVENTS + DELETE_EVENTS:
+            # Other events (comments, sprints...) aren't stored; say yes so
+            # Jira doesn't keep retrying them
+            stats.count("webhook.ignored")
+            return self.send_status(204)
+        self.server.accept(payload)
+        self.send_status(204)
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+# The search API shape store_tickets expects, from an issue webhook. The
+# webhook carries the issue's current fields and just the one changelog
+# entry for this update, whose id is the same one the search API reports,
+# so a later sync upserts over it rather than duplicating it
+def to_search_issue(payload):
+    issue = dict(payload["issue"])
+    histories = []
+    changelog = payload.get("changelog")
+    if changelog and changelog.get("items"):
+        histories.append({
+            "id": str(changelog["id"]),
+            "author": payload.get("user"),
+            "created": jira_time(payload.get("timestamp")),
+            "items": changelog["items"]
+        })
+    issue["changelog"] = {"startAt": 0, "maxResults": len(histories), "total": len(histories),
+                          "histories": histories}
+    return issue
+
+
+# Webhook timestamps are epoch milliseconds
+def jira_time(timestamp_ms):
+    if timestamp_ms is None:
+        instant = datetime.now(timezone.utc)
+    else:
+        instant = datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc)
+    return instant.strftime("%Y-%m-%dT%H:%M:%S.") + f"{instant.microsecond // 1000:03d}+0000"
+
+
+def issue_project(issue):
+    project = (issue.get("fields") or {}).get("project")
+    if isinstance(project, dict) and project.get("key"):
+        return project["key"]
+    return str(issue.get("key", "")).rsplit("-", 1)[0]
+
+
+# Folds a batch of payloads into the issues to upsert and the ids to
+# tombstone. Jira retries and reorders deliveries, so several updates to one
+# issue keep the fields of the most recently updated one (plus every
+# changelog entry), and a delete wins whatever order it came in, as nothing
+# updates an issue after it is deleted. Stale updates from earlier batches
+# are caught by the ticket upsert (see DBControl._ticket_upsert_sql)
+def collapse_batch(payloads, project_names=None):
+    issues = {}
+    deleted = {}
+    for payload in payloads:
+        issue = payload.get("issue") or {}
+        if "id" not in issue:
+            continue
+        if project_names is not None and issue_project(issue) not in project_names:
+            stats.count("webhook.other_project")
+            continue
+        issue_id = str(issue["id"])
+        if payload["webhookEvent"] in DELETE_EVENTS:
+            issues.pop(issue_id, None)
+            deleted[issue_id] = True
+            continue
+        if issue_id in deleted:
+            stats.count("webhook.stale")
+            continue
+        search_issue = to_search_issue(payload)
+        if issue_id in issues:
+            earlier = issues[issue_id]
+            if issue_updated_ts(search_issue) < issue_updated_ts(earlier):
+                stats.count("webhook.stale")
+                earlier, search_issue = search_issue, earlier
+            histories = {entry["id"]: entry for entry in earlier["changelog"]["histories"]}
+            histories.update((entry["id"], entry) for entry in search_issue["changelog"]["histories"])
+            search_issue["changelog"]["histories"] = list(histories.values())
+            search_issue["changelog"]["total"] = len(histories)
+            search_issue["changelog"]["maxResults"] = len(histories)
+        issues[issue_id] = search_issue
+    return list(issues.values()), list(deleted)
+
+
+# For ordering updates to the same issue; 0 when the payload has no time
+def issue_updated_ts(issue):
+    return dbcontrol.to_epoch((issue.get("fields") or {}).get("updated")) or 0
+
+
+# Writes queued webhooks to the DB until interrupted (or stop_event is set).
+# jira is the JiraApi for the safety-net syncs and the project list; with
+# None only the webhooks are applied
+def run(server, db, jira=None, gap_fill_seconds=DEFAULT_GAP_FILL_MINUTES * 60, stop_event=None):
+    db.recover_bulk_load()
+    project_names = set(jira.project_names) if jira is not None else None
+    next_gap_fill = time.monotonic() + gap_fill_seconds if gap_fill_seconds else None
+    pending = []
+    try:
+        while stop_event is None or not stop_event.is_set():
+            batch = pending + next_batch(server.events)
+            pending = []
+            if batch and not try_apply_batch(db, batch, project_names):
+                # Kept for the next pass, e.g. while a sync holds the write lock
+                pending = batch
+                time.sleep(BATCH_MAX_SECONDS)
+            if jira is not None and next_gap_fill is not None and time.monotonic() >= next_gap_fill:
+                print("Running gap-fill sync...")
+                try:
+                    with stats.timer("webhook.gap_fill"):
+                        jira.sync_db()
+                except Exception as error:
+                    stats.count("webhook.gap_fill_errors")
+                    print(f"Gap-fill sync failed, trying again in {gap_fill_seconds}s: {error!r}")
+                next_gap_fill = time.monotonic() + gap_fill_seconds
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Whatever arrived before the stop still gets written
+        remaining = pending + drain(server.events)
+        if remaining:
+            apply_batch(db, remaining, project_names)
+
+
+# apply_batch, logging a failure instead of raising it. Returns whether the
+# batch was written
+def try_apply_batch(db, payloads, project_names=None):
+    try:
+        apply_batch(db, payloads, project_names)
+        return True
+    except Exception as error:
+        stats.count("webhook.apply_errors")
+        print(f"Couldn't apply {len(payloads)} webhook events, will retry: {error!r}")
+        return False
+
+
+# Waits up to BATCH_MAX_SECONDS for the first event, then takes whatever
+# else arrives until the batch is full or has waited BATCH_MAX_SECONDS
+def next_batch(events):
+    try:
+        batch = [events.get(timeout=BATCH_MAX_SECONDS)]
+    except queue.Empty:
+        return []
+    deadline = time.monotonic() + BATCH_MAX_SECONDS
+    while len(batch) < BATCH_MAX_EVENTS:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(events.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def drain(events):
+    batch = []
+    while True:
+        try:
+            batch.append(events.get_nowait())
+        except queue.Empty:
+            return batch
+
+
+def apply_batch(db, payloads, project_names=None):
+    issues, deleted_ids = collapse_batch(payloads, project_names)
+    with stats.timer("webhook.apply"):
+        if issues:
+            db.store_tickets(issues)
+        if deleted_ids:
+            db.tombstone_tickets(deleted_ids)
+    stats.count("webhook.batches")
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Applied {len(payloads)} webhook events "
+          f"({len(issues)} issues updated, {len(deleted_ids)} deleted)")
+
+
+# Posts recorded payloads (a JSON lines file from record_path) to a running
+# receiver, e.g. to test it or to rebuild a DB from a capture. delay is
+# seconds between posts. Returns how many were accepted
+def replay(path, url, secret=None, delay=0.0):
+    accepted = 0
+    with open(path, encoding="utf-8") as recording:
+        for line in recording:
+            if not line.strip():
+                continue
+            body = line.strip().encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            if secret:
+                headers["X-Hub-Signature"] = "sha256=" + hmac.new(
+                    secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+            with urllib.request.urlopen(request) as response:
+                if response.status < 300:
+                    accepted += 1
+            if delay:
+                time.sleep(delay)
+    return accepted